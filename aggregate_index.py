@@ -0,0 +1,121 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+from dao import AGGREGATE_INDEX_FILE_NAME, get_results_store_dir
+from instrumentation import measure, report
+from results_store import PARTITION_FILE_NAME
+
+HISTOGRAM_BINS = 50
+SUMMARY_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def get_index_path(store_dir: str = None) -> str:
+    return os.path.join(store_dir or get_results_store_dir(), AGGREGATE_INDEX_FILE_NAME)
+
+
+def summarize_values(values: np.ndarray, bins: int = HISTOGRAM_BINS) -> dict:
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return {"count": 0}
+    # Densities rather than counts, so cost functions with different numbers
+    # of subjects overlay on the same axis.
+    density, edges = np.histogram(values, bins=bins, density=True)
+    percentiles = np.percentile(values, SUMMARY_PERCENTILES)
+    summary = {
+        "count": int(values.size),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "density": density.tolist(),
+        "edges": edges.tolist(),
+    }
+    for percentile, value in zip(SUMMARY_PERCENTILES, percentiles):
+        summary[f"p{percentile}"] = float(value)
+    return summary
+
+
+def summarize_partition(path: str, bins: int = HISTOGRAM_BINS) -> list:
+    import pandas as pd
+
+    # The partition directory names hold the target and the formatted cost
+    # function name; the original name is read from its column.
+    target_id = os.path.basename(os.path.dirname(os.path.dirname(path)))
+    target_id = target_id.split("=", 1)[1]
+    frame = pd.read_parquet(path, engine="pyarrow")
+    entries = []
+    for (cost_function, metric), values in frame.groupby(
+        ["cost_function", "metric"]
+    )["value"]:
+        entry = {
+            "target_id": target_id,
+            "cost_function": cost_function,
+            "metric": metric,
+        }
+        entry.update(summarize_values(np.asarray(values, dtype=float), bins))
+        entries.append(entry)
+    return entries
+
+
+def load_index(store_dir: str = None) -> dict:
+    try:
+        with open(get_index_path(store_dir)) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {"bins": None, "partitions": {}}
+
+
+def save_index(index: dict, store_dir: str = None):
+    path = get_index_path(store_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(tmp_path, path)
+
+
+def update_index(store_dir: str = None, bins: int = HISTOGRAM_BINS) -> dict:
+    # Only partitions written since the last update are read again, so keeping
+    # the index current costs a stat per partition.
+    store_dir = store_dir or get_results_store_dir()
+    index = load_index(store_dir)
+    if index["bins"] != bins:
+        index = {"bins": bins, "partitions": {}}
+    known = index["partitions"]
+    paths = glob.glob(os.path.join(store_dir, "*", "*", PARTITION_FILE_NAME))
+    current = dict()
+    updated = 0
+    for path in paths:
+        mtime = os.stat(path).st_mtime_ns
+        entry = known.get(path)
+        if entry is None or entry["mtime"] != mtime:
+            with measure("aggregate_index", path=path):
+                entry = {"mtime": mtime, "entries": summarize_partition(path, bins)}
+            updated += 1
+        current[path] = entry
+    removed = len(set(known) - set(current))
+    index["partitions"] = current
+    if updated or removed:
+        save_index(index, store_dir)
+        report(f"Aggregate index updated ({updated} partitions, {removed} removed).")
+    return index
+
+
+def iterate_entries(index: dict, **filters):
+    for partition in index["partitions"].values():
+        for entry in partition["entries"]:
+            if all(entry[name] == value for name, value in filters.items()):
+                yield entry
+
+
+def get_index_values(index: dict, key: str, **filters) -> list:
+    return sorted({entry[key] for entry in iterate_entries(index, **filters)})
+
+
+def get_cost_function_entries(index: dict, target_id: str, metric: str) -> dict:
+    return {
+        entry["cost_function"]: entry
+        for entry in iterate_entries(index, target_id=target_id, metric=metric)
+    }
@@ -0,0 +1,386 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import stat
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+import dao
+from instrumentation import (
+    get_children_usage,
+    read_high_water_mark_kb,
+    reset_peak_rss,
+    set_quiet,
+)
+from volume_format import load_data, save_image
+
+BENCHMARK_TARGET_ID = "TARGET"
+BENCHMARK_COST_FUNCTION = "Mutual Information"
+BENCHMARK_REALIGN_COST_FUNCTION = "Correlation Ratio"
+PHANTOM_FILE_NAME = "MPRAGE_1mm.nii.gz"
+DICOM_DIR_NAME = "DICOM"
+DICOM_SERIES_DESCRIPTION = "MPRAGE_1mm"
+DICOM_SERIES_DATE = "20180101"
+STUB_COST = 0.5
+REGRESSION_THRESHOLD = 0.1
+
+# Stubs accept the flags the pipeline passes and create whatever outputs
+# nipype expects to find, so every stage runs without FSL or dcm2niix.
+STUB_FLIRT = """#!{python}
+import shutil, sys
+args = sys.argv[1:]
+options = dict(zip(args[::2], args[1::2]))
+if "-out" in options:
+    shutil.copyfile(options["-in"], options["-out"])
+if "-omat" in options:
+    with open(options["-omat"], "w") as f:
+        f.write("1 0 0 0\\n0 1 0 0\\n0 0 1 0\\n0 0 0 1\\n")
+print("{cost} 0 0 0")
+"""
+STUB_FNIRT = """#!{python}
+import shutil, sys
+options = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+for key in ("--iout", "--fout", "--cout"):
+    if key in options:
+        shutil.copyfile(options["--in"], options[key])
+"""
+STUB_BET = """#!{python}
+import shutil, sys
+shutil.copyfile(sys.argv[1], sys.argv[2])
+"""
+STUB_DCM2NIIX = """#!{python}
+import os, sys
+args = sys.argv[1:]
+options = dict(zip(args[:-1:2], args[1:-1:2]))
+open(os.path.join(options["-o"], options["-f"] + ".nii.gz"), "wb").close()
+"""
+STUBS = {
+    "flirt": STUB_FLIRT,
+    "fnirt": STUB_FNIRT,
+    "bet": STUB_BET,
+    "dcm2niix": STUB_DCM2NIIX,
+}
+
+
+def create_phantom(shape: tuple, seed: int = 0) -> np.ndarray:
+    # An ellipsoidal "brain" with a brighter core and noise on a zero
+    # background, roughly like a skull-stripped T1.
+    random = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, size) for size in shape], indexing="ij")
+    radius = sum((axis / 0.8) ** 2 for axis in grid)
+    phantom = np.where(radius < 1, 600, 0) + np.where(radius < 0.4, 300, 0)
+    phantom = phantom + random.normal(0, 40, shape) * (radius < 1)
+    return np.clip(phantom, 0, None).astype(np.int16)
+
+
+def save_phantom(path: str, data: np.ndarray):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+
+
+def write_stub_executables(bin_dir: str) -> dict:
+    os.makedirs(bin_dir, exist_ok=True)
+    paths = dict()
+    for name, template in STUBS.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as stub:
+            stub.write(template.format(python=sys.executable, cost=STUB_COST))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        paths[name] = path
+    return paths
+
+
+def save_dicom_series(series_dir: str, patient_id: str, n_files: int = 4):
+    # Header-only files: to_nifti reads the headers, and the dcm2niix stub
+    # ignores the pixel data anyway.
+    import pydicom
+    from pydicom.dataset import Dataset, FileDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    os.makedirs(series_dir, exist_ok=True)
+    series_uid = generate_uid()
+    for index in range(n_files):
+        file_meta = Dataset()
+        file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        path = os.path.join(series_dir, f"{index:04d}.dcm")
+        dcm = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        dcm.is_little_endian, dcm.is_implicit_VR = True, False
+        dcm.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        dcm.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        dcm.SeriesInstanceUID = series_uid
+        dcm.PatientID = patient_id
+        dcm.SeriesDescription = DICOM_SERIES_DESCRIPTION
+        dcm.SeriesDate = DICOM_SERIES_DATE
+        dcm.InstanceNumber = index + 1
+        pydicom.dcmwrite(path, dcm)
+
+
+def create_dicom_tree(base_dir: str, subject_ids: list):
+    # One study directory per subject with a single series, the layout
+    # to_nifti globs for.
+    source_dir = os.path.join(base_dir, DICOM_DIR_NAME)
+    for index, subject_id in enumerate(subject_ids):
+        series_dir = os.path.join(source_dir, subject_id, "series")
+        save_dicom_series(series_dir, str(index + 1))
+    return source_dir
+
+
+def create_subject_tree(
+    base_dir: str, n_subjects: int = 10, shape: tuple = (64, 64, 64)
+) -> list:
+    dao.set_base_dir(base_dir)
+    save_phantom(dao.get_target_scan_path(BENCHMARK_TARGET_ID), create_phantom(shape))
+    subject_ids = [f"SUBJECT{index:05d}" for index in range(n_subjects)]
+    for index, subject_id in enumerate(subject_ids):
+        phantom = create_phantom(shape, seed=index + 1)
+        for status in ("raw", "skull_stripped"):
+            path = os.path.join(dao.LOCATION_DICT[status], subject_id, PHANTOM_FILE_NAME)
+            save_phantom(path, phantom)
+        realigned_dir = dao.get_realigned_subject_dir(
+            BENCHMARK_TARGET_ID, BENCHMARK_COST_FUNCTION, subject_id
+        )
+        save_phantom(os.path.join(realigned_dir, PHANTOM_FILE_NAME), phantom)
+        with open(os.path.join(realigned_dir, "MPRAGE_1mm.mat"), "w") as mat_file:
+            mat_file.write("1 0 0 0\n0 1 0 0\n0 0 1 0\n0 0 0 1\n")
+    return subject_ids
+
+
+def run_discovery():
+    dao.get_scans(dao.LOCATION_DICT["skull_stripped"], "t1")
+
+
+def run_catalog_discovery():
+    from catalog import ScanCatalog
+
+    with ScanCatalog() as catalog:
+        catalog.refresh()
+        dao.get_scans(dao.LOCATION_DICT["skull_stripped"], "t1", catalog=catalog)
+
+
+def run_mutual_information():
+    from mutual_information import calculate_mutual_information_scores
+
+    calculate_mutual_information_scores(
+        BENCHMARK_TARGET_ID, BENCHMARK_COST_FUNCTION, serialize=False, resume=False
+    )
+
+
+def run_cost():
+    import cost_finder
+
+    cost_finder.calculate_realignment_cost(
+        BENCHMARK_TARGET_ID, BENCHMARK_COST_FUNCTION, serialize=False, resume=False
+    )
+
+
+def run_realign():
+    from realign import run_realign
+
+    run_realign(BENCHMARK_TARGET_ID, BENCHMARK_REALIGN_COST_FUNCTION)
+
+
+def run_to_nifti():
+    from to_nifti import to_nifti
+
+    source_dir = os.path.join(dao.BASE_DIR, DICOM_DIR_NAME)
+    # A fresh destination, so every series is converted rather than skipped.
+    dest_dir = tempfile.mkdtemp(prefix="NIfTI_", dir=dao.BASE_DIR)
+    to_nifti(source_dir, dest_dir, command="dcm2niix", workers=4)
+
+
+def run_results_aggregation():
+    from results_store import read_results_frame, write_metric
+
+    subject_dirs = dao.generate_subject_dirs(
+        "realigned", BENCHMARK_TARGET_ID, BENCHMARK_COST_FUNCTION
+    )
+    values = {subject_dir.split("/")[-2]: 0.0 for subject_dir in subject_dirs}
+    write_metric(values, BENCHMARK_TARGET_ID, BENCHMARK_COST_FUNCTION, "Benchmark")
+    read_results_frame(BENCHMARK_TARGET_ID, metric="Benchmark")
+
+
+STAGES = {
+    "discovery": run_discovery,
+    "catalog_discovery": run_catalog_discovery,
+    "mutual_information": run_mutual_information,
+    "cost": run_cost,
+    "realign": run_realign,
+    "to_nifti": run_to_nifti,
+    "results_aggregation": run_results_aggregation,
+}
+
+
+def measure_stage(stage: str, base_dir: str, quiet: bool = True) -> dict:
+    # Runs in a worker process, which is forked from the parent after the
+    # phantoms were generated and so inherits the parent's ru_maxrss. The
+    # high-water mark is reset when the stage starts so the peak is the
+    # stage's own; where that is unsupported, the peak is reported as the
+    # rise over the inherited one.
+    dao.set_base_dir(base_dir)
+    set_quiet(quiet)
+    inherited_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracked = reset_peak_rss()
+    start_child_cpu, _ = get_children_usage()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    STAGES[stage]()
+    wall_time = time.perf_counter() - start_wall
+    cpu_time = time.process_time() - start_cpu
+    child_cpu_time = get_children_usage()[0] - start_child_cpu
+    peak_rss_kb = read_high_water_mark_kb() if tracked else None
+    if peak_rss_kb is None:
+        peak_rss_kb = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - inherited_rss_kb
+        )
+    return {
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "child_cpu_time": child_cpu_time,
+        "peak_rss_kb": peak_rss_kb,
+    }
+
+
+def benchmark_volume_formats(
+    base_dir: str,
+    shape: tuple = (64, 64, 64),
+    formats: list = None,
+    repeats: int = 3,
+) -> dict:
+    image = nib.Nifti1Image(create_phantom(shape), np.eye(4))
+    nbytes = np.asarray(image.get_data()).nbytes
+    results = dict()
+    for volume_format in formats or dao.VOLUME_FORMAT_EXTENSIONS:
+        name = "phantom_" + volume_format.replace(".", "_")
+        path = os.path.join(base_dir, "formats", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        start = time.perf_counter()
+        try:
+            path = save_image(image, path, volume_format)
+        except ImportError as e:
+            print(f"{volume_format}: skipped ({e})")
+            continue
+        write_time = time.perf_counter() - start
+        read_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            load_data(path)
+            read_times.append(time.perf_counter() - start)
+        read_time = min(read_times)
+        results[volume_format] = {
+            "write_time": write_time,
+            "read_time": read_time,
+            "read_throughput_mb": nbytes / read_time / 2 ** 20,
+            "disk_bytes": os.path.getsize(path),
+            "compression_ratio": nbytes / os.path.getsize(path),
+        }
+        print(
+            f"{volume_format}: read {results[volume_format]['read_throughput_mb']:.0f} MB/s, write {write_time:.3f}s, {results[volume_format]['disk_bytes']} bytes on disk"
+        )
+    return results
+
+
+def run_benchmark(
+    n_subjects: int = 10,
+    shape: tuple = (64, 64, 64),
+    stages: list = None,
+    base_dir: str = None,
+    formats: list = None,
+) -> dict:
+    base_dir = base_dir or tempfile.mkdtemp(prefix="brain_profile_benchmark_")
+    stub_paths = write_stub_executables(os.path.join(base_dir, "bin"))
+    os.environ["PATH"] = os.pathsep.join(
+        [os.path.dirname(stub_paths["flirt"]), os.environ.get("PATH", "")]
+    )
+    os.environ.setdefault("FSLOUTPUTTYPE", "NIFTI_GZ")
+    import cost_finder
+
+    schedule = os.path.join(base_dir, "measurecost1.sch")
+    open(schedule, "w").close()
+    cost_finder.COST_SCHEDULE = schedule
+    subject_ids = create_subject_tree(base_dir, n_subjects, shape)
+    stages = list(STAGES) if stages is None else stages
+    if "to_nifti" in stages:
+        create_dicom_tree(base_dir, subject_ids)
+    results = dict()
+    for stage in stages:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            measurement = executor.submit(measure_stage, stage, base_dir).result()
+        measurement["throughput"] = n_subjects / measurement["wall_time"]
+        results[stage] = measurement
+        print(
+            f"{stage}: {measurement['wall_time']:.3f}s, {measurement['throughput']:.1f} subjects/s, peak RSS {measurement['peak_rss_kb']} kB"
+        )
+    format_results = dict()
+    if formats is not None:
+        format_results = benchmark_volume_formats(base_dir, shape, formats)
+    return {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "n_subjects": n_subjects,
+        "shape": list(shape),
+        "stages": results,
+        "formats": format_results,
+    }
+
+
+def save_benchmark(results: dict, path: str):
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+
+def compare_benchmarks(
+    baseline_path: str, current_path: str, threshold: float = REGRESSION_THRESHOLD
+) -> dict:
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["stages"]
+    with open(current_path) as current_file:
+        current = json.load(current_file)["stages"]
+    regressions = dict()
+    for stage in set(baseline) & set(current):
+        for key in ("wall_time", "peak_rss_kb"):
+            change = current[stage][key] / baseline[stage][key] - 1
+            print(f"{stage} {key}: {change:+.1%}")
+            if change > threshold:
+                regressions[f"{stage}.{key}"] = change
+    return regressions
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages.")
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--shape", type=int, nargs=3, default=[64, 64, 64])
+    parser.add_argument("--stages", nargs="*", choices=list(STAGES))
+    parser.add_argument(
+        "--formats",
+        nargs="*",
+        choices=list(dao.VOLUME_FORMAT_EXTENSIONS),
+        help="Compare intermediate volume formats (all of them if none given).",
+    )
+    parser.add_argument("--base-dir")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="Baseline JSON to check for regressions.")
+    args = parser.parse_args(argv)
+    results = run_benchmark(
+        args.subjects, tuple(args.shape), args.stages, args.base_dir, args.formats
+    )
+    save_benchmark(results, args.output)
+    if args.compare:
+        regressions = compare_benchmarks(args.compare, args.output)
+        if regressions:
+            print(f"Regressions: {regressions}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,8 @@ import glob
 import os
 
 from nipype import Node
-from nipype.interfaces.fsl import BET, FAST
+from nipype.interfaces.fsl import BET
+from output_commit import OutputCommit, is_complete
 
 DATA_DIR = '/export/home/zvibaratz/Projects/brain_profile/Skull-stripped'
 PATTERN = '**/*.nii.gz'
@@ -22,7 +23,8 @@ def get_default_destination(
 
 def run_bet(
         skip_existing: bool = True
-):
+) -> dict:
+    failures = dict()
     full_pattern = os.path.join(DATA_DIR, PATTERN)
     scans = glob.iglob(full_pattern, recursive=True)
     for scan in scans:
@@ -30,21 +32,24 @@ def run_bet(
         if skip_existing:
             print('Checking for existing skull-stripping output...', end='\t')
         dest = get_default_destination(scan)
-        if skip_existing and os.path.isfile(dest):
+        if skip_existing and is_complete(dest, [scan], {'robust': True}):
             print(f'\u2714')
             continue
         print(f'\u2718')
         print('Running skull-stripping with BET...')
         try:
-            bet = Node(BET(robust=True), name='bet_node')
-            bet.inputs.in_file = scan
-            bet.inputs.out_file = dest
-            bet.run()
+            with OutputCommit(dest, [scan], {'robust': True}) as commit:
+                bet = Node(BET(robust=True), name='bet_node')
+                bet.inputs.in_file = scan
+                bet.inputs.out_file = commit.stage(dest)
+                bet.run()
             print(f'\u2714\tDone!')
         except Exception as e:
             print(f'\u2718')
             print(e.args)
-            break
+            failures[scan] = str(e)
+    return failures
+
 
 def run_fast(in_file: str):
-    
\ No newline at end of file
+    raise NotImplementedError('Bias-field correction with FAST is not implemented.')
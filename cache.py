@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+FINGERPRINT_METHODS = ("stat", "content")
+HASH_CHUNK_SIZE = 1 << 20
+EVICTION_INTERVAL = 1000
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    target_id TEXT,
+    metric TEXT,
+    value TEXT,
+    accessed REAL
+);
+CREATE INDEX IF NOT EXISTS results_target ON results (target_id);
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+"""
+
+
+def hash_file_content(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_file(path: str, method: str = "stat") -> str:
+    if method == "stat":
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+    elif method == "content":
+        return hash_file_content(path)
+    raise ValueError(f"Invalid fingerprint method {method}! Use one of {FINGERPRINT_METHODS}.")
+
+
+class ResultCache:
+    def __init__(self, path: str, max_entries: int = 1000000, fingerprint: str = "stat"):
+        if fingerprint not in FINGERPRINT_METHODS:
+            raise ValueError(
+                f"Invalid fingerprint method {fingerprint}! Use one of {FINGERPRINT_METHODS}."
+            )
+        self.path = path
+        self.max_entries = max_entries
+        self.fingerprint = fingerprint
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+        self._pending_inserts = 0
+
+    def make_key(self, metric: str, paths: list, **params) -> str:
+        fingerprints = [
+            fingerprint_file(path, self.fingerprint) if path else None
+            for path in paths
+        ]
+        description = json.dumps(
+            {"metric": metric, "inputs": fingerprints, "params": params},
+            sort_keys=True,
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key: str, default=None):
+        row = self.connection.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        with self.connection:
+            self.connection.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key: str, value, target_id: str, metric: str = None):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, target_id, metric, json.dumps(value), time.time()),
+            )
+        self._pending_inserts += 1
+        if self._pending_inserts >= EVICTION_INTERVAL:
+            self.evict()
+
+    def evict(self) -> int:
+        self._pending_inserts = 0
+        count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY accessed LIMIT ?)",
+                (excess,),
+            )
+        return excess
+
+    def invalidate_target(self, target_id: str) -> int:
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM results WHERE target_id = ?", (target_id,)
+            )
+        return cursor.rowcount
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM results")
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
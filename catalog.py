@@ -0,0 +1,218 @@
+import os
+import sqlite3
+
+from dao import (
+    LOCATION_DICT,
+    REALIGNED_DIR_NAME,
+    SERIES_DICT,
+    VOLUME_EXTENSIONS,
+    format_cost_function_name,
+    get_catalog_path,
+)
+from instrumentation import report
+
+CATALOGED_EXTENSIONS = VOLUME_EXTENSIONS + (".mat",)
+SCAN_STAGES = ("raw", "skull_stripped", "bias_corrected")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    subject_dir TEXT,
+    base_dir TEXT,
+    subject_id TEXT,
+    series_type TEXT,
+    stage TEXT,
+    target_id TEXT,
+    cost_function TEXT,
+    size INTEGER,
+    mtime INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_subject_dir ON files (subject_dir);
+CREATE INDEX IF NOT EXISTS files_base_dir ON files (base_dir);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    base_dir TEXT,
+    mtime INTEGER
+);
+CREATE INDEX IF NOT EXISTS directories_base_dir ON directories (base_dir);
+"""
+
+
+def get_series_type(file_name: str) -> str:
+    for series_type, identifiers in SERIES_DICT.items():
+        if any(identifier in file_name for identifier in identifiers):
+            return series_type
+    return None
+
+
+def list_subdirectories(path: str) -> list:
+    try:
+        return [entry for entry in os.scandir(path) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+class ScanCatalog:
+    def __init__(self, path: str = None):
+        self.path = path or get_catalog_path()
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def refresh(self, verbose: bool = True) -> int:
+        updated = 0
+        with self.connection:
+            for stage in SCAN_STAGES:
+                updated += self.refresh_base_dir(LOCATION_DICT[stage], stage)
+            target_root = LOCATION_DICT["target"]
+            updated += self.refresh_base_dir(target_root, "target")
+            for target_entry in list_subdirectories(target_root):
+                realigned_dir = os.path.join(target_entry.path, REALIGNED_DIR_NAME)
+                for cost_function_entry in list_subdirectories(realigned_dir):
+                    updated += self.refresh_base_dir(
+                        cost_function_entry.path,
+                        "realigned",
+                        target_id=target_entry.name,
+                        cost_function=cost_function_entry.name,
+                    )
+        if verbose:
+            report(f"Catalog refreshed ({updated} directories updated).")
+        return updated
+
+    def refresh_base_dir(
+        self,
+        base_dir: str,
+        stage: str,
+        target_id: str = None,
+        cost_function: str = None,
+    ) -> int:
+        known = dict(
+            self.connection.execute(
+                "SELECT path, mtime FROM directories WHERE base_dir = ?", (base_dir,)
+            )
+        )
+        updated = 0
+        for entry in list_subdirectories(base_dir):
+            mtime = entry.stat().st_mtime_ns
+            if known.pop(entry.path, None) != mtime:
+                subject_target_id = entry.name if stage == "target" else target_id
+                self.scan_subject_dir(
+                    entry.path, base_dir, stage, subject_target_id, cost_function
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                    (entry.path, base_dir, mtime),
+                )
+                updated += 1
+        for removed_dir in known:
+            self.connection.execute(
+                "DELETE FROM files WHERE subject_dir = ?", (removed_dir,)
+            )
+            self.connection.execute(
+                "DELETE FROM directories WHERE path = ?", (removed_dir,)
+            )
+            updated += 1
+        return updated
+
+    def scan_subject_dir(
+        self,
+        subject_dir: str,
+        base_dir: str,
+        stage: str,
+        target_id: str = None,
+        cost_function: str = None,
+    ):
+        subject_id = os.path.basename(subject_dir)
+        self.connection.execute(
+            "DELETE FROM files WHERE subject_dir = ?", (subject_dir,)
+        )
+        rows = []
+        for entry in os.scandir(subject_dir):
+            if not entry.is_file() or not entry.name.endswith(CATALOGED_EXTENSIONS):
+                continue
+            # Temporary outputs and completion markers are hidden files.
+            if entry.name.startswith("."):
+                continue
+            stat = entry.stat()
+            rows.append(
+                (
+                    entry.path,
+                    subject_dir,
+                    base_dir,
+                    subject_id,
+                    get_series_type(entry.name),
+                    stage,
+                    target_id,
+                    cost_function,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                )
+            )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+    def list_subject_dirs(self, base_dir: str) -> list:
+        base_dir = os.path.normpath(base_dir)
+        return [
+            os.path.join(path, "")
+            for path, in self.connection.execute(
+                "SELECT path FROM directories WHERE base_dir = ? ORDER BY path",
+                (base_dir,),
+            )
+        ]
+
+    def list_files(self, subject_dir: str, extension: str = None) -> list:
+        subject_dir = os.path.normpath(subject_dir)
+        files = [
+            path
+            for path, in self.connection.execute(
+                "SELECT path FROM files WHERE subject_dir = ? ORDER BY path",
+                (subject_dir,),
+            )
+        ]
+        if extension is not None:
+            files = [path for path in files if path.endswith(extension)]
+        return files
+
+    def list_scans(self, base_dir: str, extension=VOLUME_EXTENSIONS) -> list:
+        base_dir = os.path.normpath(base_dir)
+        return [
+            path
+            for path, in self.connection.execute(
+                "SELECT path FROM files WHERE base_dir = ? ORDER BY path", (base_dir,)
+            )
+            if path.endswith(extension)
+        ]
+
+    def query(
+        self,
+        stage: str = None,
+        subject_id: str = None,
+        series_type: str = None,
+        target_id: str = None,
+        cost_function: str = None,
+    ) -> list:
+        if cost_function is not None:
+            cost_function = format_cost_function_name(cost_function)
+        filters = {
+            "stage": stage,
+            "subject_id": subject_id,
+            "series_type": series_type,
+            "target_id": target_id,
+            "cost_function": cost_function,
+        }
+        conditions = [f"{column} = ?" for column, value in filters.items() if value]
+        values = [value for value in filters.values() if value]
+        statement = "SELECT path FROM files"
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        statement += " ORDER BY path"
+        return [path for path, in self.connection.execute(statement, values)]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,485 @@
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+
+PROG = "brain-profile"
+# Modules each subcommand needs, imported only once that subcommand runs.
+COMMAND_MODULES = {
+    "realign": ["realign"],
+    "mi": ["mutual_information"],
+    "screen": ["screening"],
+    "fingerprint": ["fingerprints"],
+    "cost": ["cost_finder"],
+    "plan": ["planner"],
+    "qa": ["quality_control"],
+    "catalog": ["catalog"],
+    "worker": ["work_queue"],
+    "startup": [],
+}
+
+
+def import_command(command: str) -> list:
+    return [importlib.import_module(name) for name in COMMAND_MODULES[command]]
+
+
+def open_catalog(args):
+    if not args.catalog:
+        return None
+    from catalog import ScanCatalog
+
+    catalog = ScanCatalog(args.catalog_path)
+    catalog.refresh()
+    return catalog
+
+
+def open_manifest(args, base_dir: str, catalog=None):
+    # Scans added, changed or removed since the manifest was last refreshed
+    # would otherwise be planned from stale headers, or not at all.
+    if not getattr(args, "manifest", False):
+        return None
+    from planner import ScanManifest
+
+    manifest = ScanManifest(args.manifest_path)
+    if not args.no_refresh:
+        manifest.refresh(base_dir, catalog)
+    return manifest
+
+
+def open_quality_report(args):
+    if not getattr(args, "quality_gate", False):
+        return None
+    from quality_control import QualityReport
+
+    return QualityReport(args.quality_control_path, args.outlier_threshold)
+
+
+def open_queue(args):
+    if not args.queue:
+        return None
+    from work_queue import WorkQueue
+
+    return WorkQueue(args.queue_path)
+
+
+def run_realign(args):
+    from dao import LOCATION_DICT
+    from realign import run_nonlinear_registration, run_realign
+
+    catalog = open_catalog(args)
+    if args.nonlinear:
+        results = run_nonlinear_registration(
+            args.target_id, workers=args.workers, catalog=catalog
+        )
+    else:
+        results = run_realign(
+            args.target_id,
+            args.cost_function,
+            workers=args.workers,
+            catalog=catalog,
+            queue=open_queue(args),
+            manifest=open_manifest(args, LOCATION_DICT["skull_stripped"], catalog),
+            quality_control=open_quality_report(args),
+        )
+    return int(any(result.status == "failed" for result in results.values()))
+
+
+def run_mutual_information(args):
+    from dao import COST_FUNCTION_DICT
+    from mutual_information import calculate_mutual_information_scores
+
+    catalog = open_catalog(args)
+    queue = open_queue(args)
+    cost_functions = args.cost_function or list(COST_FUNCTION_DICT.values())
+    for cost_function in cost_functions:
+        calculate_mutual_information_scores(
+            args.target_id,
+            cost_function,
+            bins=args.bins,
+            memory_budget=args.memory_budget,
+            prebinned=args.prebinned,
+            catalog=catalog,
+            queue=queue,
+        )
+    return 0
+
+
+def run_screening(args):
+    from screening import screen_mutual_information
+
+    screen_mutual_information(
+        args.target_id,
+        args.cost_function,
+        bins=args.bins,
+        mask=args.mask,
+        factor=args.downsample,
+        method=args.downsample_method,
+        top_k=args.top_k,
+        calibration_size=args.calibration_size,
+        catalog=open_catalog(args),
+    )
+    return 0
+
+
+def run_fingerprints(args):
+    from fingerprints import (
+        FingerprintIndex,
+        calculate_recall_at_k,
+        find_candidates,
+        run_shortlist,
+    )
+
+    index = FingerprintIndex(args.index_path)
+    if args.action == "build":
+        index.update(workers=args.workers, catalog=open_catalog(args))
+    elif args.action == "query":
+        for target_id, candidates in find_candidates(
+            args.target_id, args.top_k, index
+        ).items():
+            for subject_id, score in candidates:
+                print(f"{target_id}\t{subject_id}\t{score:.4f}")
+    elif args.action == "shortlist":
+        for target_id in args.target_id:
+            scores = run_shortlist(
+                target_id,
+                args.cost_function,
+                args.top_k,
+                index,
+                workers=args.workers,
+                catalog=open_catalog(args),
+            )
+            for subject_id, score in scores.items():
+                print(f"{target_id}\t{subject_id}\t{score}")
+    else:
+        calculate_recall_at_k(args.target_id, args.cost_function, args.ks, index)
+    return 0
+
+
+def run_plan(args):
+    from planner import ScanManifest, plan_bet, plan_realign, report_plan
+
+    manifest = ScanManifest(args.manifest_path)
+    options = dict(
+        workers=args.workers,
+        memory_limit=args.memory_limit,
+        manifest=manifest,
+        refresh=not args.no_refresh,
+        catalog=open_catalog(args),
+    )
+    if args.stage == "bet":
+        plan = plan_bet(**options)
+    else:
+        if args.target_id is None:
+            print("realign plans need a target_id")
+            return 2
+        plan = plan_realign(args.target_id, args.cost_function, **options)
+    report_plan(plan)
+    return 0
+
+
+def run_adopt(args):
+    from planner import ScanManifest, adopt_bet, adopt_realign
+
+    options = dict(
+        manifest=ScanManifest(args.manifest_path),
+        refresh=not args.no_refresh,
+        catalog=open_catalog(args),
+    )
+    if args.stage == "bet":
+        _, rejected = adopt_bet(**options)
+    else:
+        if args.target_id is None:
+            print("realign adoption needs a target_id")
+            return 2
+        _, rejected = adopt_realign(args.target_id, args.cost_function, **options)
+    return int(bool(rejected))
+
+
+def run_quality_control(args):
+    from quality_control import QualityReport, run_quality_control
+
+    flags = run_quality_control(
+        args.stage,
+        args.scan_type,
+        workers=args.workers,
+        memory_budget=args.memory_budget,
+        quality_report=QualityReport(args.quality_control_path, args.outlier_threshold),
+        catalog=open_catalog(args),
+    )
+    return int(bool(flags))
+
+
+def run_cost(args):
+    from cost_finder import calculate_realignment_cost, compare_native_costs
+
+    if args.compare:
+        outliers = compare_native_costs(
+            args.target_id, args.cost_function, tolerance=args.tolerance
+        )
+        return int(bool(outliers))
+    _, failures = calculate_realignment_cost(
+        args.target_id,
+        args.cost_function,
+        native=args.native,
+        catalog=open_catalog(args),
+    )
+    return int(bool(failures))
+
+
+def run_catalog(args):
+    from catalog import ScanCatalog
+
+    with ScanCatalog(args.catalog_path) as catalog:
+        if args.action == "refresh":
+            catalog.refresh()
+        else:
+            paths = catalog.query(
+                stage=args.stage,
+                subject_id=args.subject_id,
+                series_type=args.series_type,
+                target_id=args.target_id,
+                cost_function=args.cost_function,
+            )
+            print("\n".join(paths))
+    return 0
+
+
+def run_queue_worker(args):
+    from work_queue import WorkQueue, run_local_workers, run_worker
+
+    options = dict(stages=args.stages, lease=args.lease, wait=not args.no_wait)
+    if args.reset_failed:
+        with WorkQueue(args.queue_path) as queue:
+            queue.reset_failed()
+    if args.workers > 1:
+        run_local_workers(args.workers, args.queue_path, **options)
+    else:
+        run_worker(args.queue_path, **options)
+    with WorkQueue(args.queue_path) as queue:
+        print(queue.counts())
+        return int(bool(queue.failures()))
+
+
+def measure_startup(command: str) -> float:
+    # A fresh interpreter per command, so nothing is already imported.
+    code = (
+        "import time; start = time.perf_counter(); import cli; "
+        f"cli.import_command({command!r}); print(time.perf_counter() - start)"
+    )
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=cwd)
+    return float(output.split()[-1])
+
+
+def run_startup(args):
+    for command in args.commands or [c for c in COMMAND_MODULES if c != "startup"]:
+        if command not in COMMAND_MODULES:
+            print(f"{command}: unknown command")
+            continue
+        try:
+            seconds = measure_startup(command)
+        except subprocess.CalledProcessError:
+            print(f"{command}: failed to import")
+            continue
+        print(f"{command}: {seconds * 1000:.0f} ms")
+    return 0
+
+
+def add_catalog_arguments(parser):
+    parser.add_argument("--catalog", action="store_true", help="Query the scan catalog.")
+    parser.add_argument("--catalog-path")
+
+
+def add_queue_arguments(parser):
+    parser.add_argument(
+        "--queue", action="store_true", help="Publish tasks to the work queue."
+    )
+    parser.add_argument("--queue-path")
+
+
+def add_quality_control_arguments(parser):
+    parser.add_argument("--quality-control-path")
+    parser.add_argument("--outlier-threshold", type=float, default=3.5)
+
+
+def add_manifest_arguments(parser):
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="Choose and order scans from the scan manifest.",
+    )
+    parser.add_argument("--manifest-path")
+    parser.add_argument(
+        "--no-refresh",
+        action="store_true",
+        help="Use the manifest as it is, without checking for changed scans.",
+    )
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog=PROG)
+    parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--metrics", help="Write stage timings to this JSONL file.")
+    parser.add_argument(
+        "--volume-format",
+        choices=["nii.gz", "nii", "parallel_gzip", "zstd", "lz4"],
+        help="Format for intermediate volumes.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    realign = subparsers.add_parser("realign", help="Register scans to a target.")
+    realign.add_argument("target_id")
+    realign.add_argument("cost_function", nargs="?", default="Mutual Information")
+    realign.add_argument("--workers", type=int, default=1)
+    realign.add_argument("--nonlinear", action="store_true")
+    add_catalog_arguments(realign)
+    add_queue_arguments(realign)
+    add_manifest_arguments(realign)
+    realign.add_argument(
+        "--quality-gate",
+        action="store_true",
+        help="Skip scans flagged by quality control.",
+    )
+    add_quality_control_arguments(realign)
+    realign.set_defaults(handler=run_realign)
+
+    mi = subparsers.add_parser("mi", help="Score realigned scans against a target.")
+    mi.add_argument("target_id")
+    mi.add_argument("cost_function", nargs="*")
+    mi.add_argument("--bins", type=int, default=10)
+    mi.add_argument("--memory-budget", type=int)
+    mi.add_argument("--prebinned", action="store_true")
+    add_catalog_arguments(mi)
+    add_queue_arguments(mi)
+    mi.set_defaults(handler=run_mutual_information)
+
+    screen = subparsers.add_parser(
+        "screen", help="Rank registrations by masked, downsampled MI."
+    )
+    screen.add_argument("target_id")
+    screen.add_argument("cost_function")
+    screen.add_argument("--bins", type=int, default=10)
+    screen.add_argument("--mask", choices=["target", "nonzero", "none"], default="target")
+    screen.add_argument("--downsample", type=int, default=2)
+    screen.add_argument(
+        "--downsample-method", choices=["stride", "block"], default="stride"
+    )
+    screen.add_argument("--top-k", type=int, default=10)
+    screen.add_argument("--calibration-size", type=int, default=10)
+    add_catalog_arguments(screen)
+    screen.set_defaults(handler=run_screening)
+
+    fingerprint = subparsers.add_parser(
+        "fingerprint", help="Shortlist subjects by scan fingerprint similarity."
+    )
+    fingerprint.add_argument("action", choices=["build", "query", "shortlist", "recall"])
+    fingerprint.add_argument("target_id", nargs="*")
+    fingerprint.add_argument("--cost-function", default="Mutual Information")
+    fingerprint.add_argument("--top-k", type=int, default=10)
+    fingerprint.add_argument("--ks", type=int, nargs="+", default=[1, 5, 10])
+    fingerprint.add_argument("--workers", type=int, default=1)
+    fingerprint.add_argument("--index-path")
+    add_catalog_arguments(fingerprint)
+    fingerprint.set_defaults(handler=run_fingerprints)
+
+    plan = subparsers.add_parser(
+        "plan", help="Report the planned registration work without running FSL."
+    )
+    plan.add_argument("stage", choices=["realign", "bet"])
+    plan.add_argument("target_id", nargs="?")
+    plan.add_argument("cost_function", nargs="?", default="Mutual Information")
+    plan.add_argument("--workers", type=int, default=1)
+    plan.add_argument("--memory-limit", type=int, help="Bytes available to FSL.")
+    plan.add_argument("--no-refresh", action="store_true")
+    plan.add_argument("--manifest-path")
+    add_catalog_arguments(plan)
+    plan.set_defaults(handler=run_plan)
+
+    # Outputs written before completion markers existed are redone by every
+    # stage; adopting them once writes their markers instead.
+    adopt = subparsers.add_parser(
+        "adopt",
+        help="Write completion markers for existing outputs that pass a header and size check.",
+    )
+    adopt.add_argument("stage", choices=["realign", "bet"])
+    adopt.add_argument("target_id", nargs="?")
+    adopt.add_argument("cost_function", nargs="?", default="Mutual Information")
+    adopt.add_argument("--no-refresh", action="store_true")
+    adopt.add_argument("--manifest-path")
+    add_catalog_arguments(adopt)
+    adopt.set_defaults(handler=run_adopt)
+
+    qa = subparsers.add_parser(
+        "qa", help="Compute QA metrics for stage outputs and flag outliers."
+    )
+    qa.add_argument(
+        "stage",
+        nargs="?",
+        choices=["skull_stripped", "bias_corrected"],
+        default="skull_stripped",
+    )
+    qa.add_argument("--scan-type", default="t1")
+    qa.add_argument("--workers", type=int, default=1)
+    qa.add_argument("--memory-budget", type=int, default=256 * 2 ** 20)
+    add_quality_control_arguments(qa)
+    add_catalog_arguments(qa)
+    qa.set_defaults(handler=run_quality_control)
+
+    cost = subparsers.add_parser("cost", help="Measure realignment costs.")
+    cost.add_argument("target_id")
+    cost.add_argument("cost_function")
+    cost.add_argument("--native", action="store_true")
+    cost.add_argument(
+        "--compare",
+        action="store_true",
+        help="Check logged native costs against logged FLIRT costs.",
+    )
+    cost.add_argument("--tolerance", type=float, default=0.05)
+    add_catalog_arguments(cost)
+    cost.set_defaults(handler=run_cost)
+
+    catalog = subparsers.add_parser("catalog", help="Maintain the scan catalog.")
+    catalog.add_argument("action", choices=["refresh", "query"])
+    catalog.add_argument("--catalog-path")
+    for option in ("stage", "subject-id", "series-type", "target-id", "cost-function"):
+        catalog.add_argument(f"--{option}")
+    catalog.set_defaults(handler=run_catalog)
+
+    worker = subparsers.add_parser("worker", help="Run tasks from the work queue.")
+    worker.add_argument("--queue-path")
+    worker.add_argument("--stages", nargs="+")
+    worker.add_argument("--workers", type=int, default=1)
+    worker.add_argument("--lease", type=float, default=5 * 60)
+    worker.add_argument("--no-wait", action="store_true")
+    worker.add_argument("--reset-failed", action="store_true")
+    worker.set_defaults(handler=run_queue_worker)
+
+    startup = subparsers.add_parser(
+        "startup", help="Measure each subcommand's cold-start import time."
+    )
+    startup.add_argument("commands", nargs="*", metavar="command")
+    startup.set_defaults(handler=run_startup)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = create_parser().parse_args(argv)
+    from instrumentation import JsonlSink, add_sink, close_sinks, set_quiet
+
+    set_quiet(args.quiet)
+    if args.volume_format:
+        from dao import set_volume_format
+
+        set_volume_format(args.volume_format)
+    if args.metrics:
+        add_sink(JsonlSink(args.metrics))
+    try:
+        return args.handler(args)
+    finally:
+        close_sinks()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,49 +1,366 @@
+import itertools
+import numpy as np
 import os
 import pickle
 import shutil
 
+from contextlib import ExitStack
+
+from cache import ResultCache
 from dao import (
     get_costs_file_path,
+    get_costs_log_path,
     get_realigned_subject_data,
     generate_subject_dirs,
     get_target_scan,
 )
-from nipype.interfaces.fsl import FLIRT
+from instrumentation import measure, report
+from result_log import ResultLog
+from scheduler import Job
+
+COST_SCHEDULE = "/usr/local/fsl/etc/flirtsch/measurecost1.sch"
+# FLIRT's defaults: measurecost1.sch evaluates the default cost (corratio) with
+# 256 histogram bins.
+DEFAULT_NATIVE_COST_FUNCTION = "Correlation Ratio"
+NATIVE_BINS = 256
+# Native costs are not expected to reproduce FLIRT's measurecost output
+# exactly: FLIRT also smooths its joint histogram with partial-volume weights
+# and bins over a robust intensity range. How far apart they are has not been
+# measured, so this is only the default threshold `cost --compare` reports
+# against.
+NATIVE_COST_TOLERANCE = 0.05
+# Converts similarity metrics to FLIRT's cost conventions (lower is better).
+NATIVE_COST_FUNCTIONS = {
+    "Correlation Ratio": lambda metrics: 1 - metrics["Correlation Ratio"],
+    "Least Squares": lambda metrics: metrics["Least Squares"],
+    "Mutual Information": lambda metrics: -metrics["Mutual Information"],
+    "Normalized Correlation": lambda metrics: 1
+    - abs(metrics["Normalized Correlation"]),
+    "Normalized Mutual Information": lambda metrics: -metrics[
+        "Normalized Mutual Information"
+    ],
+}
+RESAMPLING_SLAB_VOXELS = 2 ** 22
 
 
-def serialize_results(target_id: str, cost_function: str, results: dict) -> bool:
-    file_path = get_costs_file_path(target_id, cost_function)
+def serialize_results(
+    target_id: str, cost_function: str, results: dict, native: bool = False
+) -> bool:
+    file_path = get_costs_file_path(target_id, cost_function, native)
     with open(file_path, "wb") as results_file:
         pickle.dump(results, results_file)
         return True
 
 
-def calculate_realignment_cost(
-    target_id: str, cost_function: str, serialize: bool = True
+def get_cost_params(
+    native: bool = False, native_cost_function: str = DEFAULT_NATIVE_COST_FUNCTION
+) -> dict:
+    if native:
+        return {
+            "mode": "native",
+            "cost_function": native_cost_function,
+            "bins": NATIVE_BINS,
+        }
+    return {"mode": "flirt", "schedule": os.path.basename(COST_SCHEDULE)}
+
+
+def load_realignment_costs(
+    target_id: str,
+    cost_function: str,
+    native: bool = False,
+    native_cost_function: str = DEFAULT_NATIVE_COST_FUNCTION,
+) -> dict:
+    params = get_cost_params(native, native_cost_function)
+    log_path = get_costs_log_path(target_id, cost_function, native)
+    return ResultLog(log_path, params).to_dict()
+
+
+def is_within_tolerance(
+    native_cost: float, flirt_cost: float, tolerance: float = NATIVE_COST_TOLERANCE
+) -> bool:
+    return abs(native_cost - flirt_cost) <= tolerance * abs(flirt_cost)
+
+
+def compare_native_costs(
+    target_id: str,
+    cost_function: str,
+    native_cost_function: str = DEFAULT_NATIVE_COST_FUNCTION,
+    tolerance: float = NATIVE_COST_TOLERANCE,
+) -> dict:
+    # Subjects scored both ways whose native cost is off by more than the
+    # tolerance, with both values.
+    flirt_costs = load_realignment_costs(target_id, cost_function)
+    native_costs = load_realignment_costs(
+        target_id, cost_function, True, native_cost_function
+    )
+    shared = sorted(set(flirt_costs) & set(native_costs))
+    outliers = {
+        subject_id: (native_costs[subject_id], flirt_costs[subject_id])
+        for subject_id in shared
+        if not is_within_tolerance(
+            native_costs[subject_id], flirt_costs[subject_id], tolerance
+        )
+    }
+    report(
+        f"{len(shared) - len(outliers)} of {len(shared)} native costs within {tolerance:.0%} of FLIRT's."
+    )
+    for subject_id, (native_cost, flirt_cost) in outliers.items():
+        report(f"\u2718 {subject_id}: native {native_cost}, FLIRT {flirt_cost}")
+    return outliers
+
+
+def get_cost_tmp_dir(subject_dir: str) -> str:
+    return os.path.join(subject_dir, "tmp")
+
+
+def create_cost_flirt(
+    registered: str, target_scan: str, mat_file: str, subject_dir: str
 ):
+    from nipype.interfaces.fsl import FLIRT
+
+    flirt = FLIRT()
+    flirt.inputs.in_file = registered
+    flirt.inputs.reference = target_scan
+    flirt.inputs.schedule = COST_SCHEDULE
+    flirt.inputs.in_matrix_file = mat_file
+    tmp = get_cost_tmp_dir(subject_dir)
+    flirt.inputs.out_file = os.path.join(tmp, "cost.nii.gz")
+    flirt.inputs.out_matrix_file = os.path.join(tmp, "cost.mat")
+    os.makedirs(tmp, exist_ok=True)
+    return flirt
+
+
+def parse_cost(stdout: str) -> float:
+    return float(stdout.split()[0])
+
+
+def measure_cost(
+    registered: str, target_scan: str, mat_file: str, subject_dir: str
+) -> float:
+    from volume_format import fsl_readable
+
+    # Chunked intermediates are expanded for FLIRT, which only reads NIfTI.
+    with fsl_readable(registered) as in_file, fsl_readable(target_scan) as reference:
+        flirt = create_cost_flirt(in_file, reference, mat_file, subject_dir)
+        with measure("flirt_cost", os.path.basename(subject_dir.rstrip("/"))):
+            f = flirt.run()
+    shutil.rmtree(get_cost_tmp_dir(subject_dir))
+    return parse_cost(f.runtime.stdout)
+
+
+def read_flirt_matrix(mat_file: str) -> np.ndarray:
+    return np.loadtxt(mat_file).reshape(4, 4)
+
+
+def get_fsl_scaling(image) -> np.ndarray:
+    # FLIRT matrices act on voxel coordinates scaled by voxel size, with the x
+    # axis flipped when the image's affine has a positive determinant.
+    zooms = image.header.get_zooms()[:3]
+    scaling = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(image.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = image.shape[0] - 1
+        scaling = scaling.dot(flip)
+    return scaling
+
+
+def interpolate_trilinear(data: np.ndarray, coordinates: np.ndarray) -> tuple:
+    # coordinates is (3, n) in voxel units; samples outside the volume are
+    # flagged invalid, as FLIRT only scores the overlap.
+    upper_bounds = np.array(data.shape[:3])[:, None] - 1
+    valid = np.all((coordinates >= 0) & (coordinates <= upper_bounds), axis=0)
+    coordinates = coordinates[:, valid]
+    lower = np.floor(coordinates).astype(np.intp)
+    fraction = coordinates - lower
+    # Coordinates on the last plane get a zero-weight upper neighbour, clipped
+    # to stay inside the volume.
+    upper = np.minimum(lower + 1, upper_bounds)
+    values = np.zeros(coordinates.shape[1])
+    for corner in itertools.product((0, 1), repeat=3):
+        weight = np.ones(coordinates.shape[1])
+        indices = []
+        for axis, offset in enumerate(corner):
+            weight *= fraction[axis] if offset else 1 - fraction[axis]
+            indices.append(upper[axis] if offset else lower[axis])
+        values += weight * data[tuple(indices)]
+    return values, valid
+
+
+def resample_to_reference(
+    scan_path: str, reference_path: str, mat_file: str
+) -> tuple:
+    from volume_format import load_image
+
+    scan = load_image(scan_path)
+    reference = load_image(reference_path)
+    scan_data = np.asarray(scan.get_data(), dtype=np.float32)
+    # Reference voxel -> reference FSL mm -> scan FSL mm -> scan voxel.
+    vox2vox = (
+        np.linalg.inv(get_fsl_scaling(scan))
+        .dot(np.linalg.inv(read_flirt_matrix(mat_file)))
+        .dot(get_fsl_scaling(reference))
+    )
+    shape = reference.shape[:3]
+    resampled = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    valid = np.zeros(resampled.size, dtype=bool)
+    # Slabs of the reference grid along its last axis bound the coordinate
+    # arrays; values are laid out in the same (Fortran) order as nibabel data.
+    slice_voxels = shape[0] * shape[1]
+    slab_size = max(1, RESAMPLING_SLAB_VOXELS // slice_voxels)
+    for start in range(0, shape[2], slab_size):
+        stop = min(start + slab_size, shape[2])
+        grid = np.mgrid[0 : shape[0], 0 : shape[1], start:stop]
+        coordinates = grid.reshape(3, -1, order="F")
+        coordinates = vox2vox[:3, :3].dot(coordinates) + vox2vox[:3, 3:]
+        values, slab_valid = interpolate_trilinear(scan_data, coordinates)
+        slab = slice(start * slice_voxels, stop * slice_voxels)
+        resampled[slab][slab_valid] = values
+        valid[slab] = slab_valid
+    return resampled, valid
+
+
+def calculate_native_cost(
+    registered: str,
+    target_scan: str,
+    mat_file: str,
+    cost_function: str = DEFAULT_NATIVE_COST_FUNCTION,
+    bins: int = NATIVE_BINS,
+) -> float:
+    # Trilinear resampling and histogram metrics as FLIRT defines them; see
+    # NATIVE_COST_TOLERANCE for how this relates to FLIRT's own costs.
+    from similarity import calculate_similarity_metrics
+    from volume_format import load_data
+
+    resampled, valid = resample_to_reference(registered, target_scan, mat_file)
+    target_data = load_data(target_scan).ravel(order="F")
+    with measure("native_cost", os.path.basename(os.path.dirname(registered))):
+        metrics = calculate_similarity_metrics(
+            target_data, resampled, bins, mask=valid
+        )
+    return float(NATIVE_COST_FUNCTIONS[cost_function](metrics))
+
+
+def calculate_realignment_cost(
+    target_id: str,
+    cost_function: str,
+    serialize: bool = True,
+    cache: ResultCache = None,
+    resume: bool = True,
+    catalog=None,
+    store: bool = False,
+    scheduler=None,
+    native: bool = False,
+    native_cost_function: str = DEFAULT_NATIVE_COST_FUNCTION,
+) -> tuple:
+    # Returns the costs and, like run_bet, the subjects whose cost could not
+    # be measured with the reason why.
     realigned_subject_dirs = generate_subject_dirs(
-        "realigned", target_id, cost_function
+        "realigned", target_id, cost_function, catalog=catalog
     )
     target_scan = get_target_scan(target_id)
-    costs = {}
-    for subject_dir in realigned_subject_dirs:
-        subject_id = subject_dir.split("/")[-2]
-        registered, mat_file = get_realigned_subject_data(subject_id)
-        print(f"Calculating cost function value...", end="\t")
-        flirt = FLIRT()
-        flirt.inputs.in_file = registered
-        flirt.inputs.reference = target_scan
-        flirt.inputs.schedule = "/usr/local/fsl/etc/flirtsch/measurecost1.sch"
-        flirt.inputs.in_matrix_file = mat_file
-        tmp = os.path.join(subject_dir, "tmp")
-        flirt.inputs.out_file = os.path.join(tmp, "cost.nii.gz")
-        flirt.inputs.out_matrix_file = os.path.join(tmp, "cost.mat")
-        os.makedirs(tmp, exist_ok=True)
-        f = flirt.run()
-        result = float(f.runtime.stdout.split()[0])
-        print(f"done! [{result}]")
-        shutil.rmtree(tmp)
+    log = ResultLog(
+        get_costs_log_path(target_id, cost_function, native),
+        get_cost_params(native, native_cost_function),
+    )
+    if resume:
+        costs = log.to_dict()
+        report(f"Resuming with {len(costs)} logged costs.")
+        other = log.count_other_params()
+        if other:
+            report(f"Ignoring {other} logged costs computed with other parameters.")
+    else:
+        costs = {}
+        if serialize:
+            log.discard()
+
+    def record(subject_id: str, result: float, key: str = None):
         costs[subject_id] = result
+        if cache is not None and key is not None:
+            cache.set(key, result, target_id, "realignment_cost")
         if serialize:
-            serialize_results(target_id, cost_function, costs)
-    return costs
+            log.append(subject_id, result)
+
+    failures = dict()
+    scheduled = dict()
+    # Scheduled FLIRT jobs run after the loop, so any expanded chunked inputs
+    # are kept until the scheduler is done with them.
+    fsl_inputs = ExitStack()
+    for subject_dir in realigned_subject_dirs:
+        subject_id = subject_dir.split("/")[-2]
+        if subject_id in costs:
+            continue
+        registered, mat_file = get_realigned_subject_data(
+            target_id, cost_function, subject_id, catalog=catalog
+        )
+        report(f"Calculating cost function value...", end="\t")
+        key = None
+        if cache is not None:
+            if native:
+                key = cache.make_key(
+                    "native_realignment_cost",
+                    [target_scan, registered, mat_file],
+                    cost_function=native_cost_function,
+                    bins=NATIVE_BINS,
+                )
+            else:
+                key = cache.make_key(
+                    "realignment_cost",
+                    [target_scan, registered, mat_file],
+                    schedule=COST_SCHEDULE,
+                )
+            result = cache.get(key)
+            if result is not None:
+                report(f"cached! [{result}]")
+                costs[subject_id] = result
+                if serialize:
+                    log.append(subject_id, result)
+                continue
+        if native:
+            result = calculate_native_cost(
+                registered, target_scan, mat_file, native_cost_function
+            )
+            record(subject_id, result, key)
+            report(f"done! [{result}]")
+            continue
+        if scheduler is not None:
+            from volume_format import fsl_readable
+
+            if not scheduled:
+                fsl_target = fsl_inputs.enter_context(fsl_readable(target_scan))
+            in_file = fsl_inputs.enter_context(fsl_readable(registered))
+            flirt = create_cost_flirt(in_file, fsl_target, mat_file, subject_dir)
+            scheduled[subject_id] = (
+                Job.from_interface(subject_id, "flirt", flirt),
+                subject_dir,
+                key,
+            )
+            report("scheduled.")
+            continue
+        result = measure_cost(registered, target_scan, mat_file, subject_dir)
+        record(subject_id, result, key)
+        report(f"done! [{result}]")
+    if scheduled:
+        jobs = [job for job, _, _ in scheduled.values()]
+        with fsl_inputs:
+            job_results = scheduler.run(jobs)
+        for subject_id, job_result in job_results.items():
+            _, subject_dir, key = scheduled[subject_id]
+            shutil.rmtree(get_cost_tmp_dir(subject_dir), ignore_errors=True)
+            if job_result.status != "done":
+                failures[subject_id] = job_result.error
+                continue
+            try:
+                record(subject_id, parse_cost(job_result.stdout), key)
+            except (IndexError, ValueError) as e:
+                failures[subject_id] = f"Unreadable cost output: {e}"
+        for subject_id, error in failures.items():
+            report(f"\u2718 No cost for {subject_id}: {error}")
+    if serialize:
+        serialize_results(target_id, cost_function, costs, native)
+    if store:
+        from results_store import COST_METRIC, NATIVE_COST_METRIC, write_metric
+
+        metric = NATIVE_COST_METRIC if native else COST_METRIC
+        write_metric(costs, target_id, cost_function, metric)
+    return costs, failures
@@ -1,12 +1,38 @@
 import glob
+import itertools
 import os
-import pandas as pd
 import pickle
 import random
 import string
 
+from instrumentation import report
+
 SERIES_DICT = {"t1": ["MPRAGE", "T1W"], "t2": ["FLAIR", "t2_"], "ir": ["IR-EPI"]}
 BASE_DIR = os.getcwd()
+# Intermediate volumes (skull-stripped, realigned) are written in VOLUME_FORMAT;
+# readers accept any of VOLUME_EXTENSIONS.
+VOLUME_FORMAT_EXTENSIONS = {
+    "nii.gz": ".nii.gz",
+    "nii": ".nii",
+    "parallel_gzip": ".nii.gz",
+    "zstd": ".nii.zst",
+    "lz4": ".nii.lz4",
+}
+VOLUME_EXTENSIONS = (".nii.gz", ".nii", ".nii.zst", ".nii.lz4")
+
+
+def validate_volume_format(volume_format: str) -> str:
+    if volume_format not in VOLUME_FORMAT_EXTENSIONS:
+        raise ValueError(
+            f"Invalid volume format {volume_format}! Use one of {list(VOLUME_FORMAT_EXTENSIONS)}."
+        )
+    return volume_format
+
+
+# A bad BRAIN_PROFILE_VOLUME_FORMAT fails here rather than at the first write.
+VOLUME_FORMAT = validate_volume_format(
+    os.environ.get("BRAIN_PROFILE_VOLUME_FORMAT", "nii.gz")
+)
 LOCATION_DICT = {
     "raw": os.path.join(BASE_DIR, "Scans"),
     "skull_stripped": os.path.join(BASE_DIR, "Skull-stripped"),
@@ -17,6 +43,75 @@ REALIGNED_DIR_NAME = "Realigned"
 TARGET_FILE_NAME = "MPRAGE.nii.gz"
 COSTS_FILE_NAME = "realignment_costs.pkl"
 MUTUAL_INFORMATION_FILE_NAME = "mutual_information.pkl"
+CACHE_FILE_NAME = "results_cache.sqlite"
+COSTS_LOG_FILE_NAME = "realignment_costs.jsonl"
+NATIVE_COSTS_FILE_NAME = "realignment_costs_native.pkl"
+NATIVE_COSTS_LOG_FILE_NAME = "realignment_costs_native.jsonl"
+MUTUAL_INFORMATION_LOG_FILE_NAME = "mutual_information.jsonl"
+CATALOG_FILE_NAME = "catalog.sqlite"
+RESULTS_STORE_DIR_NAME = "Results"
+PIPELINE_STATE_FILE_NAME = "pipeline_state.sqlite"
+WORK_QUEUE_FILE_NAME = "work_queue.sqlite"
+AGGREGATE_INDEX_FILE_NAME = "aggregate_index.json"
+FINGERPRINT_INDEX_FILE_NAME = "fingerprints.npz"
+SCAN_MANIFEST_FILE_NAME = "scan_manifest.json"
+QUALITY_CONTROL_FILE_NAME = "quality_control.json"
+
+
+def set_base_dir(base_dir: str):
+    global BASE_DIR
+    BASE_DIR = base_dir
+    LOCATION_DICT.update(
+        raw=os.path.join(base_dir, "Scans"),
+        skull_stripped=os.path.join(base_dir, "Skull-stripped"),
+        bias_corrected=os.path.join(base_dir, "Bias-corrected"),
+        target=os.path.join(base_dir, "target"),
+    )
+
+
+def set_volume_format(volume_format: str):
+    global VOLUME_FORMAT
+    VOLUME_FORMAT = validate_volume_format(volume_format)
+    # Worker processes started later read the format from the environment.
+    os.environ["BRAIN_PROFILE_VOLUME_FORMAT"] = volume_format
+
+
+def get_volume_extension(volume_format: str = None):
+    return VOLUME_FORMAT_EXTENSIONS[volume_format or VOLUME_FORMAT]
+
+
+def strip_volume_extension(path: str):
+    for extension in VOLUME_EXTENSIONS:
+        if path.endswith(extension):
+            return path[: -len(extension)]
+    return path
+
+
+def get_volume_path(path: str, volume_format: str = None):
+    return strip_volume_extension(path) + get_volume_extension(volume_format)
+
+
+def find_volume(path: str):
+    # The configured format is tried first, then every other known one.
+    base = strip_volume_extension(path)
+    extensions = [get_volume_extension()]
+    extensions += [e for e in VOLUME_EXTENSIONS if e not in extensions]
+    for extension in extensions:
+        if os.path.isfile(base + extension):
+            return base + extension
+    return None
+
+
+def unique_volumes(paths: list):
+    # One path per volume when it exists in several formats, preferring the
+    # configured one.
+    extension = get_volume_extension()
+    chosen = dict()
+    for path in sorted(paths):
+        base = strip_volume_extension(path)
+        if base not in chosen or path.endswith(extension):
+            chosen[base] = path
+    return list(chosen.values())
 
 
 def id_generator(size=8, chars=string.ascii_uppercase + string.digits):
@@ -40,7 +135,7 @@ def anonymize_data():
             dest = target_dir.replace(target_id, new_id)
             os.rename(target_dir, dest)
         else:
-            print(f"WARNING! Could not determine {target_id} source subject!")
+            report(f"WARNING! Could not determine {target_id} source subject!")
     with open("associations.pkl", "wb") as key_file:
         pickle.dump(associations, key_file)
     return associations
@@ -51,11 +146,16 @@ def get_target_subject_dir(target_id: str):
     return os.path.join(target_dir, target_id)
 
 
-def get_target_scan(target_id: str):
+def get_target_scan_path(target_id: str):
     target_subject_dir = get_target_subject_dir(target_id)
-    target_scan_path = os.path.join(target_subject_dir, TARGET_FILE_NAME)
-    if os.path.isfile(target_scan_path):
-        return os.path.join(target_subject_dir, TARGET_FILE_NAME)
+    return os.path.join(target_subject_dir, TARGET_FILE_NAME)
+
+
+def get_target_scan(target_id: str):
+    target_scan_path = get_target_scan_path(target_id)
+    found_path = find_volume(target_scan_path)
+    if found_path is not None:
+        return found_path
     else:
         raise FileNotFoundError(f"Failed to locate target scan in {target_scan_path}")
 
@@ -75,9 +175,10 @@ def get_cost_function_dir(target_id: str, cost_function: str):
     return os.path.join(realigned_scans_dir, cost_function)
 
 
-def get_costs_file_path(target_id: str, cost_function: str):
+def get_costs_file_path(target_id: str, cost_function: str, native: bool = False):
     cost_function_dir = get_cost_function_dir(target_id, cost_function)
-    return os.path.join(cost_function_dir, COSTS_FILE_NAME)
+    file_name = NATIVE_COSTS_FILE_NAME if native else COSTS_FILE_NAME
+    return os.path.join(cost_function_dir, file_name)
 
 
 def get_mutual_information_file_path(target_id: str, cost_function: str):
@@ -85,17 +186,73 @@ def get_mutual_information_file_path(target_id: str, cost_function: str):
     return os.path.join(cost_function_dir, MUTUAL_INFORMATION_FILE_NAME)
 
 
+def get_costs_log_path(target_id: str, cost_function: str, native: bool = False):
+    cost_function_dir = get_cost_function_dir(target_id, cost_function)
+    file_name = NATIVE_COSTS_LOG_FILE_NAME if native else COSTS_LOG_FILE_NAME
+    return os.path.join(cost_function_dir, file_name)
+
+
+def get_mutual_information_log_path(target_id: str, cost_function: str):
+    cost_function_dir = get_cost_function_dir(target_id, cost_function)
+    return os.path.join(cost_function_dir, MUTUAL_INFORMATION_LOG_FILE_NAME)
+
+
+def get_cache_path(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, CACHE_FILE_NAME)
+
+
+def get_catalog_path(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, CATALOG_FILE_NAME)
+
+
+def get_results_store_dir(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, RESULTS_STORE_DIR_NAME)
+
+
+def get_pipeline_state_path(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, PIPELINE_STATE_FILE_NAME)
+
+
+def get_work_queue_path(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, WORK_QUEUE_FILE_NAME)
+
+
+def get_fingerprint_index_path(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, FINGERPRINT_INDEX_FILE_NAME)
+
+
+def get_scan_manifest_path(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, SCAN_MANIFEST_FILE_NAME)
+
+
+def get_quality_control_path(base_dir: str = None):
+    return os.path.join(base_dir or BASE_DIR, QUALITY_CONTROL_FILE_NAME)
+
+
 def get_realigned_subject_dir(target_id: str, cost_function: str, subject_id: str):
     cost_function_dir = get_cost_function_dir(target_id, cost_function)
     return os.path.join(cost_function_dir, subject_id)
 
 
 def get_realigned_subject_data(
-    target_id: str, cost_function: str, subject_id: str, include_mat: bool = True
+    target_id: str,
+    cost_function: str,
+    subject_id: str,
+    include_mat: bool = True,
+    catalog=None,
 ):
     realigned_data_dir = get_realigned_subject_dir(target_id, cost_function, subject_id)
-    files = glob.glob(os.path.join(realigned_data_dir, "*"))
-    realigned_scan = [f for f in files if f.endswith(".nii.gz")]
+    if catalog is None:
+        files = glob.glob(os.path.join(realigned_data_dir, "*"))
+    else:
+        files = catalog.list_files(realigned_data_dir)
+    # A subject realigned again after the format changed has the volume in
+    # both formats; the configured one is the current result.
+    extension = get_volume_extension()
+    realigned_scan = sorted(
+        (f for f in files if f.endswith(VOLUME_EXTENSIONS)),
+        key=lambda f: not f.endswith(extension),
+    )
     if realigned_scan:
         if include_mat:
             mat_file = [f for f in files if f.endswith(".mat")]
@@ -109,25 +266,33 @@ def get_realigned_subject_data(
 
 
 def generate_subject_dirs(
-    status: str, target_id: str = None, cost_function: str = None
+    status: str, target_id: str = None, cost_function: str = None, catalog=None
 ):
     if status in ["raw", "skull_stripped"]:
-        pattern = os.path.join(LOCATION_DICT[status], "*/")
-        return glob.iglob(pattern)
+        base_dir = LOCATION_DICT[status]
     elif status in ["realigned"]:
-        realigned_scans_dir = get_cost_function_dir(target_id, cost_function)
-        pattern = os.path.join(realigned_scans_dir, "*/")
-        return glob.iglob(pattern)
+        base_dir = get_cost_function_dir(target_id, cost_function)
+    else:
+        return None
+    if catalog is not None:
+        return iter(catalog.list_subject_dirs(base_dir))
+    pattern = os.path.join(base_dir, "*/")
+    return glob.iglob(pattern)
 
 
-def generate_scans(status: str, target_id: str = None, cost_function: str = None):
+def generate_scans(
+    status: str, target_id: str = None, cost_function: str = None, catalog=None
+):
     if status in ["raw", "skull_stripped"]:
-        pattern = os.path.join(LOCATION_DICT[status], "**/*.nii.gz")
-        return glob.iglob(pattern)
+        base_dir = LOCATION_DICT[status]
     elif status in ["realigned"]:
-        realigned_scans_dir = get_cost_function_dir(target_id, cost_function)
-        pattern = os.path.join(realigned_scans_dir, "**/*.nii.gz")
-        return glob.iglob(pattern)
+        base_dir = get_cost_function_dir(target_id, cost_function)
+    else:
+        return None
+    if catalog is not None:
+        return iter(catalog.list_scans(base_dir))
+    patterns = [os.path.join(base_dir, f"**/*{e}") for e in VOLUME_EXTENSIONS]
+    return itertools.chain.from_iterable(glob.iglob(p) for p in patterns)
 
 
 def filter_scans_by_type(scans: list, scan_type: str):
@@ -142,14 +307,16 @@ def filter_scans_by_type(scans: list, scan_type: str):
 
 
 def choose_single_anatomical(scans: list):
+    # Names are matched without their extension, so the choice is the same
+    # whichever format a stage was written in.
+    names = [strip_volume_extension(scan) for scan in scans]
     choice = [
         scan
-        for scan in scans
-        if scan.endswith("EnhancedContrast.nii.gz")
-        or scan.endswith("EnchancedContrast.nii.gz")
+        for scan, name in zip(scans, names)
+        if name.endswith("EnhancedContrast") or name.endswith("EnchancedContrast")
     ]
     if not choice:
-        choice = [scan for scan in scans if scan.endswith("1mm.nii.gz")]
+        choice = [scan for scan, name in zip(scans, names) if name.endswith("1mm")]
         if not choice:
             return scans[0]
         else:
@@ -165,30 +332,40 @@ def choose_single_scan(scans: list, scan_type: str):
         return scans[0]
 
 
-def get_scans(base_dir: str, scan_type: str = None, single: bool = True) -> list:
-    print(f"Looking for {scan_type} scans in {base_dir}...")
+def get_scans(
+    base_dir: str, scan_type: str = None, single: bool = True, catalog=None
+) -> list:
+    report(f"Looking for {scan_type} scans in {base_dir}...")
     result = []
-    subject_dirs = glob.glob(os.path.join(base_dir, "*/"))
+    if catalog is None:
+        subject_dirs = glob.glob(os.path.join(base_dir, "*/"))
+    else:
+        subject_dirs = catalog.list_subject_dirs(base_dir)
     for subject_dir in subject_dirs:
         subject_id = subject_dir.split("/")[-2]
-        print(f"Checking {subject_id}...")
-        scans = glob.glob(os.path.join(subject_dir, "*.nii.gz"))
+        report(f"Checking {subject_id}...")
+        if catalog is None:
+            scans = glob.glob(os.path.join(subject_dir, "*.nii*"))
+            scans = [scan for scan in scans if scan.endswith(VOLUME_EXTENSIONS)]
+        else:
+            scans = catalog.list_files(subject_dir, VOLUME_EXTENSIONS)
+        scans = unique_volumes(scans)
         if scan_type is not None:
             scans = filter_scans_by_type(scans, scan_type)
         if scans:
-            print(f"Found {len(scans)} {scan_type} scans for {subject_id}.")
+            report(f"Found {len(scans)} {scan_type} scans for {subject_id}.")
             if single:
                 choice = choose_single_scan(scans, scan_type)
                 result += [choice]
-                print(
+                report(
                     f"{os.path.basename(choice)} added to {scan_type or 'scan'} list."
                 )
             else:
                 result += scans
-                print(f"{len(scans)} scans added to list.")
+                report(f"{len(scans)} scans added to list.")
         else:
-            print(f"Could not find {scan_type} scan for subject {subject_id}!")
-    print(f"Found {len(result)} {scan_type} scans from {len(subject_dirs)} subjects.")
+            report(f"Could not find {scan_type} scan for subject {subject_id}!")
+    report(f"Found {len(result)} {scan_type} scans from {len(subject_dirs)} subjects.")
     return result
 
 
@@ -212,4 +389,6 @@ def get_all_results(target_id: str):
         get_results(target_id, cost_function)
         for cost_function in COST_FUNCTION_DICT.values()
     ]
+    import pandas as pd
+
     return pd.concat(results, axis=1)
@@ -0,0 +1,272 @@
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cache import fingerprint_file
+from dao import (
+    LOCATION_DICT,
+    get_fingerprint_index_path,
+    get_scans,
+    get_target_scan,
+)
+from instrumentation import measure, report
+from volume_format import load_image
+
+GRID_SIZE = 16
+HISTOGRAM_BINS = 32
+# Normalized intensities are clipped to this many standard deviations before
+# the histogram descriptor is taken.
+HISTOGRAM_RANGE = 3.0
+# Relative weight of the histogram block against the intensity grid, applied
+# after each block is normalized on its own.
+HISTOGRAM_WEIGHT = 0.5
+DEFAULT_TOP_K = 10
+# Bumped whenever fingerprints change meaning, so indexes built by an older
+# version are recomputed rather than compared against new fingerprints.
+FINGERPRINT_VERSION = 2
+
+
+def get_bounding_box(mask: np.ndarray) -> tuple:
+    slices = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        present = np.flatnonzero(mask.any(axis=other_axes))
+        if not present.size:
+            return tuple(slice(None) for _ in range(mask.ndim))
+        slices.append(slice(present[0], present[-1] + 1))
+    return tuple(slices)
+
+
+def average_to_grid(volume: np.ndarray, size: int = GRID_SIZE) -> np.ndarray:
+    # Area averaging onto a fixed grid, one axis at a time.
+    for axis in range(volume.ndim):
+        length = volume.shape[axis]
+        edges = np.linspace(0, length, size + 1).astype(int)
+        starts = np.minimum(edges[:-1], length - 1)
+        counts = np.maximum(edges[1:] - starts, 1)
+        sums = np.add.reduceat(volume, starts, axis=axis)
+        shape = [1] * volume.ndim
+        shape[axis] = size
+        volume = sums / counts.reshape(shape)
+    return volume
+
+
+def normalize(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def calculate_fingerprint(
+    data: np.ndarray, grid_size: int = GRID_SIZE, bins: int = HISTOGRAM_BINS
+) -> np.ndarray:
+    # Skull-stripped volumes are zero outside the brain; cropping to the brain
+    # and resampling to a fixed grid removes most of the position and field of
+    # view differences between acquisitions.
+    data = np.asarray(data, dtype=np.float32)
+    mask = data != 0
+    box = get_bounding_box(mask)
+    data, mask = data[box], mask[box]
+    brain = data[mask] if mask.any() else data.ravel()
+    mean, std = brain.mean(), brain.std() or 1.0
+    normalized = np.where(mask, (data - mean) / std, 0)
+    grid = average_to_grid(normalized, grid_size).ravel()
+    histogram, _ = np.histogram(
+        np.clip((brain - mean) / std, -HISTOGRAM_RANGE, HISTOGRAM_RANGE),
+        bins=bins,
+        range=(-HISTOGRAM_RANGE, HISTOGRAM_RANGE),
+    )
+    histogram = np.sqrt(histogram / max(1, histogram.sum()))
+    grid, histogram = normalize(grid), normalize(histogram) * HISTOGRAM_WEIGHT
+    return normalize(np.concatenate([grid, histogram])).astype(np.float32)
+
+
+def load_canonical_data(scan_path: str) -> np.ndarray:
+    # Reoriented to RAS+ so the grid cells line up between scans stored with
+    # different voxel axis orders or flips.
+    import nibabel as nib
+
+    image = nib.as_closest_canonical(load_image(scan_path))
+    return np.asanyarray(image.dataobj)
+
+
+def calculate_scan_fingerprint(
+    scan_path: str, grid_size: int = GRID_SIZE, bins: int = HISTOGRAM_BINS
+) -> np.ndarray:
+    data = load_canonical_data(scan_path)
+    with measure("fingerprint", path=scan_path):
+        return calculate_fingerprint(data, grid_size, bins)
+
+
+class FingerprintIndex:
+    def __init__(self, path: str = None):
+        self.path = path or get_fingerprint_index_path()
+        self.subject_ids = []
+        self.paths = []
+        self.stamps = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        if os.path.isfile(self.path):
+            self.load()
+
+    def load(self):
+        with np.load(self.path) as index:
+            if "version" not in index or int(index["version"]) != FINGERPRINT_VERSION:
+                report(f"{self.path} is out of date; all scans will be fingerprinted.")
+                return
+            self.subject_ids = list(index["subject_ids"])
+            self.paths = list(index["paths"])
+            self.stamps = list(index["stamps"])
+            self.matrix = index["matrix"]
+
+    def save(self):
+        # np.savez appends .npz to names without it, so the temporary name
+        # keeps the extension.
+        tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            subject_ids=np.array(self.subject_ids, dtype=str),
+            paths=np.array(self.paths, dtype=str),
+            stamps=np.array(self.stamps, dtype=str),
+            matrix=self.matrix,
+            version=FINGERPRINT_VERSION,
+        )
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.subject_ids)
+
+    def update(self, scans: list = None, workers: int = 1, catalog=None) -> int:
+        # Only scans that are new or changed since the last update are read.
+        if scans is None:
+            scans = get_scans(LOCATION_DICT["skull_stripped"], "t1", catalog=catalog)
+        known = {
+            path: (stamp, row)
+            for row, (path, stamp) in enumerate(zip(self.paths, self.stamps))
+        }
+        stamps = [fingerprint_file(scan) for scan in scans]
+        missing = [
+            scan
+            for scan, stamp in zip(scans, stamps)
+            if known.get(scan, (None,))[0] != stamp
+        ]
+        report(f"Fingerprinting {len(missing)} of {len(scans)} scans...")
+        if workers == 1:
+            computed = [calculate_scan_fingerprint(scan) for scan in missing]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                computed = list(executor.map(calculate_scan_fingerprint, missing))
+        computed = dict(zip(missing, computed))
+        rows = [
+            computed[scan] if scan in computed else self.matrix[known[scan][1]]
+            for scan in scans
+        ]
+        self.subject_ids = [scan.split("/")[-2] for scan in scans]
+        self.paths = list(scans)
+        self.stamps = stamps
+        self.matrix = np.vstack(rows) if rows else np.zeros((0, 0), np.float32)
+        self.save()
+        return len(missing)
+
+    def query_many(self, fingerprints: np.ndarray, k: int = DEFAULT_TOP_K) -> list:
+        # One matrix product scores every candidate against every query; the
+        # vectors are unit length, so scores are cosine similarities.
+        fingerprints = np.atleast_2d(fingerprints)
+        with measure("fingerprint_query", queries=len(fingerprints)):
+            scores = fingerprints.dot(self.matrix.T)
+            k = min(k, scores.shape[1])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+        return [
+            [(self.subject_ids[column], float(scores[row, column])) for column in columns]
+            for row, columns in enumerate(top)
+        ]
+
+    def query(self, fingerprint: np.ndarray, k: int = DEFAULT_TOP_K) -> list:
+        return self.query_many(fingerprint, k)[0]
+
+
+def find_candidates(
+    target_ids: list, k: int = DEFAULT_TOP_K, index: FingerprintIndex = None
+) -> dict:
+    index = index or FingerprintIndex()
+    if not len(index):
+        raise FileNotFoundError(f"Fingerprint index {index.path} is empty!")
+    fingerprints = np.vstack(
+        [calculate_scan_fingerprint(get_target_scan(target_id)) for target_id in target_ids]
+    )
+    return dict(zip(target_ids, index.query_many(fingerprints, k)))
+
+
+def run_shortlist(
+    target_id: str,
+    cost_function: str,
+    k: int = DEFAULT_TOP_K,
+    index: FingerprintIndex = None,
+    workers: int = 1,
+    catalog=None,
+):
+    # Only the shortlisted subjects are realigned and scored exactly.
+    from mutual_information import calculate_mutual_information_scores
+    from realign import run_realign
+
+    candidates = find_candidates([target_id], k, index)[target_id]
+    subject_ids = [subject_id for subject_id, _ in candidates]
+    report(f"Shortlisted {len(subject_ids)} subjects for {target_id}.")
+    run_realign(
+        target_id, cost_function, workers, catalog=catalog, subject_ids=subject_ids
+    )
+    scores = calculate_mutual_information_scores(
+        target_id, cost_function, as_series=False, catalog=catalog
+    )
+    return {subject_id: scores.get(subject_id) for subject_id in subject_ids}
+
+
+def calculate_recall_at_k(
+    target_ids: list,
+    cost_function: str,
+    ks: tuple = (1, 5, 10),
+    index: FingerprintIndex = None,
+    bins: int = 10,
+) -> dict:
+    # The exhaustive ranking is whatever full MI scoring has logged for each
+    # target. A target counts as recalled at k when its best exhaustive match
+    # is among the fingerprint's top k; set recall is the share of the
+    # exhaustive top k that the fingerprint top k also contains.
+    from mutual_information import load_mutual_information_scores
+
+    index = index or FingerprintIndex()
+    exhaustive = {
+        target_id: load_mutual_information_scores(
+            target_id, cost_function, as_series=False, bins=bins
+        )
+        for target_id in target_ids
+    }
+    exhaustive = {
+        target_id: scores for target_id, scores in exhaustive.items() if scores
+    }
+    if not exhaustive:
+        report(f"No exhaustive {cost_function} scores logged for {target_ids}!")
+        return dict()
+    candidates = find_candidates(list(exhaustive), len(index), index)
+    recall = dict()
+    for k in ks:
+        matches, overlaps = [], []
+        for target_id, scores in exhaustive.items():
+            ranked = [
+                subject_id
+                for subject_id, _ in candidates[target_id]
+                if subject_id in scores
+            ]
+            expected = sorted(scores, key=scores.get, reverse=True)[:k]
+            matches.append(expected[0] in ranked[:k])
+            overlaps.append(len(set(expected) & set(ranked[:k])) / len(expected))
+        recall[k] = {
+            "match_recall": float(np.mean(matches)) if matches else None,
+            "set_recall": float(np.mean(overlaps)) if overlaps else None,
+            "n_targets": len(matches),
+        }
+        report(f"Recall@{k}: {recall[k]}")
+    return recall
@@ -0,0 +1,186 @@
+import json
+import os
+import resource
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+PROC_IO_PATH = "/proc/self/io"
+PROC_STATUS_PATH = "/proc/self/status"
+PROC_CLEAR_REFS_PATH = "/proc/self/clear_refs"
+METRIC_PREFIX = "brain_profile"
+
+QUIET = False
+SINKS = []
+# Peaks of the stages being measured in each thread, innermost last.
+STAGES = threading.local()
+# Resetting VmHWM also resets ru_maxrss, so the process peak seen before each
+# reset is kept here.
+PEAK_BEFORE_RESET_KB = 0
+
+
+def set_quiet(quiet: bool = True):
+    global QUIET
+    QUIET = quiet
+
+
+def report(*args, **kwargs):
+    if not QUIET:
+        print(*args, **kwargs)
+
+
+def read_bytes_read() -> int:
+    # Bytes read by the process through read(2) and friends, including page
+    # cache hits; None where /proc is unavailable.
+    try:
+        with open(PROC_IO_PATH) as io_file:
+            for line in io_file:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def get_peak_rss_kb() -> int:
+    # The process's high-water mark since it started, not a stage's.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max(peak, PEAK_BEFORE_RESET_KB)
+
+
+def get_children_usage() -> tuple:
+    # CPU seconds of, and the largest peak RSS among, child processes that
+    # have been waited for (FSL and dcm2niix run as children).
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def reset_peak_rss() -> bool:
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux 4.0+).
+    global PEAK_BEFORE_RESET_KB
+    PEAK_BEFORE_RESET_KB = get_peak_rss_kb()
+    try:
+        with open(PROC_CLEAR_REFS_PATH, "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_high_water_mark_kb() -> int:
+    try:
+        with open(PROC_STATUS_PATH) as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+class JsonlSink:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    def emit(self, record: dict):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PrometheusTextfileSink:
+    # Aggregates records per stage, for node_exporter's textfile collector.
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.totals = defaultdict(lambda: defaultdict(float))
+        self.peak_rss_kb = 0
+
+    def emit(self, record: dict):
+        with self.lock:
+            totals = self.totals[record["stage"]]
+            totals["count"] += 1
+            totals["wall_seconds"] += record["wall_time"]
+            totals["cpu_seconds"] += record["cpu_time"]
+            totals["child_cpu_seconds"] += record["child_cpu_time"]
+            totals["read_bytes"] += record["bytes_read"] or 0
+            self.peak_rss_kb = max(
+                self.peak_rss_kb, record["peak_rss_kb"] or record["process_peak_rss_kb"]
+            )
+
+    def flush(self):
+        with self.lock:
+            lines = [f"{METRIC_PREFIX}_peak_rss_bytes {self.peak_rss_kb * 1024}"]
+            for stage, totals in sorted(self.totals.items()):
+                for name, value in sorted(totals.items()):
+                    lines.append(f'{METRIC_PREFIX}_{name}_total{{stage="{stage}"}} {value}')
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self.flush()
+
+
+def add_sink(sink):
+    SINKS.append(sink)
+    return sink
+
+
+def close_sinks():
+    while SINKS:
+        SINKS.pop().close()
+
+
+@contextmanager
+def measure(stage: str, subject_id: str = None, **labels):
+    if not SINKS:
+        yield
+        return
+    # The stage's own peak is VmHWM after a reset at its start. The reset is
+    # process-wide, so an enclosing stage keeps the larger of its own reading
+    # and its inner stages' peaks; stages running at once in several threads
+    # still share one reading.
+    stack = STAGES.__dict__.setdefault("peaks", [])
+    tracked = reset_peak_rss()
+    stack.append(0)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    start_child_cpu, start_child_rss = get_children_usage()
+    start_bytes = read_bytes_read()
+    try:
+        yield
+    finally:
+        end_bytes = read_bytes_read()
+        end_child_cpu, end_child_rss = get_children_usage()
+        inner_peak = stack.pop()
+        peak = read_high_water_mark_kb() if tracked else None
+        if peak is not None:
+            peak = max(peak, inner_peak)
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+        record = {
+            "stage": stage,
+            "subject_id": subject_id,
+            "timestamp": time.time(),
+            "wall_time": time.perf_counter() - start_wall,
+            "cpu_time": time.process_time() - start_cpu,
+            "bytes_read": None if start_bytes is None else end_bytes - start_bytes,
+            "peak_rss_kb": peak,
+            "process_peak_rss_kb": get_peak_rss_kb(),
+            "child_cpu_time": end_child_cpu - start_child_cpu,
+            # Only a rise is attributable to this stage's children; otherwise
+            # none of them outgrew an earlier child.
+            "child_peak_rss_kb": end_child_rss if end_child_rss > start_child_rss else None,
+        }
+        record.update(labels)
+        for sink in SINKS:
+            sink.emit(record)
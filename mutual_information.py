@@ -1,37 +1,261 @@
-import nibabel as nib
 import numpy as np
 import pandas as pd
 import pickle
-import sklearn.metrics
 
+from collections import OrderedDict
+from cache import ResultCache
 from dao import (
     COST_FUNCTION_DICT,
     get_target_scan,
     generate_subject_dirs,
     get_realigned_subject_data,
     get_mutual_information_file_path,
+    get_mutual_information_log_path,
     get_all_results,
 )
+from instrumentation import measure, report
+from result_log import ResultLog
+from results_store import MUTUAL_INFORMATION_METRIC, write_metric
+
+DEFAULT_MEMORY_BUDGET = 256 * 2 ** 20
+# Bytes held per voxel of a slab while binning it: the scaled float64 data,
+# its bin indices and the flattened joint indices.
+SLAB_BYTES_PER_VOXEL = 24
+DEFAULT_VOLUME_CACHE_BYTES = 2 * 2 ** 30
 
 
 def extract_series_data(series_path: str):
-    return nib.load(series_path).get_data().flatten()
+    with measure("nifti_load", path=series_path):
+        from volume_format import load_image
+
+        return load_image(series_path).get_data().flatten()
 
 
 def calculate_mutual_information(
     array1: np.ndarray, array2: np.ndarray, bins: int = 10
 ) -> np.float64:
+    import sklearn.metrics
+
     histogram = np.histogram2d(array1, array2, bins)[0]
     mi = sklearn.metrics.mutual_info_score(None, None, contingency=histogram)
     return mi
 
 
 def calculate_scans_mutual_information_score(
-    scan1_path: str, scan2_path: str
+    scan1_path: str, scan2_path: str, bins: int = 10
 ) -> np.float64:
     scan1_data = extract_series_data(scan1_path)
     scan2_data = extract_series_data(scan2_path)
-    return calculate_mutual_information(scan1_data, scan2_data)
+    return calculate_mutual_information(scan1_data, scan2_data, bins)
+
+
+def calculate_bin_edges(array: np.ndarray, bins: int = 10) -> np.ndarray:
+    return calculate_range_bin_edges(array.min(), array.max(), bins)
+
+
+def calculate_range_bin_edges(
+    first_edge: float, last_edge: float, bins: int = 10
+) -> np.ndarray:
+    # Same edges np.histogram2d derives for an integer bin count.
+    first_edge, last_edge = float(first_edge), float(last_edge)
+    if first_edge == last_edge:
+        first_edge -= 0.5
+        last_edge += 0.5
+    return np.linspace(first_edge, last_edge, bins + 1)
+
+
+def calculate_bin_indices(
+    array: np.ndarray, bins: int = 10, edges: np.ndarray = None
+) -> np.ndarray:
+    if edges is None:
+        edges = calculate_bin_edges(array, bins)
+    indices = np.searchsorted(edges, array, side="right")
+    # np.histogram2d closes the right-most bin and drops values outside the
+    # edges, which can only happen when the edges are given explicitly.
+    indices[array == edges[-1]] -= 1
+    indices -= 1
+    indices[(indices < 0) | (indices >= bins)] = -1
+    return indices.astype(np.min_scalar_type(-bins), copy=False)
+
+
+def calculate_joint_histogram(
+    indices1: np.ndarray, indices2: np.ndarray, bins: int = 10
+) -> np.ndarray:
+    if indices1.shape != indices2.shape:
+        raise ValueError(
+            f"Cannot compare arrays of different shapes ({indices1.shape} and {indices2.shape})!"
+        )
+    valid = (indices1 >= 0) & (indices2 >= 0)
+    if not valid.all():
+        indices1, indices2 = indices1[valid], indices2[valid]
+    flat_indices = indices1.astype(np.intp, copy=False) * bins + indices2
+    return np.bincount(flat_indices, minlength=bins * bins).reshape(bins, bins)
+
+
+def calculate_histogram_mutual_information(histogram: np.ndarray) -> np.float64:
+    import sklearn.metrics
+
+    return sklearn.metrics.mutual_info_score(None, None, contingency=histogram)
+
+
+def iterate_batch_mutual_information(target_scan: str, scans: dict, bins: int = 10):
+    target_indices = calculate_bin_indices(extract_series_data(target_scan), bins)
+    target_indices = target_indices.astype(np.intp)
+    for subject_id, scan_path in scans.items():
+        scan_data = extract_series_data(scan_path)
+        with measure("histogram", subject_id):
+            scan_indices = calculate_bin_indices(scan_data, bins)
+            histogram = calculate_joint_histogram(target_indices, scan_indices, bins)
+            score = calculate_histogram_mutual_information(histogram)
+        yield subject_id, score
+
+
+class BinnedVolumeCache:
+    # Least-recently-used cache of binned volumes, bounded by their total size.
+    def __init__(self, max_bytes: int = DEFAULT_VOLUME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.volumes = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def get(self, series_path: str, bins: int = 10) -> np.ndarray:
+        key = (series_path, bins)
+        if key in self.volumes:
+            self.hits += 1
+            self.volumes.move_to_end(key)
+            return self.volumes[key]
+        self.misses += 1
+        indices = calculate_bin_indices(extract_series_data(series_path), bins)
+        self.volumes[key] = indices
+        self.size += indices.nbytes
+        while self.size > self.max_bytes and len(self.volumes) > 1:
+            _, evicted = self.volumes.popitem(last=False)
+            self.size -= evicted.nbytes
+        return indices
+
+
+def calculate_batch_mutual_information(
+    target_scan: str, scans: dict, bins: int = 10
+) -> dict:
+    return dict(iterate_batch_mutual_information(target_scan, scans, bins))
+
+
+def get_slab_size(shape: tuple, memory_budget: int = DEFAULT_MEMORY_BUDGET) -> int:
+    slice_voxels = int(np.prod(shape[:-1]))
+    return max(1, memory_budget // (slice_voxels * SLAB_BYTES_PER_VOXEL))
+
+
+def iterate_series_slabs(series_path: str, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+    # Slabs are taken along the last axis, which is contiguous on disk, through
+    # the image's array proxy so the full volume is never held in memory. The
+    # file stays open between slabs, so a gzipped volume is decompressed in one
+    # sequential pass instead of from its start for every slab.
+    from volume_format import load_proxy
+
+    proxy = load_proxy(series_path, keep_file_open=True)
+    slab_size = get_slab_size(proxy.shape, memory_budget)
+    for start in range(0, proxy.shape[-1], slab_size):
+        yield np.asarray(proxy[..., start : start + slab_size]).ravel()
+
+
+def get_series_shape(series_path: str) -> tuple:
+    from volume_format import load_proxy
+
+    return tuple(load_proxy(series_path).shape)
+
+
+def calculate_series_range(
+    series_path: str, memory_budget: int = DEFAULT_MEMORY_BUDGET
+) -> tuple:
+    minimum, maximum = np.inf, -np.inf
+    for slab in iterate_series_slabs(series_path, memory_budget):
+        minimum = min(minimum, slab.min())
+        maximum = max(maximum, slab.max())
+    return minimum, maximum
+
+
+def calculate_streaming_joint_histogram(
+    scan1_path: str,
+    scan2_path: str,
+    bins: int = 10,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    scan1_edges: np.ndarray = None,
+) -> np.ndarray:
+    # Both volumes are read slab by slab at the same time, so each gets half of
+    # the budget. The bin edges depend on each volume's range, which takes a
+    # pass of its own unless the volume fits in a single slab, so larger
+    # volumes are read twice (the target's range is computed once per batch by
+    # iterate_streaming_mutual_information); that is the price of exact parity
+    # with the batch path without holding either volume.
+    shape1, shape2 = get_series_shape(scan1_path), get_series_shape(scan2_path)
+    if shape1 != shape2:
+        # Slabs are paired up with zip, which would silently stop at the
+        # shorter volume.
+        raise ValueError(
+            f"Cannot compare volumes of different shapes ({shape1} and {shape2})!"
+        )
+    memory_budget //= 2
+    if get_slab_size(shape1, memory_budget) >= shape1[-1]:
+        # Each volume is read once, and its range taken from the data in hand.
+        (data1,) = iterate_series_slabs(scan1_path, memory_budget)
+        (data2,) = iterate_series_slabs(scan2_path, memory_budget)
+        return calculate_joint_histogram(
+            calculate_bin_indices(data1, bins, scan1_edges),
+            calculate_bin_indices(data2, bins),
+            bins,
+        )
+    if scan1_edges is None:
+        scan1_edges = calculate_range_bin_edges(
+            *calculate_series_range(scan1_path, memory_budget), bins
+        )
+    scan2_edges = calculate_range_bin_edges(
+        *calculate_series_range(scan2_path, memory_budget), bins
+    )
+    histogram = np.zeros((bins, bins), dtype=np.int64)
+    slabs = zip(
+        iterate_series_slabs(scan1_path, memory_budget),
+        iterate_series_slabs(scan2_path, memory_budget),
+    )
+    for slab1, slab2 in slabs:
+        histogram += calculate_joint_histogram(
+            calculate_bin_indices(slab1, bins, scan1_edges),
+            calculate_bin_indices(slab2, bins, scan2_edges),
+            bins,
+        )
+    return histogram
+
+
+def calculate_streaming_mutual_information(
+    scan1_path: str,
+    scan2_path: str,
+    bins: int = 10,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+) -> np.float64:
+    histogram = calculate_streaming_joint_histogram(
+        scan1_path, scan2_path, bins, memory_budget
+    )
+    return calculate_histogram_mutual_information(histogram)
+
+
+def iterate_streaming_mutual_information(
+    target_scan: str,
+    scans: dict,
+    bins: int = 10,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+):
+    # A target that fits in one slab is binned from the data read with each
+    # scan instead.
+    target_edges = None
+    shape = get_series_shape(target_scan)
+    if get_slab_size(shape, memory_budget // 2) < shape[-1]:
+        target_edges = calculate_range_bin_edges(
+            *calculate_series_range(target_scan, memory_budget // 2), bins
+        )
+    for subject_id, scan_path in scans.items():
+        histogram = calculate_streaming_joint_histogram(
+            target_scan, scan_path, bins, memory_budget, scan1_edges=target_edges
+        )
+        yield subject_id, calculate_histogram_mutual_information(histogram)
 
 
 def mutual_information_dict_to_series(
@@ -43,49 +267,236 @@ def mutual_information_dict_to_series(
     return result
 
 
+def get_mutual_information_params(bins: int = 10, prebinned: bool = False) -> dict:
+    # Batch and streaming scoring give the same values; prebinned scans are
+    # quantized first, so their scores are logged apart.
+    return {"bins": bins, "engine": "prebinned" if prebinned else "exact"}
+
+
 def calculate_mutual_information_scores(
-    target_id: str, cost_function: str, as_series: bool = True, serialize: bool = True
+    target_id: str,
+    cost_function: str,
+    as_series: bool = True,
+    serialize: bool = True,
+    bins: int = 10,
+    cache: ResultCache = None,
+    resume: bool = True,
+    catalog=None,
+    memory_budget: int = None,
+    store: bool = False,
+    prebinned: bool = False,
+    queue=None,
 ) -> pd.Series:
     target_scan = get_target_scan(target_id)
     realigned_subject_dirs = generate_subject_dirs(
-        "realigned", target_id, cost_function
-    )
-    mutual_information = dict()
-    print(
-        f"\n\u0FD4 Calculating mutual information scores for target {target_id} after {cost_function} realignment \u0FD4\n"
+        "realigned", target_id, cost_function, catalog=catalog
     )
+    realigned_scans = dict()
     for subject_dir in realigned_subject_dirs:
         subject_id = subject_dir.split("/")[-2]
-        print(f"Calculating mutual information for {subject_id}...", end="\t")
-        realigned_scan_path = get_realigned_subject_data(
-            target_id, cost_function, subject_id, include_mat=False
+        realigned_scans[subject_id] = get_realigned_subject_data(
+            target_id, cost_function, subject_id, include_mat=False, catalog=catalog
         )
-        mutual_information_score = calculate_scans_mutual_information_score(
-            target_scan, realigned_scan_path
+    mutual_information = dict()
+    report(
+        f"\n\u0FD4 Calculating mutual information scores for target {target_id} after {cost_function} realignment \u0FD4\n"
+    )
+    log = ResultLog(
+        get_mutual_information_log_path(target_id, cost_function),
+        get_mutual_information_params(bins, prebinned),
+    )
+    if resume:
+        mutual_information.update(
+            (subject_id, score)
+            for subject_id, score in log.iterate()
+            if subject_id in realigned_scans
         )
-        mutual_information[subject_id] = mutual_information_score
-        print(f"\u2714\t[{mutual_information_score}]")
+        report(f"Resuming with {len(mutual_information)} logged scores.")
+        other = log.count_other_params()
+        if other:
+            report(f"Ignoring {other} logged scores computed with other parameters.")
+    elif serialize:
+        log.discard()
+    cache_keys = dict()
+    if cache is not None:
+        for subject_id, realigned_scan_path in realigned_scans.items():
+            if subject_id in mutual_information:
+                continue
+            key = cache.make_key(
+                "mutual_information", [target_scan, realigned_scan_path], bins=bins
+            )
+            cached_score = cache.get(key)
+            if cached_score is None:
+                cache_keys[subject_id] = key
+            else:
+                mutual_information[subject_id] = cached_score
+                if serialize:
+                    log.append(subject_id, cached_score)
+        report(f"Found {len(mutual_information)} existing scores.")
+    missing_scans = {
+        subject_id: realigned_scan_path
+        for subject_id, realigned_scan_path in realigned_scans.items()
+        if subject_id not in mutual_information
+    }
+    if missing_scans and queue is not None:
+        # Workers append their scores to the same log, so a later resumed run
+        # picks them up.
+        from work_queue import get_mutual_information_key
+
+        for subject_id, realigned_scan_path in missing_scans.items():
+            payload = {
+                "target_scan": target_scan,
+                "scan": realigned_scan_path,
+                "target_id": target_id,
+                "cost_function": cost_function,
+                "subject_id": subject_id,
+                "bins": bins,
+            }
+            key = get_mutual_information_key(target_id, cost_function, subject_id)
+            queue.publish(key, "mutual_information", payload)
+        report(f"Queued {len(missing_scans)} mutual information scores.")
+    elif missing_scans:
+        if prebinned:
+            from quantization import iterate_binned_mutual_information
+
+            scores = iterate_binned_mutual_information(
+                target_scan, missing_scans, bins
+            )
+        elif memory_budget is None:
+            scores = iterate_batch_mutual_information(
+                target_scan, missing_scans, bins
+            )
+        else:
+            scores = iterate_streaming_mutual_information(
+                target_scan, missing_scans, bins, memory_budget
+            )
+        for subject_id, mutual_information_score in scores:
+            mutual_information[subject_id] = mutual_information_score
+            if serialize:
+                log.append(subject_id, float(mutual_information_score))
+            if cache is not None:
+                cache.set(
+                    cache_keys[subject_id],
+                    float(mutual_information_score),
+                    target_id,
+                    "mutual_information",
+                )
+            report(
+                f"Calculating mutual information for {subject_id}...\t\u2714\t[{mutual_information_score}]"
+            )
 
+    if store:
+        write_metric(
+            mutual_information, target_id, cost_function, MUTUAL_INFORMATION_METRIC
+        )
     if as_series:
-        print("Converting to pandas series object...", end="\t")
+        report("Converting to pandas series object...", end="\t")
         series = mutual_information_dict_to_series(mutual_information, cost_function)
-        print("\u2714")
+        report("\u2714")
         if serialize:
             file_path = get_mutual_information_file_path(target_id, cost_function)
-            print(f"Saving to {file_path}...", end="\t")
-            series.to_pickle(file_path)
-            print("\u2714")
+            report(f"Saving to {file_path}...", end="\t")
+            with measure("serialization", path=file_path):
+                series.to_pickle(file_path)
+            report("\u2714")
         return series
     else:
         if serialize:
             file_path = get_mutual_information_file_path(target_id, cost_function)
-            print(f"Saving to {file_path}...", end="\t")
-            with open(file_path, "wb") as mutual_information_file:
-                pickle.dump(mutual_information, mutual_information_file)
-            print("\u2714")
+            report(f"Saving to {file_path}...", end="\t")
+            with measure("serialization", path=file_path):
+                with open(file_path, "wb") as mutual_information_file:
+                    pickle.dump(mutual_information, mutual_information_file)
+            report("\u2714")
         return mutual_information
 
 
+def load_mutual_information_scores(
+    target_id: str,
+    cost_function: str,
+    as_series: bool = True,
+    bins: int = None,
+    prebinned: bool = False,
+) -> pd.Series:
+    # Without bins, every logged score is returned.
+    params = None if bins is None else get_mutual_information_params(bins, prebinned)
+    log = ResultLog(get_mutual_information_log_path(target_id, cost_function), params)
+    mutual_information = log.to_dict()
+    if as_series:
+        return mutual_information_dict_to_series(mutual_information, cost_function)
+    return mutual_information
+
+
+def calculate_mutual_information_matrix(
+    target_ids: list,
+    cost_functions: list = None,
+    bins: int = 10,
+    cache_bytes: int = DEFAULT_VOLUME_CACHE_BYTES,
+    catalog=None,
+) -> pd.DataFrame:
+    # Pairs are visited target by target so each target is decoded and binned
+    # once and then served from the cache for every subject and cost function.
+    cost_functions = cost_functions or list(COST_FUNCTION_DICT.values())
+    volumes = BinnedVolumeCache(cache_bytes)
+    scores = dict()
+    for target_id in target_ids:
+        target_scan = get_target_scan(target_id)
+        for cost_function in cost_functions:
+            report(f"Scoring {target_id} after {cost_function} realignment...")
+            realigned_subject_dirs = generate_subject_dirs(
+                "realigned", target_id, cost_function, catalog=catalog
+            )
+            for subject_dir in realigned_subject_dirs:
+                subject_id = subject_dir.split("/")[-2]
+                realigned_scan_path = get_realigned_subject_data(
+                    target_id,
+                    cost_function,
+                    subject_id,
+                    include_mat=False,
+                    catalog=catalog,
+                )
+                if realigned_scan_path is None:
+                    continue
+                target_indices = volumes.get(target_scan, bins)
+                # Realigned scans belong to a single pair, so caching them would
+                # only evict targets.
+                scan_indices = calculate_bin_indices(
+                    extract_series_data(realigned_scan_path), bins
+                )
+                with measure("histogram", subject_id):
+                    histogram = calculate_joint_histogram(
+                        target_indices, scan_indices, bins
+                    )
+                scores[(subject_id, target_id, cost_function)] = (
+                    calculate_histogram_mutual_information(histogram)
+                )
+    report(f"Volume cache: {volumes.hits} hits, {volumes.misses} misses.")
+    if not scores:
+        # from_tuples cannot infer the levels of an empty index.
+        report(f"No realigned scans found for {target_ids}!")
+        columns = pd.MultiIndex.from_arrays(
+            [[], []], names=["Target ID", "Cost Function"]
+        )
+        return pd.DataFrame(index=pd.Index([], name="Subject ID"), columns=columns)
+    index = pd.MultiIndex.from_tuples(
+        scores.keys(), names=["Subject ID", "Target ID", "Cost Function"]
+    )
+    matrix = pd.Series(list(scores.values()), index=index, name="Mutual Information")
+    return matrix.unstack(["Target ID", "Cost Function"])
+
+
+def mutual_information_matrix_to_array(matrix: pd.DataFrame) -> tuple:
+    # subjects x targets x cost functions, with the labels of each axis.
+    targets = sorted(set(matrix.columns.get_level_values(0)))
+    cost_functions = sorted(set(matrix.columns.get_level_values(1)))
+    full_columns = pd.MultiIndex.from_product(
+        [targets, cost_functions], names=matrix.columns.names
+    )
+    values = matrix.reindex(columns=full_columns).values
+    array = values.reshape(len(matrix.index), len(targets), len(cost_functions))
+    return array, (list(matrix.index), targets, cost_functions)
+
+
 def calculate_all_mutual_information_scores(target_id: str) -> pd.DataFrame:
     for cost_function in COST_FUNCTION_DICT.values():
         calculate_mutual_information_scores(target_id, cost_function)
@@ -0,0 +1,192 @@
+import json
+import os
+import time
+import uuid
+
+from cache import fingerprint_file
+from dao import VOLUME_EXTENSIONS, strip_volume_extension
+
+MARKER_SUFFIX = ".complete"
+
+
+def get_marker_path(path: str) -> str:
+    # The marker is named after the unit's primary output, without its volume
+    # extension, so it does not depend on the intermediate volume format. The
+    # leading dot keeps markers and temporary files out of scan globs.
+    directory, name = os.path.split(strip_volume_extension(path))
+    return os.path.join(directory, f".{name}{MARKER_SUFFIX}")
+
+
+def get_extension(path: str) -> str:
+    for extension in VOLUME_EXTENSIONS:
+        if path.endswith(extension):
+            return extension
+    return os.path.splitext(path)[1]
+
+
+def get_temporary_path(path: str) -> str:
+    # Temporary outputs keep their extension, since FSL chooses its output
+    # format by extension, and are unique per attempt, so concurrent attempts
+    # at the same unit never write to the same file.
+    extension = get_extension(path)
+    directory, name = os.path.split(path[: len(path) - len(extension)])
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex[:12]}.tmp{extension}")
+
+
+def fsync_file(path: str):
+    with open(path, "rb") as output_file:
+        os.fsync(output_file.fileno())
+
+
+def fsync_directory(path: str):
+    descriptor = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def write_marker(path: str, record: dict):
+    tmp_path = get_temporary_path(path)
+    with open(tmp_path, "w") as marker_file:
+        json.dump(record, marker_file)
+        marker_file.flush()
+        os.fsync(marker_file.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(os.path.dirname(path))
+
+
+def read_marker(path: str) -> dict:
+    try:
+        with open(path) as marker_file:
+            return json.load(marker_file)
+    except (OSError, ValueError):
+        return None
+
+
+def fingerprint_paths(paths: list) -> dict:
+    return {path: fingerprint_file(path) for path in paths}
+
+
+def is_complete(primary_output: str, inputs: list = (), params: dict = None) -> bool:
+    # A unit is complete when its marker exists, was written for the same
+    # inputs and parameters, and every output it lists is still the file that
+    # was committed.
+    marker = read_marker(get_marker_path(primary_output))
+    if marker is None or marker.get("params") != (params or {}):
+        return False
+    try:
+        return (
+            marker["inputs"] == fingerprint_paths(inputs)
+            and marker["outputs"] == fingerprint_paths(marker["outputs"])
+        )
+    except OSError:
+        return False
+
+
+def adopt(primary_output: str, inputs: list = (), params: dict = None, outputs=None):
+    # Writes the marker for outputs produced before markers existed, or by
+    # hand. Nothing about the outputs is checked here; callers vouch for them.
+    outputs = list(outputs or [primary_output])
+    write_marker(
+        get_marker_path(primary_output),
+        {
+            "inputs": fingerprint_paths(inputs),
+            "outputs": fingerprint_paths(outputs),
+            "params": params or {},
+            "completed": time.time(),
+            "adopted": True,
+        },
+    )
+
+
+def remove_files(paths: list):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def clear_marker(primary_output: str):
+    remove_files([get_marker_path(primary_output)])
+
+
+class OutputCommit:
+    # Collects the outputs of one unit of work under temporary names and moves
+    # them into place together:
+    #
+    #     with OutputCommit(dest, inputs=[scan]) as commit:
+    #         run(out_file=commit.stage(dest))
+    #
+    # Outputs are fsynced and renamed only when the block exits cleanly, and
+    # the completion marker is written last; otherwise the temporary files are
+    # removed and any previous marker stays invalidated.
+    def __init__(self, primary_output: str, inputs: list = (), params: dict = None):
+        self.primary_output = primary_output
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.staged = []
+        self.scratch = []
+
+    def stage(self, path: str) -> str:
+        tmp_path = get_temporary_path(path)
+        self.staged.append((tmp_path, path))
+        return tmp_path
+
+    def track(self, path: str) -> str:
+        # Scratch files, such as FSL's output before format conversion, that
+        # are removed however the block exits.
+        self.scratch.append(path)
+        return path
+
+    def begin(self):
+        # The old marker goes first: a crash while outputs are being replaced
+        # must not leave a marker vouching for a mix of old and new files.
+        clear_marker(self.primary_output)
+        return self
+
+    def finish(self, succeeded: bool = True):
+        try:
+            if succeeded:
+                self.commit()
+            else:
+                self.abort()
+        finally:
+            remove_files(self.scratch)
+            self.scratch = []
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(exc_type is None)
+        return False
+
+    def commit(self):
+        missing = [tmp for tmp, _ in self.staged if not os.path.isfile(tmp)]
+        if missing:
+            self.abort()
+            raise FileNotFoundError(f"Missing outputs: {missing}")
+        directories = set()
+        for tmp_path, path in self.staged:
+            fsync_file(tmp_path)
+            os.replace(tmp_path, path)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            fsync_directory(directory)
+        outputs = [path for _, path in self.staged]
+        write_marker(
+            get_marker_path(self.primary_output),
+            {
+                "inputs": fingerprint_paths(self.inputs),
+                "outputs": fingerprint_paths(outputs),
+                "params": self.params,
+                "completed": time.time(),
+            },
+        )
+        self.staged = []
+
+    def abort(self):
+        remove_files([tmp_path for tmp_path, _ in self.staged])
+        self.staged = []
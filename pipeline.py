@@ -0,0 +1,350 @@
+import json
+import os
+import sqlite3
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+
+from cache import fingerprint_file
+from dao import (
+    LOCATION_DICT,
+    get_costs_log_path,
+    get_cost_function_dir,
+    get_mutual_information_log_path,
+    get_pipeline_state_path,
+    get_scans,
+    get_target_scan,
+)
+from instrumentation import report
+from output_commit import is_complete
+from result_log import ResultLog
+
+STAGE_LIMITS = {"skull_strip": 4, "realign": 8, "cost": 8, "mutual_information": 4}
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY,
+    fingerprints TEXT
+);
+"""
+
+
+class Task:
+    def __init__(
+        self,
+        key: str,
+        stage: str,
+        action,
+        arguments: tuple,
+        inputs: list,
+        outputs: list = (),
+        dependencies: list = (),
+        completed=None,
+    ):
+        self.key = key
+        self.stage = stage
+        self.action = action
+        self.arguments = arguments
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.dependencies = list(dependencies)
+        # Tells whether the stage's own bookkeeping (a completion marker or a
+        # logged result) already has this task's result, for tasks the state
+        # database has no record of.
+        self.completed = completed
+        self.status = "pending"
+        self.error = None
+
+    def __repr__(self):
+        return f"Task({self.key}, {self.status})"
+
+
+class PipelineState:
+    def __init__(self, path: str = None):
+        self.connection = sqlite3.connect(path or get_pipeline_state_path())
+        self.connection.executescript(SCHEMA)
+
+    def get(self, key: str) -> dict:
+        row = self.connection.execute(
+            "SELECT fingerprints FROM tasks WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, fingerprints: dict):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tasks VALUES (?, ?)",
+                (key, json.dumps(fingerprints)),
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+def fingerprint_paths(paths: list) -> list:
+    return [fingerprint_file(path) for path in paths]
+
+
+def fingerprint_task(task: Task) -> dict:
+    return {
+        "inputs": fingerprint_paths(task.inputs),
+        "outputs": fingerprint_paths(task.outputs),
+    }
+
+
+def is_up_to_date(task: Task, state: PipelineState) -> bool:
+    # Inputs that do not exist yet belong to a dependency that has not run, so
+    # the task is pending rather than fingerprinted.
+    paths = task.inputs + task.outputs
+    if not all(os.path.isfile(path) for path in paths):
+        return False
+    fingerprints = fingerprint_task(task)
+    recorded = state.get(task.key)
+    # Rows written before outputs were fingerprinted hold a bare list.
+    if not isinstance(recorded, dict):
+        recorded = None
+    if recorded is None and task.completed is not None and task.completed():
+        # Results from before the state database existed, or from the stage
+        # commands run on their own, are adopted rather than redone.
+        state.set(task.key, fingerprints)
+        return True
+    return recorded == fingerprints
+
+
+def is_logged(log_path: str, params: dict, subject_id: str) -> bool:
+    return subject_id in ResultLog(log_path, params).completed()
+
+
+def run_skull_strip(scan: str, dest: str):
+    from skull_strip import strip_skull
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    strip_skull(scan, dest)
+
+
+def run_linear_registration(
+    stripped: str, target_scan: str, target_id: str, cost_function: str
+):
+    from realign import register_linear
+
+    output_dir = get_cost_function_dir(target_id, cost_function)
+    result = register_linear(
+        stripped, target_scan, output_dir, cost_function, overwrite=True
+    )
+    if result.status == "failed":
+        raise RuntimeError(result.error)
+
+
+def run_cost(
+    registered: str,
+    mat_file: str,
+    target_scan: str,
+    target_id: str,
+    cost_function: str,
+    subject_id: str,
+):
+    from cost_finder import get_cost_params, measure_cost
+
+    subject_dir = os.path.dirname(registered)
+    cost = measure_cost(registered, target_scan, mat_file, subject_dir)
+    log = ResultLog(get_costs_log_path(target_id, cost_function), get_cost_params())
+    log.append(subject_id, cost)
+
+
+def run_mutual_information(
+    registered: str,
+    target_scan: str,
+    target_id: str,
+    cost_function: str,
+    subject_id: str,
+    bins: int = 10,
+):
+    from mutual_information import (
+        calculate_scans_mutual_information_score,
+        get_mutual_information_params,
+    )
+
+    score = calculate_scans_mutual_information_score(target_scan, registered, bins)
+    log = ResultLog(
+        get_mutual_information_log_path(target_id, cost_function),
+        get_mutual_information_params(bins),
+    )
+    log.append(subject_id, float(score))
+
+
+def build_subject_tasks(
+    scan: str, target_scans: dict, cost_functions: list, bins: int = 10
+) -> list:
+    from cost_finder import get_cost_params
+    from mutual_information import get_mutual_information_params
+    from realign import get_linear_outputs, get_linear_params
+    from skull_strip import get_default_destination
+
+    subject_id = scan.split("/")[-2]
+    stripped = get_default_destination(scan, create=False)
+    strip_task = Task(
+        f"skull_strip:{subject_id}",
+        "skull_strip",
+        run_skull_strip,
+        (scan, stripped),
+        inputs=[scan],
+        outputs=[stripped],
+        completed=partial(is_complete, stripped, [scan], {"robust": True}),
+    )
+    tasks = [strip_task]
+    for target_id, target_scan in target_scans.items():
+        for cost_function in cost_functions:
+            suffix = f"{subject_id}:{target_id}:{cost_function}"
+            output_dir = get_cost_function_dir(target_id, cost_function)
+            registered, mat_file = get_linear_outputs(stripped, output_dir)
+            realign_task = Task(
+                f"realign:{suffix}",
+                "realign",
+                run_linear_registration,
+                (stripped, target_scan, target_id, cost_function),
+                inputs=[stripped, target_scan],
+                outputs=[registered, mat_file],
+                dependencies=[strip_task.key],
+                completed=partial(
+                    is_complete,
+                    registered,
+                    [stripped, target_scan],
+                    get_linear_params(cost_function),
+                ),
+            )
+            cost_task = Task(
+                f"cost:{suffix}",
+                "cost",
+                run_cost,
+                (
+                    registered,
+                    mat_file,
+                    target_scan,
+                    target_id,
+                    cost_function,
+                    subject_id,
+                ),
+                inputs=[registered, mat_file, target_scan],
+                dependencies=[realign_task.key],
+                completed=partial(
+                    is_logged,
+                    get_costs_log_path(target_id, cost_function),
+                    get_cost_params(),
+                    subject_id,
+                ),
+            )
+            mutual_information_task = Task(
+                f"mutual_information:{suffix}",
+                "mutual_information",
+                run_mutual_information,
+                (
+                    registered,
+                    target_scan,
+                    target_id,
+                    cost_function,
+                    subject_id,
+                    bins,
+                ),
+                inputs=[registered, target_scan],
+                dependencies=[realign_task.key],
+                completed=partial(
+                    is_logged,
+                    get_mutual_information_log_path(target_id, cost_function),
+                    get_mutual_information_params(bins),
+                    subject_id,
+                ),
+            )
+            tasks += [realign_task, cost_task, mutual_information_task]
+    return tasks
+
+
+def build_pipeline(
+    target_ids: list, cost_functions: list, bins: int = 10, catalog=None
+) -> dict:
+    target_scans = {target_id: get_target_scan(target_id) for target_id in target_ids}
+    scans = get_scans(LOCATION_DICT["raw"], "t1", catalog=catalog)
+    tasks = dict()
+    for scan in scans:
+        for task in build_subject_tasks(scan, target_scans, cost_functions, bins):
+            tasks[task.key] = task
+    return tasks
+
+
+def block_dependents(task: Task, tasks: dict, dependents: dict):
+    for key in dependents[task.key]:
+        dependent = tasks[key]
+        if dependent.status == "pending":
+            dependent.status = "blocked"
+            block_dependents(dependent, tasks, dependents)
+
+
+def run_pipeline(
+    tasks: dict,
+    limits: dict = None,
+    state_path: str = None,
+    dry_run: bool = False,
+) -> dict:
+    limits = dict(STAGE_LIMITS, **(limits or {}))
+    dependents = defaultdict(list)
+    remaining = dict()
+    ready = {stage: deque() for stage in limits}
+    for task in tasks.values():
+        remaining[task.key] = len(task.dependencies)
+        for key in task.dependencies:
+            dependents[key].append(task.key)
+        if not task.dependencies:
+            ready[task.stage].append(task)
+
+    def release(task: Task):
+        for key in dependents[task.key]:
+            remaining[key] -= 1
+            if remaining[key] == 0:
+                ready[tasks[key].stage].append(tasks[key])
+
+    state = PipelineState(state_path)
+    running = dict()
+    running_per_stage = defaultdict(int)
+    try:
+        with ThreadPoolExecutor(max_workers=sum(limits.values())) as executor:
+            while True:
+                # Skipped tasks release their dependents immediately, so keep
+                # scheduling until no stage can take another task.
+                scheduled = True
+                while scheduled:
+                    scheduled = False
+                    for stage, queue in ready.items():
+                        while queue and running_per_stage[stage] < limits[stage]:
+                            task = queue.popleft()
+                            scheduled = True
+                            if is_up_to_date(task, state):
+                                task.status = "skipped"
+                                release(task)
+                            elif dry_run:
+                                print(f"Would run {task.key}")
+                                task.status = "done"
+                                release(task)
+                            else:
+                                task.status = "running"
+                                future = executor.submit(task.action, *task.arguments)
+                                running[future] = task
+                                running_per_stage[stage] += 1
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    running_per_stage[task.stage] -= 1
+                    try:
+                        future.result()
+                    except Exception as e:
+                        task.status, task.error = "failed", str(e)
+                        block_dependents(task, tasks, dependents)
+                        report(f"\u2718 {task.key}: {e}")
+                        continue
+                    task.status = "done"
+                    state.set(task.key, fingerprint_task(task))
+                    release(task)
+                    report(f"\u2714 {task.key}")
+    finally:
+        state.close()
+    return {key: task.status for key, task in tasks.items()}
@@ -0,0 +1,385 @@
+import glob
+import heapq
+import json
+import os
+
+from collections import namedtuple
+
+import numpy as np
+
+from cache import fingerprint_file
+from dao import (
+    LOCATION_DICT,
+    VOLUME_EXTENSIONS,
+    choose_single_scan,
+    filter_scans_by_type,
+    get_cost_function_dir,
+    get_scan_manifest_path,
+    get_target_scan,
+    unique_volumes,
+)
+from instrumentation import measure, report
+from output_commit import adopt, is_complete
+from realign import get_linear_outputs, get_linear_params
+from skull_strip import get_default_destination
+
+# Rough throughput of FSL on one core, used to turn voxel counts into time
+# estimates; only the relative costs matter for ordering and balancing.
+SECONDS_PER_MEGAVOXEL = {"flirt": 6.0, "bet": 2.0}
+# FSL holds every volume it works on as float32, plus working copies (FLIRT's
+# resampling pyramid, BET's surface and mask).
+FSL_BYTES_PER_VOXEL = 4
+MEMORY_FACTOR = {"flirt": 3.0, "bet": 2.5}
+
+PlannedTask = namedtuple(
+    "PlannedTask",
+    ["subject_id", "scan", "dest", "shape", "zooms", "cost", "memory", "worker"],
+)
+Plan = namedtuple("Plan", ["stage", "tasks", "skipped", "loads", "max_workers"])
+
+
+def read_volume_header(path: str) -> dict:
+    # Only the header is read; the data is never loaded.
+    import nibabel as nib
+
+    from volume_format import CHUNKED_FORMATS, ChunkedVolume, get_volume_format
+
+    if get_volume_format(path) in CHUNKED_FORMATS:
+        import base64
+
+        header_block = base64.b64decode(ChunkedVolume(path).header["nifti_header"])
+        header = nib.Nifti1Header(binaryblock=header_block)
+    else:
+        header = nib.load(path).header
+    return {
+        "shape": [int(size) for size in header.get_data_shape()],
+        "zooms": [float(zoom) for zoom in header.get_zooms()],
+        "dtype": header.get_data_dtype().str,
+    }
+
+
+def count_voxels(entry: dict) -> int:
+    voxels = 1
+    for size in entry["shape"]:
+        voxels *= size
+    return voxels
+
+
+class ScanManifest:
+    def __init__(self, path: str = None):
+        self.path = path or get_scan_manifest_path()
+        try:
+            with open(self.path) as manifest_file:
+                self.entries = json.load(manifest_file)
+        except (OSError, ValueError):
+            self.entries = dict()
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self.entries, manifest_file)
+        os.replace(tmp_path, self.path)
+
+    def list_volumes(self, base_dir: str, catalog=None) -> list:
+        if catalog is not None:
+            return catalog.list_scans(base_dir)
+        patterns = [os.path.join(base_dir, f"*/*{e}") for e in VOLUME_EXTENSIONS]
+        return sorted(path for pattern in patterns for path in glob.glob(pattern))
+
+    def refresh(self, base_dir: str, catalog=None) -> int:
+        # Headers are read again only for volumes that changed since the last
+        # refresh; volumes that disappeared from base_dir are dropped.
+        base_dir = os.path.join(os.path.normpath(base_dir), "")
+        paths = unique_volumes(self.list_volumes(base_dir, catalog))
+        updated = 0
+        for path in paths:
+            stamp = fingerprint_file(path)
+            entry = self.entries.get(path)
+            if entry is not None and entry["stamp"] == stamp:
+                continue
+            try:
+                with measure("header_read", path=path):
+                    entry = read_volume_header(path)
+            except Exception as e:
+                report(f"Failed to read the header of {path}!\n{e}")
+                continue
+            entry["stamp"] = stamp
+            self.entries[path] = entry
+            updated += 1
+        current = set(paths)
+        removed = [
+            path
+            for path in self.entries
+            if path.startswith(base_dir) and path not in current
+        ]
+        for path in removed:
+            del self.entries[path]
+        if updated or removed:
+            self.save()
+        report(
+            f"Scan manifest refreshed for {base_dir} ({updated} headers read, {len(removed)} removed)."
+        )
+        return updated
+
+    def get_subject_scans(self, base_dir: str) -> dict:
+        base_dir = os.path.join(os.path.normpath(base_dir), "")
+        subject_scans = dict()
+        for path in sorted(self.entries):
+            if path.startswith(base_dir):
+                subject_id = path.split("/")[-2]
+                subject_scans.setdefault(subject_id, []).append(path)
+        return subject_scans
+
+    def choose_scans(self, base_dir: str, scan_type: str = None) -> list:
+        # The same choice get_scans makes, from candidates in the same (path)
+        # order, but from the manifest rather than the file system.
+        scans = []
+        for subject_scans in self.get_subject_scans(base_dir).values():
+            if scan_type is not None:
+                subject_scans = filter_scans_by_type(subject_scans, scan_type)
+            if subject_scans:
+                scans.append(choose_single_scan(subject_scans, scan_type))
+        return scans
+
+    def get_voxels(self, path: str) -> int:
+        entry = self.entries.get(path)
+        if entry is None:
+            entry = read_volume_header(path)
+        return count_voxels(entry)
+
+    def get_planned_scans(self, base_dir: str, scan_type: str = None) -> list:
+        # Largest volumes first, so the longest jobs are not left for last.
+        scans = self.choose_scans(base_dir, scan_type)
+        return sorted(scans, key=self.get_voxels, reverse=True)
+
+
+def estimate_cost(stage: str, voxels: int) -> float:
+    return voxels / 1e6 * SECONDS_PER_MEGAVOXEL[stage]
+
+
+def estimate_memory(stage: str, voxels: int) -> int:
+    return int(voxels * FSL_BYTES_PER_VOXEL * MEMORY_FACTOR[stage])
+
+
+def balance_tasks(tasks: list, workers: int) -> tuple:
+    # Longest processing time first: each task, largest first, goes to the
+    # worker with the least estimated work so far.
+    tasks = sorted(tasks, key=lambda task: task.cost, reverse=True)
+    heap = [(0.0, worker) for worker in range(max(1, workers))]
+    balanced = []
+    for task in tasks:
+        load, worker = heapq.heappop(heap)
+        balanced.append(task._replace(worker=worker))
+        heapq.heappush(heap, (load + task.cost, worker))
+    loads = [load for load, _ in sorted(heap, key=lambda item: item[1])]
+    return balanced, loads
+
+
+def get_max_workers(tasks: list, workers: int, memory_limit: int = None) -> int:
+    # Workers that can run at once without the largest jobs exceeding the
+    # memory limit.
+    if memory_limit is None or not tasks:
+        return workers
+    largest = max(task.memory for task in tasks)
+    return max(1, min(workers, memory_limit // max(1, largest)))
+
+
+def create_plan(
+    stage: str,
+    candidates: list,
+    manifest: ScanManifest,
+    workers: int = 1,
+    memory_limit: int = None,
+    extra_voxels: int = 0,
+) -> Plan:
+    tasks, skipped = [], []
+    for subject_id, scan, dest, done in candidates:
+        if done:
+            skipped.append(subject_id)
+            continue
+        entry = manifest.entries[scan]
+        voxels = count_voxels(entry) + extra_voxels
+        tasks.append(
+            PlannedTask(
+                subject_id,
+                scan,
+                dest,
+                tuple(entry["shape"]),
+                tuple(entry["zooms"]),
+                estimate_cost(stage, voxels),
+                estimate_memory(stage, voxels),
+                None,
+            )
+        )
+    max_workers = get_max_workers(tasks, workers, memory_limit)
+    tasks, loads = balance_tasks(tasks, max_workers)
+    return Plan(stage, tasks, skipped, loads, max_workers)
+
+
+def plan_realign(
+    target_id: str,
+    cost_function: str,
+    workers: int = 1,
+    memory_limit: int = None,
+    manifest: ScanManifest = None,
+    refresh: bool = True,
+    catalog=None,
+    command: str = "flirt",
+) -> Plan:
+    # Existing results are detected the way register_linear detects them, by
+    # their completion markers, without creating any directories.
+    manifest = manifest or ScanManifest()
+    base_dir = LOCATION_DICT["skull_stripped"]
+    if refresh:
+        manifest.refresh(base_dir, catalog)
+    output_dir = get_cost_function_dir(target_id, cost_function)
+    target_scan = get_target_scan(target_id)
+    target_voxels = manifest.get_voxels(target_scan)
+    params = get_linear_params(cost_function, command)
+    candidates = []
+    for scan in manifest.choose_scans(base_dir, "t1"):
+        subject_id = scan.split("/")[-2]
+        out_file, _ = get_linear_outputs(scan, output_dir)
+        done = is_complete(out_file, [scan, target_scan], params)
+        candidates.append((subject_id, scan, out_file, done))
+    return create_plan(
+        "flirt", candidates, manifest, workers, memory_limit, target_voxels
+    )
+
+
+def plan_bet(
+    workers: int = 1,
+    memory_limit: int = None,
+    skip_existing: bool = True,
+    manifest: ScanManifest = None,
+    refresh: bool = True,
+    catalog=None,
+    robust: bool = True,
+) -> Plan:
+    manifest = manifest or ScanManifest()
+    base_dir = LOCATION_DICT["raw"]
+    if refresh:
+        manifest.refresh(base_dir, catalog)
+    candidates = []
+    for scan in manifest.choose_scans(base_dir):
+        subject_id = scan.split("/")[-2]
+        dest = get_default_destination(scan, create=False)
+        done = skip_existing and is_complete(dest, [scan], {"robust": robust})
+        candidates.append((subject_id, scan, dest, done))
+    return create_plan("bet", candidates, manifest, workers, memory_limit)
+
+
+def check_output_volume(path: str, shape: tuple) -> str:
+    # Why an existing output cannot be trusted, or None. FSL writes the header
+    # first, so a truncated volume still has one; the size check catches
+    # uncompressed volumes cut short.
+    try:
+        size = os.path.getsize(path)
+        header = read_volume_header(path)
+    except Exception as e:
+        return f"unreadable ({e})"
+    if list(header["shape"][:3]) != list(shape[:3]):
+        return f"shape {header['shape']} does not match {list(shape)}"
+    if path.endswith(".nii"):
+        expected = count_voxels(header) * np.dtype(header["dtype"]).itemsize
+        if size < expected:
+            return f"{size} bytes, expected at least {expected}"
+    return None
+
+
+def adopt_outputs(plan: Plan, get_outputs, get_inputs, params: dict, shape=None):
+    # Outputs of planned tasks that predate completion markers get one when
+    # they pass check_output_volume; the rest stay planned.
+    adopted, rejected = [], dict()
+    for task in plan.tasks:
+        outputs = get_outputs(task)
+        missing = [path for path in outputs if not os.path.isfile(path)]
+        if missing:
+            continue
+        reason = check_output_volume(task.dest, shape or task.shape)
+        if reason is not None:
+            rejected[task.subject_id] = reason
+            report(f"\u2718 {task.subject_id}: {task.dest} {reason}")
+            continue
+        adopt(task.dest, get_inputs(task), params, outputs)
+        adopted.append(task.subject_id)
+        report(f"\u2714 {task.subject_id}: adopted {task.dest}")
+    report(
+        f"Adopted {len(adopted)} existing {plan.stage} outputs, rejected {len(rejected)}."
+    )
+    return adopted, rejected
+
+
+def adopt_realign(
+    target_id: str,
+    cost_function: str,
+    manifest: ScanManifest = None,
+    refresh: bool = True,
+    catalog=None,
+    command: str = "flirt",
+) -> tuple:
+    # FLIRT resamples onto the target's grid, so registered volumes must have
+    # the target's shape.
+    plan = plan_realign(
+        target_id,
+        cost_function,
+        manifest=manifest,
+        refresh=refresh,
+        catalog=catalog,
+        command=command,
+    )
+    output_dir = get_cost_function_dir(target_id, cost_function)
+    target_scan = get_target_scan(target_id)
+    return adopt_outputs(
+        plan,
+        lambda task: list(get_linear_outputs(task.scan, output_dir)),
+        lambda task: [task.scan, target_scan],
+        get_linear_params(cost_function, command),
+        read_volume_header(target_scan)["shape"],
+    )
+
+
+def adopt_bet(
+    manifest: ScanManifest = None,
+    refresh: bool = True,
+    catalog=None,
+    robust: bool = True,
+) -> tuple:
+    # BET keeps the raw scan's grid.
+    plan = plan_bet(manifest=manifest, refresh=refresh, catalog=catalog, robust=robust)
+    return adopt_outputs(
+        plan,
+        lambda task: [task.dest],
+        lambda task: [task.scan],
+        {"robust": robust},
+    )
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def report_plan(plan: Plan):
+    # The plan is what was asked for, so it is printed even with --quiet.
+    print(
+        f"\nPlanned {len(plan.tasks)} {plan.stage} jobs ({len(plan.skipped)} already done) on {plan.max_workers} workers:"
+    )
+    for task in plan.tasks:
+        shape = "x".join(str(size) for size in task.shape)
+        zooms = "x".join(f"{zoom:.2g}" for zoom in task.zooms[:3])
+        print(
+            f"[{task.worker}]\t{task.subject_id}\t{shape} @ {zooms} mm\t"
+            f"~{task.cost:.0f} s\t~{format_bytes(task.memory)}\t{task.dest}"
+        )
+    for worker, load in enumerate(plan.loads):
+        print(f"Worker {worker}: ~{load:.0f} s")
+    if plan.tasks:
+        peak = sorted((task.memory for task in plan.tasks), reverse=True)
+        print(
+            f"Estimated makespan ~{max(plan.loads):.0f} s, "
+            f"peak memory ~{format_bytes(sum(peak[: plan.max_workers]))}."
+        )
@@ -1,85 +1,189 @@
-import numpy as np
-import pandas as pd
-import pickle
+import os
 
 from bokeh.io import curdoc
-from bokeh.layouts import row, widgetbox
-from bokeh.models import ColumnDataSource, CDSView, BooleanFilter, FactorRange
-from bokeh.models.widgets import MultiSelect
+from bokeh.layouts import column, row
+from bokeh.models import ColumnDataSource
+from bokeh.models.widgets import DataTable, MultiSelect, Select, TableColumn
+from bokeh.palettes import Category10
 from bokeh.plotting import figure
 
+from aggregate_index import (
+    HISTOGRAM_BINS,
+    get_cost_function_entries,
+    get_index_values,
+    update_index,
+)
+
+RESULTS_STORE_DIR = os.environ.get("BRAIN_PROFILE_RESULTS_STORE")
+DEFAULT_METRIC = "Mutual Information"
+REFRESH_INTERVAL_MS = 30 * 1000
+SUMMARY_COLUMNS = ["count", "mean", "std", "min", "p25", "p50", "p75", "max"]
+
+
+def create_histogram_data(
+    entries: dict, cost_functions: list, selected: list, bins: int
+) -> dict:
+    # Every cost function always has its full set of bins, so the source keeps
+    # the same length and widget changes can be sent as patches.
+    data = {name: [] for name in ("cost_function", "left", "right", "top", "alpha")}
+    for cost_function in cost_functions:
+        entry = entries.get(cost_function, {})
+        density = entry.get("density") or [0.0] * bins
+        edges = entry.get("edges") or [0.0] * (bins + 1)
+        alpha = 0.5 if cost_function in selected else 0.0
+        data["cost_function"] += [cost_function] * bins
+        data["left"] += edges[:-1]
+        data["right"] += edges[1:]
+        data["top"] += density
+        data["alpha"] += [alpha] * bins
+    data["color"] = [
+        Category10[10][cost_functions.index(cost_function) % 10]
+        for cost_function in data["cost_function"]
+    ]
+    return data
+
+
+def create_summary_data(entries: dict, cost_functions: list) -> dict:
+    data = {"cost_function": list(cost_functions)}
+    for name in SUMMARY_COLUMNS:
+        data[name] = [
+            entries.get(cost_function, {}).get(name, float("nan"))
+            for cost_function in cost_functions
+        ]
+    return data
+
+
+def patch_source(source: ColumnDataSource, data: dict):
+    # Only the cells that changed are sent to the browser; NaN cells compare
+    # unequal to themselves, so they are matched separately.
+    if set(data) != set(source.data) or any(
+        len(values) != len(source.data[name]) for name, values in data.items()
+    ):
+        source.data = data
+        return
+    patches = dict()
+    for name, values in data.items():
+        current = source.data[name]
+        changed = [
+            (position, value)
+            for position, (old, value) in enumerate(zip(current, values))
+            if old != value and not (old != old and value != value)
+        ]
+        if changed:
+            patches[name] = changed
+    if patches:
+        source.patch(patches)
+
+
+class Dashboard:
+    def __init__(self, store_dir: str = None):
+        self.store_dir = store_dir
+        self.index = update_index(store_dir)
+        self.bins = self.index["bins"] or HISTOGRAM_BINS
+        self.cost_functions = get_index_values(self.index, "cost_function")
+        targets = get_index_values(self.index, "target_id")
+        self.target_select = Select(
+            title="Target", options=targets, value=targets[0] if targets else None
+        )
+        metrics = get_index_values(self.index, "metric")
+        default_metric = DEFAULT_METRIC if DEFAULT_METRIC in metrics else None
+        self.metric_select = Select(
+            title="Metric",
+            options=metrics,
+            value=default_metric or (metrics[0] if metrics else None),
+        )
+        self.cost_function_select = MultiSelect(
+            title="Cost functions",
+            options=self.cost_functions,
+            value=list(self.cost_functions),
+        )
+        self.histogram_source = ColumnDataSource(self.create_histogram_data())
+        self.summary_source = ColumnDataSource(self.create_summary_data())
+        for widget in (self.target_select, self.metric_select):
+            widget.on_change("value", self.update)
+        self.cost_function_select.on_change("value", self.update)
+
+    def get_entries(self) -> dict:
+        return get_cost_function_entries(
+            self.index, self.target_select.value, self.metric_select.value
+        )
 
-RESULTS_PATH = "/home/flavus/Projects/reid/results.pkl"
-
-
-def read_results(path: str):
-    try:
-        with open(path, "rb") as results_content:
-            return pickle.load(results_content)
-    except Exception:
-        raise FileNotFoundError("Failed to load results!")
-
+    def create_histogram_data(self) -> dict:
+        return create_histogram_data(
+            self.get_entries(),
+            self.cost_functions,
+            self.cost_function_select.value,
+            self.bins,
+        )
 
-df = read_results(RESULTS_PATH)
+    def create_summary_data(self) -> dict:
+        return create_summary_data(self.get_entries(), self.cost_functions)
+
+    def update(self, attr=None, old=None, new=None):
+        patch_source(self.histogram_source, self.create_histogram_data())
+        patch_source(self.summary_source, self.create_summary_data())
+
+    def refresh(self):
+        # Picks up partitions written since the last refresh; only their
+        # aggregates are recomputed.
+        self.index = update_index(self.store_dir)
+        cost_functions = get_index_values(self.index, "cost_function")
+        if cost_functions != self.cost_functions:
+            added = set(cost_functions) - set(self.cost_functions)
+            self.cost_functions = cost_functions
+            self.cost_function_select.options = cost_functions
+            self.cost_function_select.value = [
+                cost_function
+                for cost_function in cost_functions
+                if cost_function in self.cost_function_select.value
+                or cost_function in added
+            ]
+        self.target_select.options = get_index_values(self.index, "target_id")
+        self.metric_select.options = get_index_values(self.index, "metric")
+        self.update()
+
+    def create_histogram_figure(self):
+        plot = figure(
+            title="Result distributions", tools="", background_fill_color="#fafafa"
+        )
+        plot.quad(
+            source=self.histogram_source,
+            top="top",
+            bottom=0,
+            left="left",
+            right="right",
+            fill_color="color",
+            fill_alpha="alpha",
+            line_color="white",
+            line_alpha="alpha",
+        )
+        plot.y_range.start = 0
+        plot.xaxis.axis_label = "Value"
+        plot.yaxis.axis_label = "Density"
+        plot.grid.grid_line_color = "white"
+        return plot
+
+    def create_summary_table(self) -> DataTable:
+        columns = [TableColumn(field="cost_function", title="Cost function")]
+        columns += [TableColumn(field=name, title=name) for name in SUMMARY_COLUMNS]
+        return DataTable(source=self.summary_source, columns=columns, height=200)
+
+    def create_layout(self):
+        controls = column(
+            self.target_select, self.metric_select, self.cost_function_select
+        )
+        figures = column(self.create_histogram_figure(), self.create_summary_table())
+        return row(controls, figures)
 
 
-def query_results(
-    results: pd.DataFrame,
-    subject_id: str = None,
-    cost_function: str = None,
-    metric: str = "Mutual Information",
-) -> pd.DataFrame:
-    subject_id = subject_id or slice(None)
-    cost_function = cost_function or slice(None)
-    metric = metric or slice(None)
-    return results.sort_index().loc[(subject_id, cost_function, metric), :]
+def add_dashboard(document, store_dir: str = RESULTS_STORE_DIR) -> Dashboard:
+    dashboard = Dashboard(store_dir)
+    document.add_root(dashboard.create_layout())
+    document.add_periodic_callback(dashboard.refresh, REFRESH_INTERVAL_MS)
+    return dashboard
 
 
-def create_column_data_source(dataframe: pd.DataFrame) -> ColumnDataSource:
-    subject_id = list(dataframe.index.get_level_values(0))
-    cost_function = list(dataframe.index.get_level_values(1))
-    metric = list(dataframe.index.get_level_values(2))
-    value = [value[0] for value in dataframe.values]
-    return ColumnDataSource(
-        data=dict(
-            subject_id=subject_id,
-            cost_function=cost_function,
-            metric=metric,
-            value=value,
-        )
-    )
-
-
-def extract_cost_function_results(dataframe: pd.DataFrame, cost_function: str) -> list:
-    results = query_results(dataframe, cost_function=cost_function)
-    return [value[0] for value in results.values]
-
-
-def make_plot(title, hist, edges, x):
-    p = figure(title=title, tools="", background_fill_color="#fafafa")
-    p.quad(
-        top=hist,
-        bottom=0,
-        left=edges[:-1],
-        right=edges[1:],
-        fill_color="navy",
-        line_color="white",
-        alpha=0.5,
-    )
-    p.y_range.start = 0
-    p.legend.location = "center_right"
-    p.legend.background_fill_color = "#fefefe"
-    p.xaxis.axis_label = "x"
-    p.yaxis.axis_label = "Pr(x)"
-    p.grid.grid_line_color = "white"
-    return p
-
-
-values = extract_cost_function_results(df, "Correlation Ratio")
-hist, edges = np.histogram(values, density=True, bins=50)
-x = np.linspace(0, 1, 1000)
-
-plot = make_plot("Correlation Ratio", hist, edges, x)
-
-layout = row(plot)
-curdoc().add_root(layout)
+# `bokeh serve plot_cost.py` runs this file under a generated bokeh_app_*
+# module name; plain imports have no side effects.
+if __name__.startswith("bokeh_app"):
+    add_dashboard(curdoc())
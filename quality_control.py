@@ -0,0 +1,264 @@
+import itertools
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cache import fingerprint_file
+from dao import (
+    LOCATION_DICT,
+    find_volume,
+    get_quality_control_path,
+    get_scans,
+)
+from instrumentation import measure, report
+from mutual_information import DEFAULT_MEMORY_BUDGET, iterate_series_slabs
+from planner import read_volume_header
+
+QC_STAGES = ("skull_stripped", "bias_corrected")
+PERCENTILES = (1, 5, 50, 95, 99)
+# Percentiles are read off a histogram of the foreground, so the volume is
+# streamed twice instead of being held in memory for sorting.
+PERCENTILE_BINS = 4096
+OUTLIER_METRICS = ("mask_volume", "mask_fraction", "cv", "foreground_ratio", "p50")
+# Modified z-score above which a volume is flagged (Iglewicz and Hoaglin).
+OUTLIER_THRESHOLD = 3.5
+
+
+def get_source_scan(path: str) -> str:
+    # Skull-stripping and bias correction keep the raw scan's file name and
+    # voxel grid, so the raw scan gives the background the stripped volume no
+    # longer has.
+    subject_id, file_name = path.split("/")[-2:]
+    return find_volume(os.path.join(LOCATION_DICT["raw"], subject_id, file_name))
+
+
+def iterate_slab_pairs(path: str, source_path: str, memory_budget: int):
+    if source_path is None:
+        slabs = iterate_series_slabs(path, memory_budget)
+        return zip(slabs, itertools.repeat(None))
+    # Both volumes are read at the same time, so each gets half of the budget.
+    return zip(
+        iterate_series_slabs(path, memory_budget // 2),
+        iterate_series_slabs(source_path, memory_budget // 2),
+    )
+
+
+def calculate_percentiles(histogram: np.ndarray, edges: np.ndarray) -> dict:
+    cumulative = np.cumsum(histogram)
+    positions = np.array(PERCENTILES) / 100 * cumulative[-1]
+    indices = np.minimum(np.searchsorted(cumulative, positions), len(histogram) - 1)
+    centers = (edges[:-1] + edges[1:]) / 2
+    return {
+        f"p{percentile:02d}": float(centers[index])
+        for percentile, index in zip(PERCENTILES, indices)
+    }
+
+
+def calculate_volume_metrics(
+    path: str, source_path: str = None, memory_budget: int = DEFAULT_MEMORY_BUDGET
+) -> dict:
+    # Skull-stripped and bias-corrected volumes are zero outside the brain,
+    # so non-zero voxels are the brain mask.
+    header = read_volume_header(path)
+    if source_path is not None:
+        if read_volume_header(source_path)["shape"] != header["shape"]:
+            source_path = None
+    voxels = foreground = 0
+    total = total_squares = 0.0
+    minimum, maximum = np.inf, -np.inf
+    source_foreground = source_background = 0.0
+    with measure("quality_control", path=path):
+        for slab, source_slab in iterate_slab_pairs(path, source_path, memory_budget):
+            mask = slab != 0
+            values = slab[mask].astype(np.float64)
+            voxels += slab.size
+            foreground += values.size
+            if values.size:
+                total += values.sum()
+                total_squares += np.square(values).sum()
+                minimum = min(minimum, values.min())
+                maximum = max(maximum, values.max())
+            if source_slab is not None:
+                source_foreground += source_slab[mask].sum(dtype=np.float64)
+                source_background += source_slab[~mask].sum(dtype=np.float64)
+        voxel_volume = float(np.prod(header["zooms"][:3]))
+        metrics = {
+            "voxels": voxels,
+            "mask_voxels": foreground,
+            "mask_volume": foreground * voxel_volume / 1000,
+            "mask_fraction": foreground / voxels if voxels else 0.0,
+            "source": source_path,
+        }
+        if not foreground:
+            return metrics
+        mean = total / foreground
+        std = np.sqrt(max(0.0, total_squares / foreground - mean ** 2))
+        metrics.update(
+            mean=float(mean), std=float(std), cv=float(std / mean) if mean else None
+        )
+        if source_path is not None and foreground < voxels:
+            background_mean = source_background / (voxels - foreground)
+            if background_mean:
+                metrics["foreground_ratio"] = float(
+                    source_foreground / foreground / background_mean
+                )
+        if minimum == maximum:
+            metrics.update((f"p{p:02d}", float(minimum)) for p in PERCENTILES)
+            return metrics
+        edges = np.linspace(minimum, maximum, PERCENTILE_BINS + 1)
+        histogram = np.zeros(PERCENTILE_BINS, dtype=np.int64)
+        for slab in iterate_series_slabs(path, memory_budget):
+            histogram += np.histogram(slab[slab != 0], bins=edges)[0]
+        metrics.update(calculate_percentiles(histogram, edges))
+    return metrics
+
+
+def assess_volume(
+    path: str, source_path: str = None, memory_budget: int = DEFAULT_MEMORY_BUDGET
+) -> dict:
+    # A volume that cannot be read fails quality control rather than the run.
+    try:
+        return calculate_volume_metrics(path, source_path, memory_budget)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def calculate_robust_scores(values: np.ndarray) -> np.ndarray:
+    # Median and MAD rather than mean and standard deviation, so the outliers
+    # being looked for do not hide themselves by inflating the spread.
+    median = np.median(values)
+    deviation = np.median(np.abs(values - median))
+    if deviation:
+        return 0.6745 * (values - median) / deviation
+    # More than half the cohort shares the median value; the mean absolute
+    # deviation still separates whatever differs from it.
+    deviation = np.mean(np.abs(values - median))
+    if deviation:
+        return (values - median) / (1.253314 * deviation)
+    return np.zeros_like(values)
+
+
+def flag_outliers(
+    metrics: dict, threshold: float = OUTLIER_THRESHOLD, names: tuple = OUTLIER_METRICS
+) -> dict:
+    flags = {path: [] for path in metrics}
+    for path, entry in metrics.items():
+        if "error" in entry:
+            flags[path].append(f"unreadable ({entry['error']})")
+        elif not entry.get("mask_voxels"):
+            flags[path].append("empty mask")
+    for name in names:
+        paths = [
+            path for path, entry in metrics.items() if entry.get(name) is not None
+        ]
+        if len(paths) < 3:
+            continue
+        scores = calculate_robust_scores(
+            np.array([metrics[path][name] for path in paths], dtype=np.float64)
+        )
+        for path, score in zip(paths, scores):
+            if abs(score) > threshold:
+                flags[path].append(f"{name} ({score:+.1f})")
+    return {path: reasons for path, reasons in flags.items() if reasons}
+
+
+class QualityReport:
+    def __init__(self, path: str = None, threshold: float = OUTLIER_THRESHOLD):
+        self.path = path or get_quality_control_path()
+        self.threshold = threshold
+        try:
+            with open(self.path) as report_file:
+                self.entries = json.load(report_file)
+        except (OSError, ValueError):
+            self.entries = dict()
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as report_file:
+            json.dump(self.entries, report_file)
+        os.replace(tmp_path, self.path)
+
+    def get_stamps(self, path: str, source_path: str) -> list:
+        return [
+            fingerprint_file(path),
+            fingerprint_file(source_path) if source_path else None,
+        ]
+
+    def update(
+        self,
+        scans: list,
+        workers: int = 1,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    ) -> int:
+        # Only volumes written since they were last assessed are read again.
+        sources = [get_source_scan(scan) for scan in scans]
+        missing = []
+        for scan, source_path in zip(scans, sources):
+            stamps = self.get_stamps(scan, source_path)
+            entry = self.entries.get(scan)
+            if entry is None or entry["stamps"] != stamps:
+                missing.append((scan, source_path, stamps))
+        report(f"Assessing {len(missing)} of {len(scans)} volumes...")
+        paths = [scan for scan, _, _ in missing]
+        source_paths = [source_path for _, source_path, _ in missing]
+        budgets = [memory_budget] * len(missing)
+        if workers == 1:
+            results = list(map(assess_volume, paths, source_paths, budgets))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(assess_volume, paths, source_paths, budgets)
+                )
+        for (scan, _, stamps), metrics in zip(missing, results):
+            metrics["stamps"] = stamps
+            self.entries[scan] = metrics
+        if missing:
+            self.save()
+        return len(missing)
+
+    def get_flags(self, scans: list) -> dict:
+        # Scans are compared with the cohort they were given with, so each
+        # stage and series type is judged against its own kind.
+        metrics = {scan: self.entries[scan] for scan in scans if scan in self.entries}
+        return flag_outliers(metrics, self.threshold)
+
+    def filter_scans(self, scans: list, workers: int = 1) -> list:
+        self.update(scans, workers)
+        flags = self.get_flags(scans)
+        for scan, reasons in flags.items():
+            report(f"\u2718 Excluding {scan}: {', '.join(reasons)}")
+        report(
+            f"{len(scans) - len(flags)} of {len(scans)} scans passed quality control."
+        )
+        return [scan for scan in scans if scan not in flags]
+
+
+def run_quality_control(
+    stage: str = "skull_stripped",
+    scan_type: str = "t1",
+    workers: int = 1,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    quality_report: QualityReport = None,
+    catalog=None,
+) -> dict:
+    if stage not in QC_STAGES:
+        raise ValueError(f"Invalid stage {stage}! Use one of {QC_STAGES}.")
+    quality_report = quality_report or QualityReport()
+    scans = get_scans(LOCATION_DICT[stage], scan_type, catalog=catalog)
+    quality_report.update(scans, workers, memory_budget)
+    flags = quality_report.get_flags(scans)
+    for scan in scans:
+        entry = quality_report.entries[scan]
+        values = [entry.get(name) for name in ("mask_volume", "cv", "foreground_ratio")]
+        values = [float("nan") if value is None else value for value in values]
+        status = "\u2718" if scan in flags else "\u2714"
+        report(
+            f"{status} {scan.split('/')[-2]}\tmask {values[0]:.0f} ml\t"
+            f"cv {values[1]:.3f}\tfg/bg {values[2]:.1f}\t"
+            f"{', '.join(flags.get(scan, []))}"
+        )
+    report(f"Flagged {len(flags)} of {len(scans)} volumes.")
+    return flags
@@ -0,0 +1,147 @@
+import json
+import os
+
+import numpy as np
+
+from dao import strip_volume_extension
+from instrumentation import measure
+from mutual_information import (
+    calculate_bin_edges,
+    calculate_bin_indices,
+    calculate_histogram_mutual_information,
+    extract_series_data,
+)
+
+EDGE_MODES = ("fixed", "percentile")
+DEFAULT_PERCENTILES = (1, 99)
+BINCOUNT_CHUNK_SIZE = 2 ** 24
+
+
+def get_sidecar_base(series_path: str, bins: int, edge_mode: str) -> str:
+    base = strip_volume_extension(series_path)
+    return f"{base}.bins{bins}.{edge_mode}"
+
+
+def get_sidecar_paths(series_path: str, bins: int, edge_mode: str) -> tuple:
+    base = get_sidecar_base(series_path, bins, edge_mode)
+    return f"{base}.npy", f"{base}.json"
+
+
+def get_source_stamp(series_path: str) -> dict:
+    stat = os.stat(series_path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def calculate_percentile_edges(
+    data: np.ndarray, bins: int, percentiles: tuple = DEFAULT_PERCENTILES
+) -> np.ndarray:
+    low, high = np.percentile(data, percentiles)
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    return np.linspace(low, high, bins + 1)
+
+
+def quantize(
+    data: np.ndarray,
+    bins: int = 10,
+    edge_mode: str = "fixed",
+    percentiles: tuple = DEFAULT_PERCENTILES,
+) -> tuple:
+    # "fixed" reproduces np.histogram2d's min/max edges, so scores are identical
+    # to calculate_mutual_information; "percentile" clips outliers into the end
+    # bins.
+    if edge_mode == "fixed":
+        edges = calculate_bin_edges(data, bins)
+        indices = calculate_bin_indices(data, bins, edges)
+    elif edge_mode == "percentile":
+        edges = calculate_percentile_edges(data, bins, percentiles)
+        indices = np.searchsorted(edges[1:-1], data, side="right")
+    else:
+        raise ValueError(f"Invalid edge mode {edge_mode}! Use one of {EDGE_MODES}.")
+    dtype = np.uint8 if bins <= np.iinfo(np.uint8).max + 1 else np.uint16
+    return indices.astype(dtype), edges
+
+
+def is_fresh(series_path: str, bins: int = 10, edge_mode: str = "fixed") -> bool:
+    array_path, meta_path = get_sidecar_paths(series_path, bins, edge_mode)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+    return os.path.isfile(array_path) and meta["source"] == get_source_stamp(
+        series_path
+    )
+
+
+def write_sidecar(
+    series_path: str,
+    bins: int = 10,
+    edge_mode: str = "fixed",
+    percentiles: tuple = DEFAULT_PERCENTILES,
+) -> str:
+    array_path, meta_path = get_sidecar_paths(series_path, bins, edge_mode)
+    source = get_source_stamp(series_path)
+    indices, edges = quantize(
+        extract_series_data(series_path), bins, edge_mode, percentiles
+    )
+    # Write to temporary names and rename so readers never see partial files;
+    # the metadata goes last since it is what marks the sidecar as fresh.
+    tmp_array_path = f"{array_path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_array_path, indices)
+    os.replace(tmp_array_path, array_path)
+    meta = {
+        "source": source,
+        "bins": bins,
+        "edge_mode": edge_mode,
+        "edges": edges.tolist(),
+    }
+    tmp_meta_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_meta_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(tmp_meta_path, meta_path)
+    return array_path
+
+
+def load_binned_volume(
+    series_path: str,
+    bins: int = 10,
+    edge_mode: str = "fixed",
+    percentiles: tuple = DEFAULT_PERCENTILES,
+) -> np.ndarray:
+    if not is_fresh(series_path, bins, edge_mode):
+        write_sidecar(series_path, bins, edge_mode, percentiles)
+    array_path, _ = get_sidecar_paths(series_path, bins, edge_mode)
+    with measure("binned_load", path=array_path):
+        return np.load(array_path, mmap_mode="r")
+
+
+def calculate_binned_joint_histogram(
+    indices1: np.ndarray, indices2: np.ndarray, bins: int = 10
+) -> np.ndarray:
+    if indices1.shape != indices2.shape:
+        raise ValueError(
+            f"Cannot compare arrays of different shapes ({indices1.shape} and {indices2.shape})!"
+        )
+    # Chunks bound the temporary joint-index array when reading from memory maps.
+    histogram = np.zeros(bins * bins, dtype=np.int64)
+    for start in range(0, indices1.size, BINCOUNT_CHUNK_SIZE):
+        stop = start + BINCOUNT_CHUNK_SIZE
+        flat_indices = indices1[start:stop].astype(np.intp) * bins
+        flat_indices += indices2[start:stop]
+        histogram += np.bincount(flat_indices, minlength=bins * bins)
+    return histogram.reshape(bins, bins)
+
+
+def iterate_binned_mutual_information(
+    target_scan: str, scans: dict, bins: int = 10, edge_mode: str = "fixed"
+):
+    target_indices = load_binned_volume(target_scan, bins, edge_mode)
+    for subject_id, scan_path in scans.items():
+        scan_indices = load_binned_volume(scan_path, bins, edge_mode)
+        with measure("histogram", subject_id):
+            histogram = calculate_binned_joint_histogram(
+                target_indices, scan_indices, bins
+            )
+            score = calculate_histogram_mutual_information(histogram)
+        yield subject_id, score
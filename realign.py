@@ -1,7 +1,24 @@
 import os
 
-from dao import get_scans, LOCATION_DICT, get_target_scan, get_cost_function_dir
-from nipype.interfaces.fsl import FLIRT, FNIRT
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from dao import (
+    get_scans,
+    LOCATION_DICT,
+    get_target_scan,
+    get_cost_function_dir,
+    get_volume_extension,
+)
+from instrumentation import measure, report
+from output_commit import OutputCommit, is_complete
+from scheduler import Job
+from volume_format import (
+    finalize_volume,
+    fsl_readable,
+    get_fsl_output_path,
+    get_fsl_output_type,
+)
 
 
 SERIES_TYPE = "t1"
@@ -13,68 +30,331 @@ COST_FUNCTION_DICT = {
     "Least Squares": "leastsq",
     "Boundary-Based Registration": "bbr",
 }
+FLIRT_COMMAND = "flirt"
+FNIRT_COMMAND = "fnirt"
+
+RegistrationResult = namedtuple(
+    "RegistrationResult", ["subject_id", "status", "error"]
+)
 
 
 def create_results_directory(target_id: str, cost_function: str):
     results_location = get_cost_function_dir(target_id, cost_function)
-    print(f"Creating output directory in {results_location}...", end="\t")
+    report(f"Creating output directory in {results_location}...", end="\t")
     if os.path.isdir(results_location):
-        print(f"\nOutput directory already exists in {results_location}!")
+        report(f"\nOutput directory already exists in {results_location}!")
     else:
-        os.makedirs(results_location, exist_ok=False)
+        # Another process may create the directory between the check and here.
+        os.makedirs(results_location, exist_ok=True)
     return results_location
 
 
-def run_realign(target_id: str, cost_function: str):
-    target_scan = get_target_scan(target_id)
-    scans = get_scans(LOCATION_DICT["skull_stripped"], "t1")
-    output_dir = create_results_directory(target_id, cost_function)
-    for scan in scans:
-        subject_id = scan.split("/")[-2]
-        subject_results_dir = os.path.join(output_dir, subject_id)
+def get_linear_outputs(scan: str, output_dir: str) -> tuple:
+    subject_id = scan.split("/")[-2]
+    scan_name = os.path.basename(scan).split(".")[0]
+    subject_results_dir = os.path.join(output_dir, subject_id)
+    return (
+        os.path.join(subject_results_dir, scan_name + get_volume_extension()),
+        os.path.join(subject_results_dir, f"{scan_name}.mat"),
+    )
+
+
+def get_linear_params(cost_function: str, command: str = FLIRT_COMMAND) -> dict:
+    return {"cost_function": cost_function, "command": command}
+
+
+def create_flirt(
+    scan: str,
+    target_scan: str,
+    output_dir: str,
+    cost_function: str,
+    command: str = FLIRT_COMMAND,
+    outputs: tuple = None,
+):
+    from nipype.interfaces.fsl import FLIRT
+
+    flirt = FLIRT(command=command)
+    flirt.inputs.in_file = scan
+    flirt.inputs.reference = target_scan
+    flirt.inputs.cost = COST_FUNCTION_DICT[cost_function]
+    out_file, out_matrix_file = outputs or get_linear_outputs(scan, output_dir)
+    # FSL writes NIfTI; other intermediate formats are converted afterwards
+    # by finalize_volume.
+    flirt.inputs.output_type = get_fsl_output_type()
+    flirt.inputs.out_file = get_fsl_output_path(out_file)
+    flirt.inputs.out_matrix_file = out_matrix_file
+    return flirt
+
+
+def register_linear(
+    scan: str,
+    target_scan: str,
+    output_dir: str,
+    cost_function: str,
+    command: str = FLIRT_COMMAND,
+    overwrite: bool = False,
+) -> RegistrationResult:
+    subject_id = scan.split("/")[-2]
+    out_file, out_matrix_file = get_linear_outputs(scan, output_dir)
+    inputs, params = [scan, target_scan], get_linear_params(cost_function, command)
+    # Only a completion marker counts as done; a directory left by a crashed
+    # run is registered again.
+    if not overwrite and is_complete(out_file, inputs, params):
+        report(f"Results for {subject_id} found! Skipping...")
+        return RegistrationResult(subject_id, "skipped", None)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    scan_name = os.path.basename(scan).split(".")[0]
+    report(f"Registering {subject_id}'s {scan_name} to target...", end="\t")
+    try:
+        with OutputCommit(out_file, inputs, params) as commit:
+            tmp_out_file = commit.stage(out_file)
+            flirt = create_flirt(
+                scan,
+                target_scan,
+                output_dir,
+                cost_function,
+                command,
+                outputs=(tmp_out_file, commit.stage(out_matrix_file)),
+            )
+            commit.track(flirt.inputs.out_file)
+            with fsl_readable(scan) as in_file, fsl_readable(target_scan) as reference:
+                flirt.inputs.in_file, flirt.inputs.reference = in_file, reference
+                with measure("flirt", subject_id, cost_function=cost_function):
+                    flirt.run()
+            finalize_volume(flirt.inputs.out_file, tmp_out_file)
+    except Exception as e:
+        report(f"failed!\n{e}")
+        return RegistrationResult(subject_id, "failed", str(e))
+    report("done!")
+    return RegistrationResult(subject_id, "done", None)
+
+
+def get_nonlinear_outputs(scan: str, output_dir: str) -> tuple:
+    subject_id = scan.split("/")[-2]
+    scan_name = os.path.basename(scan).split(".")[0]
+    subject_results_dir = os.path.join(output_dir, subject_id)
+    return (
+        os.path.join(subject_results_dir, f"{scan_name}_warped.nii.gz"),
+        os.path.join(subject_results_dir, f"{scan_name}_field.nii.gz"),
+    )
+
+
+def register_nonlinear(
+    scan: str,
+    target_scan: str,
+    output_dir: str,
+    command: str = FNIRT_COMMAND,
+    overwrite: bool = False,
+) -> RegistrationResult:
+    from nipype.interfaces.fsl import FNIRT
+
+    subject_id = scan.split("/")[-2]
+    warped_file, field_file = get_nonlinear_outputs(scan, output_dir)
+    inputs, params = [scan, target_scan], {"command": command}
+    if not overwrite and is_complete(warped_file, inputs, params):
+        report(f"Results for {subject_id} found! Skipping...")
+        return RegistrationResult(subject_id, "skipped", None)
+    os.makedirs(os.path.dirname(warped_file), exist_ok=True)
+    scan_name = os.path.basename(scan).split(".")[0]
+    report(f"Registering {subject_id}'s {scan_name} to target...", end="\t")
+    try:
+        with OutputCommit(warped_file, inputs, params) as commit:
+            fnirt = FNIRT(command=command)
+            fnirt.inputs.warped_file = commit.stage(warped_file)
+            fnirt.inputs.field_file = commit.stage(field_file)
+            with fsl_readable(scan) as in_file, fsl_readable(target_scan) as ref_file:
+                fnirt.inputs.in_file, fnirt.inputs.ref_file = in_file, ref_file
+                with measure("fnirt", subject_id):
+                    fnirt.run()
+    except Exception as e:
+        report(f"failed!\n{e}")
+        return RegistrationResult(subject_id, "failed", str(e))
+    report("done!")
+    return RegistrationResult(subject_id, "done", None)
+
+
+def summarize_registrations(results: dict) -> dict:
+    failed = [result for result in results.values() if result.status == "failed"]
+    done = sum(result.status == "done" for result in results.values())
+    report(
+        f"Registered {done} subjects, skipped {len(results) - done - len(failed)}, {len(failed)} failed."
+    )
+    for result in failed:
+        report(f"\u2718 {result.subject_id}: {result.error}")
+    return results
+
+
+def run_registrations(register, scans: list, workers: int = 1, **kwargs) -> dict:
+    results = dict()
+    if workers == 1:
+        for scan in scans:
+            result = register(scan, **kwargs)
+            results[result.subject_id] = result
+        return summarize_registrations(results)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(register, scan, **kwargs): scan for scan in scans}
+        for future in as_completed(futures):
+            subject_id = futures[future].split("/")[-2]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = RegistrationResult(subject_id, "failed", str(e))
+            results[result.subject_id] = result
+    return summarize_registrations(results)
+
+
+def run_scheduled_registrations(
+    scheduler,
+    scans: list,
+    target_scan: str,
+    output_dir: str,
+    cost_function: str,
+    command: str = FLIRT_COMMAND,
+) -> dict:
+    results = dict()
+    jobs = []
+    outputs = dict()
+    commits = dict()
+    params = get_linear_params(cost_function, command)
+    # Expanded chunked inputs must outlive the scheduled jobs that read them.
+    with ExitStack() as fsl_inputs:
+        reference = fsl_inputs.enter_context(fsl_readable(target_scan))
+        for scan in scans:
+            subject_id = scan.split("/")[-2]
+            out_file, out_matrix_file = get_linear_outputs(scan, output_dir)
+            if is_complete(out_file, [scan, target_scan], params):
+                report(f"Results for {subject_id} found! Skipping...")
+                results[subject_id] = RegistrationResult(subject_id, "skipped", None)
+                continue
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+            commit = OutputCommit(out_file, [scan, target_scan], params).begin()
+            tmp_out_file = commit.stage(out_file)
+            tmp_matrix_file = commit.stage(out_matrix_file)
+            flirt = create_flirt(
+                scan,
+                target_scan,
+                output_dir,
+                cost_function,
+                command,
+                outputs=(tmp_out_file, tmp_matrix_file),
+            )
+            commit.track(flirt.inputs.out_file)
+            flirt.inputs.in_file = fsl_inputs.enter_context(fsl_readable(scan))
+            flirt.inputs.reference = reference
+            outputs[subject_id] = (flirt.inputs.out_file, tmp_out_file)
+            commits[subject_id] = commit
+            job = Job.from_interface(
+                subject_id,
+                "flirt",
+                flirt,
+                outputs=[flirt.inputs.out_file, tmp_matrix_file],
+            )
+            jobs.append(job)
+        job_results = scheduler.run(jobs)
+    for subject_id, job_result in job_results.items():
+        status = "done" if job_result.status == "done" else "failed"
+        error = job_result.error
         try:
-            os.makedirs(subject_results_dir, exist_ok=False)
-        except FileExistsError:
-            print(f"Results for {subject_id} found! Skipping...")
-            continue
-        scan_name = os.path.basename(scan).split(".")[0]
-        print(f"Registering {subject_id}'s {scan_name} to target...", end="\t")
-        flirt = FLIRT()
-        flirt.inputs.in_file = scan
-        flirt.inputs.reference = target_scan
-        flirt.inputs.cost = COST_FUNCTION_DICT[cost_function]
-        flirt.inputs.out_file = os.path.join(subject_results_dir, f"{scan_name}.nii.gz")
-        flirt.inputs.out_matrix_file = os.path.join(
-            subject_results_dir, f"{scan_name}.mat"
-        )
-        flirt.run()
-        print("done!")
+            if status == "done":
+                finalize_volume(*outputs[subject_id])
+            commits[subject_id].finish(status == "done")
+        except Exception as e:
+            commits[subject_id].finish(False)
+            status, error = "failed", str(e)
+        results[subject_id] = RegistrationResult(subject_id, status, error)
+    return summarize_registrations(results)
 
 
-def run_nonlinear_registration(target_id: str):
-    target_scan = get_target_scan(target_id)
-    scans = get_scans(LOCATION_DICT["skull_stripped"], "t1")
-    output_dir = create_results_directory(target_id, "NonlinearSSD")
+def publish_registrations(
+    queue,
+    scans: list,
+    target_id: str,
+    target_scan: str,
+    output_dir: str,
+    cost_function: str,
+    command: str = FLIRT_COMMAND,
+) -> dict:
+    from work_queue import get_realign_key
 
+    results = dict()
+    params = get_linear_params(cost_function, command)
     for scan in scans:
         subject_id = scan.split("/")[-2]
-        subject_results_dir = os.path.join(output_dir, subject_id)
-        try:
-            os.makedirs(subject_results_dir, exist_ok=False)
-        except FileExistsError:
-            if os.listdir(subject_results_dir):
-                print(f"Results for {subject_id} found! Skipping...")
-                continue
-        scan_name = os.path.basename(scan).split(".")[0]
-        print(f"Registering {subject_id}'s {scan_name} to target...", end="\t")
-        fnirt = FNIRT()
-        fnirt.inputs.in_file = scan
-        fnirt.inputs.ref_file = target_scan
-        fnirt.inputs.warped_file = os.path.join(
-            subject_results_dir, f"{scan_name}_warped.nii.gz"
+        out_file, _ = get_linear_outputs(scan, output_dir)
+        if is_complete(out_file, [scan, target_scan], params):
+            report(f"Results for {subject_id} found! Skipping...")
+            results[subject_id] = RegistrationResult(subject_id, "skipped", None)
+            continue
+        payload = {
+            "scan": scan,
+            "target_scan": target_scan,
+            "output_dir": output_dir,
+            "cost_function": cost_function,
+            "command": command,
+            "subject_id": subject_id,
+        }
+        key = get_realign_key(target_id, cost_function, subject_id)
+        queue.publish(key, "realign", payload)
+        results[subject_id] = RegistrationResult(subject_id, "queued", None)
+    queued = sum(result.status == "queued" for result in results.values())
+    report(f"Queued {queued} registrations.")
+    return results
+
+
+def run_realign(
+    target_id: str,
+    cost_function: str,
+    workers: int = 1,
+    command: str = FLIRT_COMMAND,
+    catalog=None,
+    scheduler=None,
+    queue=None,
+    subject_ids: list = None,
+    manifest=None,
+    quality_control=None,
+) -> dict:
+    target_scan = get_target_scan(target_id)
+    if manifest is None:
+        scans = get_scans(LOCATION_DICT["skull_stripped"], "t1", catalog=catalog)
+    else:
+        scans = manifest.get_planned_scans(LOCATION_DICT["skull_stripped"], "t1")
+    if subject_ids is not None:
+        subject_ids = set(subject_ids)
+        scans = [scan for scan in scans if scan.split("/")[-2] in subject_ids]
+    if quality_control is not None:
+        # Scans flagged against the rest of the cohort are not realigned.
+        scans = quality_control.filter_scans(scans, workers)
+    output_dir = create_results_directory(target_id, cost_function)
+    if queue is not None:
+        return publish_registrations(
+            queue, scans, target_id, target_scan, output_dir, cost_function, command
         )
-        fnirt.inputs.field_file = os.path.join(
-            subject_results_dir, f"{scan_name}_warped.nii.gz"
+    if scheduler is not None:
+        return run_scheduled_registrations(
+            scheduler, scans, target_scan, output_dir, cost_function, command
         )
-        fnirt.run()
-        print("done!")
+    return run_registrations(
+        register_linear,
+        scans,
+        workers,
+        target_scan=target_scan,
+        output_dir=output_dir,
+        cost_function=cost_function,
+        command=command,
+    )
+
+
+def run_nonlinear_registration(
+    target_id: str, workers: int = 1, command: str = FNIRT_COMMAND, catalog=None
+) -> dict:
+    target_scan = get_target_scan(target_id)
+    scans = get_scans(LOCATION_DICT["skull_stripped"], "t1", catalog=catalog)
+    output_dir = create_results_directory(target_id, "NonlinearSSD")
+    return run_registrations(
+        register_nonlinear,
+        scans,
+        workers,
+        target_scan=target_scan,
+        output_dir=output_dir,
+        command=command,
+    )
@@ -0,0 +1,98 @@
+import json
+import os
+
+LOCK_FILE_SUFFIX = ".lock"
+
+
+class ResultLog:
+    # Records carry the parameters they were computed with; a log opened with
+    # params only yields records computed the same way.
+    def __init__(self, path: str, params: dict = None):
+        self.path = path
+        self.params = params
+
+    def lock(self):
+        from results_store import exclusive_lock
+
+        # Appends may come from workers on several nodes, where O_APPEND alone
+        # does not keep their writes apart.
+        return exclusive_lock(self.path + LOCK_FILE_SUFFIX)
+
+    def repair(self):
+        # A crash mid-append can leave a partial last line; trim it so the next
+        # record starts on a fresh line. Only safe while holding the lock, as
+        # the last line may otherwise be another writer's append in progress.
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "rb+") as log_file:
+            if log_file.seek(0, os.SEEK_END) == 0:
+                return
+            log_file.seek(-1, os.SEEK_END)
+            if log_file.read(1) == b"\n":
+                return
+            log_file.seek(0)
+            content = log_file.read()
+            log_file.truncate(content.rfind(b"\n") + 1)
+
+    def append(self, subject_id: str, value):
+        record = {"subject_id": subject_id, "value": value}
+        if self.params is not None:
+            record["params"] = self.params
+        line = json.dumps(record) + "\n"
+        with self.lock():
+            self.repair()
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def iterate_records(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r") as log_file:
+            for line in log_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def matches(self, record: dict) -> bool:
+        return self.params is None or record.get("params") == self.params
+
+    def iterate(self):
+        for record in self.iterate_records():
+            if self.matches(record):
+                yield record["subject_id"], record["value"]
+
+    def count_other_params(self) -> int:
+        # Records written before parameters were logged have none, so they
+        # count as computed differently.
+        return sum(not self.matches(record) for record in self.iterate_records())
+
+    def to_dict(self) -> dict:
+        return dict(self.iterate())
+
+    def completed(self) -> set:
+        return {subject_id for subject_id, _ in self.iterate()}
+
+    def discard(self):
+        # Drops the records computed with this log's parameters. The log is
+        # shared by every stage writing to it, so records computed with other
+        # parameters are kept.
+        if not os.path.isfile(self.path):
+            return
+        with self.lock():
+            kept = [
+                record for record in self.iterate_records() if not self.matches(record)
+            ]
+            if not kept:
+                os.remove(self.path)
+                return
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as log_file:
+                log_file.writelines(json.dumps(record) + "\n" for record in kept)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            os.replace(tmp_path, self.path)
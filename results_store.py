@@ -0,0 +1,207 @@
+import fcntl
+import glob
+import os
+import pandas as pd
+
+from contextlib import contextmanager
+
+from dao import (
+    COST_FUNCTION_DICT,
+    format_cost_function_name,
+    get_costs_file_path,
+    get_mutual_information_file_path,
+    get_results_store_dir,
+)
+from instrumentation import report
+
+COLUMNS = ["subject_id", "cost_function", "metric", "value"]
+PARTITION_FILE_NAME = "part.parquet"
+PARTITION_LOCK_FILE_NAME = ".lock"
+MUTUAL_INFORMATION_METRIC = "Mutual Information"
+COST_METRIC = "Realignment Cost"
+# Native costs approximate FLIRT's rather than reproduce them, so they are
+# stored as a metric of their own.
+NATIVE_COST_METRIC = "Realignment Cost (native)"
+
+
+def get_partition_dir(target_id: str, cost_function: str, store_dir: str = None) -> str:
+    store_dir = store_dir or get_results_store_dir()
+    cost_function = format_cost_function_name(cost_function)
+    return os.path.join(
+        store_dir, f"target_id={target_id}", f"cost_function={cost_function}"
+    )
+
+
+@contextmanager
+def exclusive_lock(path: str):
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def lock_partition(target_id: str, cost_function: str, store_dir: str = None):
+    # Writers of a partition take turns, so one writer's read-modify-write
+    # cannot drop the rows another just wrote.
+    partition_dir = get_partition_dir(target_id, cost_function, store_dir)
+    os.makedirs(partition_dir, exist_ok=True)
+    with exclusive_lock(os.path.join(partition_dir, PARTITION_LOCK_FILE_NAME)):
+        yield partition_dir
+
+
+def save_partition(results: pd.DataFrame, partition_dir: str, cost_function: str):
+    path = os.path.join(partition_dir, PARTITION_FILE_NAME)
+    results = results.assign(cost_function=cost_function)[COLUMNS]
+    results = results.astype({"subject_id": str, "metric": str, "value": float})
+    # The pinned pandas (0.23) has no to_parquet(index=False); a default index
+    # is stored as a plain range either way.
+    results = results.reset_index(drop=True)
+    # Readers only ever see a complete file.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    results.to_parquet(tmp_path, engine="pyarrow")
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_partition(
+    results: pd.DataFrame, target_id: str, cost_function: str, store_dir: str = None
+) -> str:
+    with lock_partition(target_id, cost_function, store_dir) as partition_dir:
+        return save_partition(results, partition_dir, cost_function)
+
+
+def write_metric(
+    values: dict,
+    target_id: str,
+    cost_function: str,
+    metric: str,
+    store_dir: str = None,
+) -> str:
+    # Replaces this metric's rows in the partition, keeping any other metric.
+    with lock_partition(target_id, cost_function, store_dir) as partition_dir:
+        try:
+            existing = read_results(
+                target_id, cost_function, store_dir=store_dir, with_target=False
+            )
+            existing = existing[existing["metric"] != metric]
+        except FileNotFoundError:
+            existing = pd.DataFrame(columns=COLUMNS)
+        new = pd.DataFrame(
+            {
+                "subject_id": list(values.keys()),
+                "cost_function": cost_function,
+                "metric": metric,
+                "value": list(values.values()),
+            },
+            columns=COLUMNS,
+        )
+        results = pd.concat([existing, new], ignore_index=True)
+        return save_partition(results, partition_dir, cost_function)
+
+
+def read_results(
+    target_id: str = None,
+    cost_function: str = None,
+    subject_id=None,
+    metric=None,
+    store_dir: str = None,
+    with_target: bool = True,
+) -> pd.DataFrame:
+    store_dir = store_dir or get_results_store_dir()
+    target_pattern = f"target_id={target_id}" if target_id else "target_id=*"
+    cost_function_pattern = (
+        f"cost_function={format_cost_function_name(cost_function)}"
+        if cost_function
+        else "cost_function=*"
+    )
+    paths = sorted(
+        glob.glob(
+            os.path.join(
+                store_dir, target_pattern, cost_function_pattern, PARTITION_FILE_NAME
+            )
+        )
+    )
+    if not paths:
+        raise FileNotFoundError(f"No results found in {store_dir}!")
+    frames = []
+    for path in paths:
+        # Partitions are picked by their directory names above and rows are
+        # filtered here: the pinned pandas (0.23) and pyarrow (0.11) cannot push
+        # row predicates down to the Parquet reader.
+        frame = pd.read_parquet(path, engine="pyarrow")
+        for column, value in (("subject_id", subject_id), ("metric", metric)):
+            if value is None:
+                continue
+            if isinstance(value, str):
+                frame = frame[frame[column] == value]
+            else:
+                frame = frame[frame[column].isin(list(value))]
+        if with_target:
+            partition_target = os.path.basename(
+                os.path.dirname(os.path.dirname(path))
+            ).split("=", 1)[1]
+            frame.insert(0, "target_id", partition_target)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_results_frame(
+    target_id: str,
+    subject_id=None,
+    cost_function: str = None,
+    metric=None,
+    store_dir: str = None,
+) -> pd.DataFrame:
+    results = read_results(
+        target_id, cost_function, subject_id, metric, store_dir, with_target=False
+    )
+    return results.set_index(["subject_id", "cost_function", "metric"]).sort_index()
+
+
+def get_all_results(target_id: str, store_dir: str = None) -> pd.DataFrame:
+    results = read_results(
+        target_id, metric=MUTUAL_INFORMATION_METRIC, store_dir=store_dir
+    )
+    frame = results.pivot(index="subject_id", columns="cost_function", values="value")
+    frame.index.name = "Subject ID"
+    return frame
+
+
+def migrate_pickles(target_id: str, store_dir: str = None) -> list:
+    written = []
+    for cost_function in COST_FUNCTION_DICT.values():
+        legacy_files = (
+            (get_mutual_information_file_path, MUTUAL_INFORMATION_METRIC),
+            (get_costs_file_path, COST_METRIC),
+            (
+                lambda *args: get_costs_file_path(*args, native=True),
+                NATIVE_COST_METRIC,
+            ),
+        )
+        for get_path, metric in legacy_files:
+            path = get_path(target_id, cost_function)
+            if not os.path.isfile(path):
+                continue
+            values = pd.read_pickle(path)
+            if isinstance(values, pd.Series):
+                values = values.to_dict()
+            written.append(
+                write_metric(values, target_id, cost_function, metric, store_dir)
+            )
+            report(f"Migrated {path} \u2714")
+    return written
+
+
+def migrate_results_frame(path: str, target_id: str, store_dir: str = None) -> list:
+    # Frames indexed by (subject, cost function, metric) with the value in the
+    # first column, as read by plot_cost.
+    results = pd.read_pickle(path)
+    results = results.iloc[:, 0].rename("value").reset_index()
+    results.columns = COLUMNS
+    written = []
+    for cost_function, partition in results.groupby("cost_function"):
+        written.append(write_partition(partition, target_id, cost_function, store_dir))
+    return written
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import signal
+import time
+
+from collections import namedtuple
+
+from instrumentation import report
+
+TOOL_LIMITS = {"bet": 8, "fast": 4, "flirt": 8, "fnirt": 2}
+# Rough resident memory per job in MB, used against the scheduler's budget.
+TOOL_MEMORY = {"bet": 512, "fast": 2048, "flirt": 1024, "fnirt": 4096}
+DEFAULT_TIMEOUT = 60 * 60
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 5
+
+JobResult = namedtuple(
+    "JobResult", ["key", "status", "attempts", "returncode", "stdout", "error"]
+)
+
+
+class Job:
+    def __init__(
+        self,
+        key: str,
+        tool: str,
+        command: str,
+        outputs: list = (),
+        timeout: float = None,
+        memory: int = None,
+        environ: dict = None,
+    ):
+        self.key = key
+        self.tool = tool
+        self.command = command
+        self.outputs = list(outputs)
+        self.timeout = timeout
+        self.memory = memory if memory is not None else TOOL_MEMORY.get(tool, 0)
+        self.environ = dict(environ or {})
+
+    @classmethod
+    def from_interface(cls, key: str, tool: str, interface, **kwargs):
+        # nipype builds the exact command line it would run itself, and sets
+        # variables such as FSLOUTPUTTYPE in the interface's environment.
+        kwargs.setdefault("environ", interface.inputs.environ)
+        return cls(key, tool, interface.cmdline, **kwargs)
+
+
+class FslScheduler:
+    def __init__(
+        self,
+        limits: dict = None,
+        memory_budget: int = None,
+        timeout: float = DEFAULT_TIMEOUT,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+    ):
+        self.limits = dict(TOOL_LIMITS, **(limits or {}))
+        self.memory_budget = memory_budget
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def run(self, jobs: list) -> dict:
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(self.run_jobs(jobs))
+        finally:
+            loop.close()
+        failed = [result for result in results if result.status != "done"]
+        report(f"{len(results) - len(failed)} jobs done, {len(failed)} failed.")
+        for result in failed:
+            report(f"\u2718 {result.key} ({result.status}): {result.error}")
+        return {result.key: result for result in results}
+
+    async def run_jobs(self, jobs: list) -> list:
+        # Synchronization primitives are created here so they bind to the loop
+        # that runs them.
+        self.semaphores = {
+            tool: asyncio.Semaphore(limit) for tool, limit in self.limits.items()
+        }
+        self.memory_available = self.memory_budget
+        self.memory_condition = asyncio.Condition()
+        return await asyncio.gather(*[self.run_job(job) for job in jobs])
+
+    async def acquire_memory(self, amount: int):
+        if self.memory_budget is None:
+            return
+        # A job larger than the whole budget still runs, alone.
+        amount = min(amount, self.memory_budget)
+        async with self.memory_condition:
+            while self.memory_available < amount:
+                await self.memory_condition.wait()
+            self.memory_available -= amount
+
+    async def release_memory(self, amount: int):
+        if self.memory_budget is None:
+            return
+        amount = min(amount, self.memory_budget)
+        async with self.memory_condition:
+            self.memory_available += amount
+            self.memory_condition.notify_all()
+
+    async def run_job(self, job: Job) -> JobResult:
+        semaphore = self.semaphores.setdefault(job.tool, asyncio.Semaphore(1))
+        timeout = job.timeout or self.timeout
+        result = None
+        for attempt in range(1, self.retries + 2):
+            async with semaphore:
+                await self.acquire_memory(job.memory)
+                try:
+                    result = await self.execute(job, timeout, attempt)
+                finally:
+                    await self.release_memory(job.memory)
+            if result.status == "done":
+                return result
+            if attempt <= self.retries:
+                delay = self.backoff * 2 ** (attempt - 1)
+                report(f"{job.key} {result.status}, retrying in {delay}s...")
+                await asyncio.sleep(delay)
+        return result
+
+    async def execute(self, job: Job, timeout: float, attempt: int) -> JobResult:
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_shell(
+            job.command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env={**os.environ, **job.environ},
+            start_new_session=True,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            # The command runs under a shell, so kill its whole process group.
+            os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+            return JobResult(
+                job.key, "timeout", attempt, None, None, f"Timed out after {timeout}s"
+            )
+        stdout = stdout.decode(errors="replace")
+        if process.returncode != 0:
+            error = stderr.decode(errors="replace").strip()
+            error = error or f"Exited with code {process.returncode}"
+            return JobResult(
+                job.key, "failed", attempt, process.returncode, stdout, error
+            )
+        missing = [path for path in job.outputs if not os.path.isfile(path)]
+        if missing:
+            return JobResult(
+                job.key,
+                "failed",
+                attempt,
+                process.returncode,
+                stdout,
+                f"Missing outputs: {missing}",
+            )
+        report(f"\u2714 {job.key} ({time.perf_counter() - start:.1f}s)")
+        return JobResult(job.key, "done", attempt, process.returncode, stdout, None)
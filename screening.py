@@ -0,0 +1,195 @@
+from collections import namedtuple
+
+import numpy as np
+
+from dao import (
+    generate_subject_dirs,
+    get_mutual_information_log_path,
+    get_realigned_subject_data,
+    get_target_scan,
+)
+from instrumentation import measure, report
+from mutual_information import (
+    calculate_bin_indices,
+    calculate_histogram_mutual_information,
+    calculate_joint_histogram,
+    get_mutual_information_params,
+    iterate_batch_mutual_information,
+)
+from result_log import ResultLog
+from volume_format import load_data
+
+MASK_MODES = ("target", "nonzero", "none")
+DOWNSAMPLE_METHODS = ("stride", "block")
+DEFAULT_TOP_K = 10
+DEFAULT_CALIBRATION_SIZE = 10
+
+ScreeningResult = namedtuple("ScreeningResult", ["estimates", "exact", "errors"])
+
+
+def load_volume(series_path: str) -> np.ndarray:
+    with measure("nifti_load", path=series_path):
+        return load_data(series_path)
+
+
+def downsample(volume: np.ndarray, factor: int = 1, method: str = "stride"):
+    if factor == 1:
+        return volume
+    if method == "stride":
+        return volume[(slice(None, None, factor),) * volume.ndim]
+    elif method == "block":
+        # Trailing voxels that do not fill a whole block are dropped.
+        shape = [size // factor for size in volume.shape]
+        volume = volume[tuple(slice(0, size * factor) for size in shape)]
+        blocks = volume.reshape([dim for size in shape for dim in (size, factor)])
+        return blocks.mean(axis=tuple(range(1, blocks.ndim, 2)))
+    raise ValueError(
+        f"Invalid downsampling method {method}! Use one of {DOWNSAMPLE_METHODS}."
+    )
+
+
+def create_mask(
+    target_data: np.ndarray, scan_data: np.ndarray = None, mode: str = "target"
+) -> np.ndarray:
+    # Skull-stripping leaves the background at exactly zero, so non-zero
+    # voxels are the brain.
+    if mode == "target":
+        return target_data != 0
+    elif mode == "nonzero":
+        return (target_data != 0) | (scan_data != 0)
+    elif mode == "none":
+        return None
+    raise ValueError(f"Invalid mask mode {mode}! Use one of {MASK_MODES}.")
+
+
+def calculate_screening_mutual_information(
+    target_data: np.ndarray,
+    scan_data: np.ndarray,
+    bins: int = 10,
+    mask: str = "target",
+    factor: int = 1,
+    method: str = "stride",
+) -> np.float64:
+    if target_data.shape != scan_data.shape:
+        raise ValueError(
+            f"Cannot compare arrays of different shapes ({target_data.shape} and {scan_data.shape})!"
+        )
+    target_data = downsample(target_data, factor, method)
+    scan_data = downsample(scan_data, factor, method)
+    voxels = create_mask(target_data, scan_data, mode=mask)
+    if voxels is None:
+        target_values, scan_values = target_data.ravel(), scan_data.ravel()
+    else:
+        target_values, scan_values = target_data[voxels], scan_data[voxels]
+    histogram = calculate_joint_histogram(
+        calculate_bin_indices(target_values, bins),
+        calculate_bin_indices(scan_values, bins),
+        bins,
+    )
+    return calculate_histogram_mutual_information(histogram)
+
+
+def calculate_ranks(values: np.ndarray) -> np.ndarray:
+    # Average ranks for ties, as used by Spearman's correlation.
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return (np.cumsum(counts) - (counts + 1) / 2)[inverse]
+
+
+def calculate_screening_errors(estimates: dict, exact: dict) -> dict:
+    subject_ids = [subject_id for subject_id in exact if subject_id in estimates]
+    estimated = np.array([estimates[subject_id] for subject_id in subject_ids])
+    measured = np.array([exact[subject_id] for subject_id in subject_ids])
+    errors = {"n_compared": len(subject_ids)}
+    if not subject_ids:
+        return errors
+    absolute_errors = np.abs(estimated - measured)
+    errors["mean_absolute_error"] = float(absolute_errors.mean())
+    errors["max_absolute_error"] = float(absolute_errors.max())
+    # Screening estimates are biased by the mask, so what matters for triage
+    # is whether they rank candidates the same way the full computation does.
+    if len(subject_ids) > 1:
+        errors["rank_correlation"] = float(
+            np.corrcoef(calculate_ranks(estimated), calculate_ranks(measured))[0, 1]
+        )
+    return errors
+
+
+def select_calibration_subjects(ranking: list, size: int) -> list:
+    # Spread across the whole ranking rather than only its head, so the error
+    # is measured on good and bad registrations alike.
+    if size >= len(ranking):
+        return list(ranking)
+    positions = np.linspace(0, len(ranking) - 1, size).round().astype(int)
+    return [ranking[position] for position in sorted(set(positions))]
+
+
+def screen_mutual_information(
+    target_id: str,
+    cost_function: str,
+    bins: int = 10,
+    mask: str = "target",
+    factor: int = 2,
+    method: str = "stride",
+    top_k: int = DEFAULT_TOP_K,
+    calibration_size: int = DEFAULT_CALIBRATION_SIZE,
+    serialize: bool = True,
+    catalog=None,
+) -> ScreeningResult:
+    target_scan = get_target_scan(target_id)
+    realigned_scans = dict()
+    for subject_dir in generate_subject_dirs(
+        "realigned", target_id, cost_function, catalog=catalog
+    ):
+        subject_id = subject_dir.split("/")[-2]
+        realigned_scan_path = get_realigned_subject_data(
+            target_id, cost_function, subject_id, include_mat=False, catalog=catalog
+        )
+        if realigned_scan_path is not None:
+            realigned_scans[subject_id] = realigned_scan_path
+    report(
+        f"\nScreening {len(realigned_scans)} registrations to {target_id} after {cost_function} realignment..."
+    )
+    target_data = load_volume(target_scan)
+    estimates = dict()
+    for subject_id, realigned_scan_path in realigned_scans.items():
+        scan_data = load_volume(realigned_scan_path)
+        with measure("screening", subject_id):
+            estimates[subject_id] = calculate_screening_mutual_information(
+                target_data, scan_data, bins, mask, factor, method
+            )
+    ranking = sorted(estimates, key=estimates.get, reverse=True)
+    selected = ranking[:top_k]
+    selected += [
+        subject_id
+        for subject_id in select_calibration_subjects(ranking, calibration_size)
+        if subject_id not in selected
+    ]
+
+    # Exact scores already logged by a full run are reused.
+    log = ResultLog(
+        get_mutual_information_log_path(target_id, cost_function),
+        get_mutual_information_params(bins),
+    )
+    exact = {
+        subject_id: score
+        for subject_id, score in log.iterate()
+        if subject_id in selected
+    }
+    missing_scans = {
+        subject_id: realigned_scans[subject_id]
+        for subject_id in selected
+        if subject_id not in exact
+    }
+    report(f"Scoring {len(missing_scans)} candidates at full resolution...")
+    for subject_id, score in iterate_batch_mutual_information(
+        target_scan, missing_scans, bins
+    ):
+        exact[subject_id] = float(score)
+        if serialize:
+            log.append(subject_id, float(score))
+
+    errors = calculate_screening_errors(estimates, exact)
+    report(f"Screening error against the full computation: {errors}")
+    for subject_id in ranking[:top_k]:
+        report(f"{subject_id}\t{estimates[subject_id]:.4f}\t{exact[subject_id]:.4f}")
+    return ScreeningResult(estimates, exact, errors)
@@ -0,0 +1,263 @@
+import numpy as np
+import pandas as pd
+
+from dao import (
+    COST_FUNCTION_DICT,
+    generate_subject_dirs,
+    get_realigned_subject_data,
+    get_target_scan,
+)
+from mutual_information import (
+    DEFAULT_MEMORY_BUDGET,
+    calculate_bin_indices,
+    calculate_histogram_mutual_information,
+    calculate_joint_histogram,
+    calculate_range_bin_edges,
+    extract_series_data,
+    iterate_series_slabs,
+)
+
+SUM_OF_SQUARED_DIFFERENCES = "Sum of Squared Differences"
+SIMILARITY_METRICS = (
+    COST_FUNCTION_DICT["MutualInformation"],
+    COST_FUNCTION_DICT["NormalizedMutualInformation"],
+    COST_FUNCTION_DICT["CorrelationRatio"],
+    COST_FUNCTION_DICT["NormalizedCorrelation"],
+    COST_FUNCTION_DICT["LeastSquares"],
+    SUM_OF_SQUARED_DIFFERENCES,
+)
+
+
+def calculate_entropy(counts: np.ndarray) -> float:
+    probabilities = counts[counts > 0] / counts.sum()
+    return float(-np.sum(probabilities * np.log(probabilities)))
+
+
+class SimilarityAccumulator:
+    def __init__(self, bins: int = 10):
+        self.bins = bins
+        self.histogram = np.zeros((bins, bins), dtype=np.int64)
+        # Per target-bin count, sum and sum of squares of the scan intensities,
+        # for the correlation ratio.
+        self.bin_sums = np.zeros(bins)
+        self.bin_square_sums = np.zeros(bins)
+        self.n = 0
+        self.sum_x = self.sum_y = 0.0
+        self.sum_xx = self.sum_yy = self.sum_xy = 0.0
+        self.ssd = 0.0
+
+    def update(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        x_indices: np.ndarray,
+        y_indices: np.ndarray,
+    ):
+        x = x.astype(np.float64, copy=False)
+        y = y.astype(np.float64, copy=False)
+        self.histogram += calculate_joint_histogram(x_indices, y_indices, self.bins)
+        valid = x_indices >= 0
+        self.bin_sums += np.bincount(
+            x_indices[valid], weights=y[valid], minlength=self.bins
+        )
+        self.bin_square_sums += np.bincount(
+            x_indices[valid], weights=y[valid] ** 2, minlength=self.bins
+        )
+        self.n += x.size
+        self.sum_x += x.sum()
+        self.sum_y += y.sum()
+        self.sum_xx += np.dot(x, x)
+        self.sum_yy += np.dot(y, y)
+        self.sum_xy += np.dot(x, y)
+        difference = x - y
+        self.ssd += np.dot(difference, difference)
+
+    def mutual_information(self) -> float:
+        return float(calculate_histogram_mutual_information(self.histogram))
+
+    def normalized_mutual_information(self) -> float:
+        # Studholme's (H(X) + H(Y)) / H(X, Y), as used by FLIRT's normmi.
+        joint_entropy = calculate_entropy(self.histogram.ravel())
+        if joint_entropy == 0:
+            return np.nan
+        marginal_entropies = calculate_entropy(
+            self.histogram.sum(axis=1)
+        ) + calculate_entropy(self.histogram.sum(axis=0))
+        return marginal_entropies / joint_entropy
+
+    def correlation_ratio(self) -> float:
+        # Share of the scan's variance explained by the target's intensity bins.
+        counts = self.histogram.sum(axis=1)
+        n = counts.sum()
+        total_variance = self.bin_square_sums.sum() / n - (self.bin_sums.sum() / n) ** 2
+        if total_variance <= 0:
+            return np.nan
+        occupied = counts > 0
+        within_variance = (
+            self.bin_square_sums[occupied]
+            - self.bin_sums[occupied] ** 2 / counts[occupied]
+        ).sum() / n
+        return 1 - within_variance / total_variance
+
+    def normalized_correlation(self) -> float:
+        n = self.n
+        covariance = self.sum_xy - self.sum_x * self.sum_y / n
+        variance_x = self.sum_xx - self.sum_x ** 2 / n
+        variance_y = self.sum_yy - self.sum_y ** 2 / n
+        if variance_x <= 0 or variance_y <= 0:
+            return np.nan
+        return covariance / np.sqrt(variance_x * variance_y)
+
+    def results(self) -> dict:
+        return {
+            COST_FUNCTION_DICT["MutualInformation"]: self.mutual_information(),
+            COST_FUNCTION_DICT[
+                "NormalizedMutualInformation"
+            ]: self.normalized_mutual_information(),
+            COST_FUNCTION_DICT["CorrelationRatio"]: self.correlation_ratio(),
+            COST_FUNCTION_DICT["NormalizedCorrelation"]: self.normalized_correlation(),
+            COST_FUNCTION_DICT["LeastSquares"]: self.ssd / self.n,
+            SUM_OF_SQUARED_DIFFERENCES: self.ssd,
+        }
+
+
+def load_mask(mask) -> np.ndarray:
+    if mask is None:
+        return None
+    if isinstance(mask, str):
+        mask = extract_series_data(mask)
+    return np.asarray(mask).ravel() != 0
+
+
+def calculate_similarity_metrics(
+    target_data: np.ndarray,
+    scan_data: np.ndarray,
+    bins: int = 10,
+    mask: np.ndarray = None,
+    target_indices: np.ndarray = None,
+) -> dict:
+    if mask is not None:
+        target_data, scan_data = target_data[mask], scan_data[mask]
+        if target_indices is not None:
+            target_indices = target_indices[mask]
+    if target_indices is None:
+        target_indices = calculate_bin_indices(target_data, bins)
+    accumulator = SimilarityAccumulator(bins)
+    accumulator.update(
+        target_data, scan_data, target_indices, calculate_bin_indices(scan_data, bins)
+    )
+    return accumulator.results()
+
+
+def iterate_masked_slabs(
+    series_path: str, mask_path: str = None, memory_budget: int = DEFAULT_MEMORY_BUDGET
+):
+    slabs = iterate_series_slabs(series_path, memory_budget)
+    if mask_path is None:
+        yield from slabs
+        return
+    for slab, mask_slab in zip(slabs, iterate_series_slabs(mask_path, memory_budget)):
+        yield slab[mask_slab != 0]
+
+
+def calculate_masked_range(
+    series_path: str, mask_path: str = None, memory_budget: int = DEFAULT_MEMORY_BUDGET
+) -> tuple:
+    minimum, maximum = np.inf, -np.inf
+    for slab in iterate_masked_slabs(series_path, mask_path, memory_budget):
+        if slab.size:
+            minimum = min(minimum, slab.min())
+            maximum = max(maximum, slab.max())
+    return minimum, maximum
+
+
+def calculate_streaming_similarity_metrics(
+    target_scan: str,
+    scan_path: str,
+    bins: int = 10,
+    mask_path: str = None,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    target_edges: np.ndarray = None,
+) -> dict:
+    # Target, scan and mask slabs are held together.
+    memory_budget //= 3
+    if target_edges is None:
+        target_edges = calculate_range_bin_edges(
+            *calculate_masked_range(target_scan, mask_path, memory_budget), bins
+        )
+    scan_edges = calculate_range_bin_edges(
+        *calculate_masked_range(scan_path, mask_path, memory_budget), bins
+    )
+    accumulator = SimilarityAccumulator(bins)
+    slabs = zip(
+        iterate_masked_slabs(target_scan, mask_path, memory_budget),
+        iterate_masked_slabs(scan_path, mask_path, memory_budget),
+    )
+    for target_slab, scan_slab in slabs:
+        accumulator.update(
+            target_slab,
+            scan_slab,
+            calculate_bin_indices(target_slab, bins, target_edges),
+            calculate_bin_indices(scan_slab, bins, scan_edges),
+        )
+    return accumulator.results()
+
+
+def iterate_similarity_metrics(
+    target_scan: str,
+    scans: dict,
+    bins: int = 10,
+    mask=None,
+    memory_budget: int = None,
+):
+    if memory_budget is not None:
+        if mask is not None and not isinstance(mask, str):
+            raise ValueError("Streaming similarity requires the mask as a NIfTI path!")
+        target_edges = calculate_range_bin_edges(
+            *calculate_masked_range(target_scan, mask, memory_budget // 3), bins
+        )
+        for subject_id, scan_path in scans.items():
+            yield subject_id, calculate_streaming_similarity_metrics(
+                target_scan, scan_path, bins, mask, memory_budget, target_edges
+            )
+        return
+    mask = load_mask(mask)
+    target_data = extract_series_data(target_scan)
+    if mask is not None:
+        target_data = target_data[mask]
+    target_indices = calculate_bin_indices(target_data, bins)
+    for subject_id, scan_path in scans.items():
+        scan_data = extract_series_data(scan_path)
+        if mask is not None:
+            scan_data = scan_data[mask]
+        yield subject_id, calculate_similarity_metrics(
+            target_data, scan_data, bins, target_indices=target_indices
+        )
+
+
+def calculate_similarity_scores(
+    target_id: str,
+    cost_function: str,
+    bins: int = 10,
+    mask=None,
+    memory_budget: int = None,
+    catalog=None,
+) -> pd.DataFrame:
+    target_scan = get_target_scan(target_id)
+    realigned_subject_dirs = generate_subject_dirs(
+        "realigned", target_id, cost_function, catalog=catalog
+    )
+    realigned_scans = dict()
+    for subject_dir in realigned_subject_dirs:
+        subject_id = subject_dir.split("/")[-2]
+        realigned_scans[subject_id] = get_realigned_subject_data(
+            target_id, cost_function, subject_id, include_mat=False, catalog=catalog
+        )
+    scores = dict(
+        iterate_similarity_metrics(
+            target_scan, realigned_scans, bins, mask, memory_budget
+        )
+    )
+    result = pd.DataFrame.from_dict(scores, orient="index", columns=SIMILARITY_METRICS)
+    result.index.name = "Subject ID"
+    return result
@@ -1,7 +1,10 @@
 import os
 
-from dao import LOCATION_DICT, get_scans
-from nipype.interfaces.fsl import BET
+from dao import LOCATION_DICT, get_scans, get_volume_path
+from instrumentation import measure, report
+from output_commit import OutputCommit, is_complete
+from scheduler import Job
+from volume_format import finalize_volume, get_fsl_output_path, get_fsl_output_type
 
 
 def get_default_destination(scan: str, create: bool = True) -> str:
@@ -10,28 +13,97 @@ def get_default_destination(scan: str, create: bool = True) -> str:
     file_name, subject_id = parts[-1], parts[-2]
     if create:
         os.makedirs(os.path.join(output_dir, subject_id), exist_ok=True)
-    return os.path.join(output_dir, subject_id, file_name)
+    return get_volume_path(os.path.join(output_dir, subject_id, file_name))
 
 
-def run_bet(robust: bool = True, skip_existing: bool = True):
-    scans = get_scans(LOCATION_DICT["raw"])
+def create_bet(scan: str, dest: str, robust: bool = True):
+    from nipype.interfaces.fsl import BET
+
+    bet = BET(robust=robust)
+    bet.inputs.in_file = scan
+    # BET writes NIfTI; finalize_volume converts it to the intermediate format.
+    bet.inputs.output_type = get_fsl_output_type()
+    bet.inputs.out_file = get_fsl_output_path(dest)
+    return bet
+
+
+def strip_skull(scan: str, dest: str, robust: bool = True):
+    with OutputCommit(dest, [scan], {"robust": robust}) as commit:
+        tmp_dest = commit.stage(dest)
+        bet = create_bet(scan, tmp_dest, robust)
+        commit.track(bet.inputs.out_file)
+        with measure("bet", scan.split("/")[-2]):
+            bet.run()
+        finalize_volume(bet.inputs.out_file, tmp_dest)
+
+
+def run_bet(
+    robust: bool = True,
+    skip_existing: bool = True,
+    scheduler=None,
+    queue=None,
+    manifest=None,
+) -> dict:
+    if manifest is None:
+        scans = get_scans(LOCATION_DICT["raw"])
+    else:
+        scans = manifest.get_planned_scans(LOCATION_DICT["raw"])
+    failures = dict()
+    jobs = []
+    outputs = dict()
+    commits = dict()
     for scan in scans:
-        print(f"\nCurrent series: {scan}")
+        report(f"\nCurrent series: {scan}")
         if skip_existing:
-            print("Checking for existing skull-stripping output...", end="\t")
+            report("Checking for existing skull-stripping output...", end="\t")
         dest = get_default_destination(scan)
-        if skip_existing and os.path.isfile(dest):
-            print(f"\u2714")
+        # A destination without a completion marker may be half-written.
+        if skip_existing and is_complete(dest, [scan], {"robust": robust}):
+            report(f"\u2714")
+            continue
+        report(f"\u2718")
+        if queue is not None:
+            from work_queue import get_skull_strip_key
+
+            subject_id = scan.split("/")[-2]
+            payload = {
+                "scan": scan,
+                "dest": dest,
+                "robust": robust,
+                "subject_id": subject_id,
+            }
+            queue.publish(get_skull_strip_key(subject_id), "skull_strip", payload)
+            report("Queued skull-stripping.")
             continue
-        print(f"\u2718")
-        print("Running skull-stripping with BET...", end="\t")
+        if scheduler is not None:
+            commit = OutputCommit(dest, [scan], {"robust": robust}).begin()
+            tmp_dest = commit.stage(dest)
+            bet = create_bet(scan, tmp_dest, robust)
+            commit.track(bet.inputs.out_file)
+            outputs[scan] = (bet.inputs.out_file, tmp_dest)
+            commits[scan] = commit
+            jobs.append(
+                Job.from_interface(scan, "bet", bet, outputs=[bet.inputs.out_file])
+            )
+            continue
+        report("Running skull-stripping with BET...", end="\t")
         try:
-            bet = BET(robust=True)
-            bet.inputs.in_file = scan
-            bet.inputs.out_file = dest
-            bet.run()
-            print(f"\u2714\tDone!")
+            strip_skull(scan, dest, robust)
+            report(f"\u2714\tDone!")
         except Exception as e:
-            print(f"\u2718")
-            print(e.args)
-            break
+            report(f"\u2718")
+            report(e.args)
+            failures[scan] = str(e)
+    if jobs:
+        for scan, result in scheduler.run(jobs).items():
+            if result.status != "done":
+                commits[scan].finish(False)
+                failures[scan] = result.error
+                continue
+            try:
+                finalize_volume(*outputs[scan])
+                commits[scan].finish(True)
+            except Exception as e:
+                commits[scan].finish(False)
+                failures[scan] = str(e)
+    return failures
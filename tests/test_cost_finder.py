@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+ndimage = pytest.importorskip("scipy.ndimage")
+
+from cost_finder import NATIVE_BINS, calculate_native_cost
+
+SHAPE = (20, 18, 16)
+ZOOMS = (2.0, 2.0, 2.5)
+
+
+@pytest.fixture(autouse=True)
+def get_data(monkeypatch):
+    # The native path reads volumes through get_data, which newer nibabel
+    # releases no longer provide.
+    monkeypatch.setattr(
+        nib.Nifti1Image, "get_data", lambda image: np.asanyarray(image.dataobj)
+    )
+
+
+def save_volume(path, data: np.ndarray, flip: bool) -> str:
+    # flip gives the affine a positive determinant, for which FLIRT flips the
+    # x axis of its coordinates.
+    affine = np.diag([ZOOMS[0] if flip else -ZOOMS[0], ZOOMS[1], ZOOMS[2], 1])
+    nib.save(nib.Nifti1Image(data.astype(np.float32), affine), str(path))
+    return str(path)
+
+
+def save_matrix(path, matrix: np.ndarray) -> str:
+    np.savetxt(str(path), matrix)
+    return str(path)
+
+
+def create_phantom(seed: int) -> np.ndarray:
+    random = np.random.RandomState(seed)
+    return ndimage.gaussian_filter(random.normal(500, 200, SHAPE), 1.5)
+
+
+def to_fsl_coordinates(flip: bool) -> np.ndarray:
+    scaling = np.diag(list(ZOOMS) + [1.0])
+    if flip:
+        scaling[0, 0], scaling[0, 3] = -ZOOMS[0], ZOOMS[0] * (SHAPE[0] - 1)
+    return scaling
+
+
+def calculate_expected_costs(target: np.ndarray, resampled: np.ndarray) -> dict:
+    # Correlation ratio and Studholme's NMI from np.histogram2d's binning.
+    histogram, target_edges, _ = np.histogram2d(target, resampled, NATIVE_BINS)
+    target_bins = np.clip(np.digitize(target, target_edges) - 1, 0, NATIVE_BINS - 1)
+    counts = np.bincount(target_bins, minlength=NATIVE_BINS)
+    sums = np.bincount(target_bins, resampled, NATIVE_BINS)
+    means = np.divide(sums, counts, out=np.zeros(NATIVE_BINS), where=counts > 0)
+    within = np.sum((resampled - means[target_bins]) ** 2)
+    correlation_ratio = 1 - within / np.sum((resampled - resampled.mean()) ** 2)
+
+    def entropy(counts):
+        probabilities = counts[counts > 0] / counts.sum()
+        return -np.sum(probabilities * np.log(probabilities))
+
+    nmi = (entropy(histogram.sum(0)) + entropy(histogram.sum(1))) / entropy(histogram)
+    return {
+        "Correlation Ratio": 1 - correlation_ratio,
+        "Normalized Mutual Information": -nmi,
+    }
+
+
+@pytest.mark.parametrize("flip", [False, True])
+@pytest.mark.parametrize("translation", [(0, 0, 0), (2, -1, 3), (0.5, 1.25, -0.75)])
+@pytest.mark.parametrize(
+    "cost_function", ["Correlation Ratio", "Normalized Mutual Information"]
+)
+def test_native_cost_matches_reference(tmp_path, flip, translation, cost_function):
+    target = create_phantom(0)
+    scan = create_phantom(1) * 0.5 + target
+    # A FLIRT matrix moving the scan by the given voxels, in FSL millimetres,
+    # and the scan resampled onto the target grid by scipy.
+    matrix = np.eye(4)
+    matrix[:3, 3] = np.multiply(translation, ZOOMS)
+    vox2vox = (
+        np.linalg.inv(to_fsl_coordinates(flip))
+        .dot(np.linalg.inv(matrix))
+        .dot(to_fsl_coordinates(flip))
+    )
+    grid = np.indices(SHAPE).reshape(3, -1)
+    coordinates = vox2vox[:3, :3].dot(grid) + vox2vox[:3, 3:]
+    inside = np.all(
+        (coordinates >= 0) & (coordinates <= np.array(SHAPE)[:, None] - 1), axis=0
+    )
+    resampled = ndimage.map_coordinates(scan, coordinates[:, inside], order=1)
+    expected = calculate_expected_costs(target.ravel()[inside], resampled)
+    native = calculate_native_cost(
+        save_volume(tmp_path / "scan.nii", scan, flip),
+        save_volume(tmp_path / "target.nii", target, flip),
+        save_matrix(tmp_path / "scan.mat", matrix),
+        cost_function,
+    )
+    # Measured at up to 5e-8 for CR, from resampling in single precision,
+    # and exact for NMI.
+    assert native == pytest.approx(expected[cost_function], rel=1e-6)
@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+
+from nibabel import openers
+
+from mutual_information import (
+    SLAB_BYTES_PER_VOXEL,
+    calculate_bin_indices,
+    calculate_joint_histogram,
+    calculate_streaming_joint_histogram,
+    iterate_batch_mutual_information,
+    iterate_series_slabs,
+    iterate_streaming_mutual_information,
+)
+
+SHAPE = (12, 10, 9)
+
+
+def save_volume(path, data: np.ndarray, slope: float = None) -> str:
+    image = nib.Nifti1Image(data, np.eye(4))
+    if slope is not None:
+        image.header.set_slope_inter(slope, 0.5)
+    nib.save(image, str(path))
+    return str(path)
+
+
+def load_batch_data(path: str) -> np.ndarray:
+    # What extract_series_data hands the batch path.
+    return np.asanyarray(nib.load(path).dataobj).flatten()
+
+
+def calculate_batch_joint_histogram(path1: str, path2: str, bins: int) -> np.ndarray:
+    return calculate_joint_histogram(
+        calculate_bin_indices(load_batch_data(path1), bins),
+        calculate_bin_indices(load_batch_data(path2), bins),
+        bins,
+    )
+
+
+@pytest.fixture
+def volumes(tmp_path):
+    random = np.random.RandomState(0)
+    target = random.normal(500, 120, SHAPE).astype(np.float32)
+    # Correlated with the target, stored scaled as integers, with exact
+    # minimum and maximum values on different slabs.
+    scan = (target * 0.7 + random.normal(0, 60, SHAPE)).astype(np.int16)
+    scan[0, 0, 0], scan[-1, -1, -1] = scan.min() - 40, scan.max() + 40
+    return (
+        save_volume(tmp_path / "target.nii.gz", target),
+        save_volume(tmp_path / "scan.nii", scan, slope=2.0),
+    )
+
+
+def get_budget(slices: int) -> int:
+    # A streaming budget that fits the given number of slices per volume.
+    return 2 * slices * SHAPE[0] * SHAPE[1] * SLAB_BYTES_PER_VOXEL
+
+
+@pytest.mark.parametrize("bins", [2, 10, 64])
+@pytest.mark.parametrize("slices", [1, 2, 4, SHAPE[2]])
+def test_streaming_histogram_matches_batch(volumes, bins, slices):
+    batch = calculate_batch_joint_histogram(*volumes, bins)
+    streaming = calculate_streaming_joint_histogram(
+        *volumes, bins, memory_budget=get_budget(slices)
+    )
+    np.testing.assert_array_equal(streaming, batch)
+    assert streaming.sum() == np.prod(SHAPE)
+
+
+def test_batch_histogram_matches_numpy(volumes):
+    data1, data2 = (load_batch_data(path) for path in volumes)
+    expected = np.histogram2d(data1, data2, 10)[0]
+    np.testing.assert_array_equal(
+        calculate_batch_joint_histogram(*volumes, 10), expected
+    )
+
+
+def test_constant_volume(tmp_path, volumes):
+    constant = save_volume(tmp_path / "constant.nii.gz", np.full(SHAPE, 7, np.int16))
+    batch = calculate_batch_joint_histogram(volumes[0], constant, 10)
+    streaming = calculate_streaming_joint_histogram(
+        volumes[0], constant, 10, memory_budget=get_budget(2)
+    )
+    np.testing.assert_array_equal(streaming, batch)
+
+
+def test_gzipped_volume_is_decompressed_once_per_pass(tmp_path, monkeypatch):
+    # Without keeping the file open, every slab of a .nii.gz is decompressed
+    # from the start of the file again.
+    random = np.random.RandomState(0)
+    shape = SHAPE[:2] + (64,)
+    target = random.normal(500, 120, shape).astype(np.float32)
+    volumes = (
+        save_volume(tmp_path / "target.nii.gz", target),
+        save_volume(tmp_path / "scan.nii.gz", (target * 0.7).astype(np.int16), 2.0),
+    )
+    opened = []
+    init = openers.Opener.__init__
+
+    def count_opens(opener, *args, **kwargs):
+        opened.append(args[0])
+        init(opener, *args, **kwargs)
+
+    monkeypatch.setattr(openers.Opener, "__init__", count_opens)
+    whole = list(iterate_series_slabs(volumes[0], get_budget(shape[2])))
+    opens_per_pass = len(opened)
+    slabs = list(iterate_series_slabs(volumes[0], get_budget(1) // 2))
+    assert len(slabs) == shape[2] and len(whole) == 1
+    assert len(opened) == 2 * opens_per_pass
+    np.testing.assert_array_equal(np.sort(np.concatenate(slabs)), np.sort(whole[0]))
+    streaming = calculate_streaming_joint_histogram(
+        *volumes, 10, memory_budget=get_budget(1)
+    )
+    np.testing.assert_array_equal(
+        streaming, calculate_batch_joint_histogram(*volumes, 10)
+    )
+
+
+def test_streaming_rejects_mismatched_shapes(tmp_path, volumes):
+    other = save_volume(tmp_path / "other.nii.gz", np.ones((12, 10, 8), np.float32))
+    with pytest.raises(ValueError):
+        calculate_streaming_joint_histogram(volumes[0], other, 10)
+
+
+def test_streaming_scores_match_batch(volumes, monkeypatch):
+    pytest.importorskip("sklearn")
+    # The batch path reads volumes through get_data, which newer nibabel
+    # releases no longer provide.
+    monkeypatch.setattr(
+        nib.Nifti1Image, "get_data", lambda image: np.asanyarray(image.dataobj)
+    )
+    target, scan = volumes
+    scans = {"subject": scan, "self": target}
+    batch = dict(iterate_batch_mutual_information(target, scans, 10))
+    streaming = dict(
+        iterate_streaming_mutual_information(target, scans, 10, get_budget(3))
+    )
+    assert streaming.keys() == batch.keys()
+    for subject_id in batch:
+        assert streaming[subject_id] == pytest.approx(batch[subject_id], rel=1e-12)
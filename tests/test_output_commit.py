@@ -0,0 +1,96 @@
+import os
+import time
+
+import pytest
+
+from output_commit import OutputCommit, adopt, get_marker_path, is_complete
+
+PARAMS = {"robust": True}
+
+
+@pytest.fixture
+def scan(tmp_path):
+    path = tmp_path / "raw" / "MPRAGE.nii.gz"
+    path.parent.mkdir()
+    path.write_text("scan")
+    return str(path)
+
+
+@pytest.fixture
+def dest(tmp_path):
+    (tmp_path / "out").mkdir()
+    return str(tmp_path / "out" / "MPRAGE.nii.gz")
+
+
+def write(path: str, content: str = "output"):
+    with open(path, "w") as output_file:
+        output_file.write(content)
+
+
+def test_commit_moves_outputs_into_place(scan, dest):
+    matrix = dest.replace(".nii.gz", ".mat")
+    with OutputCommit(dest, [scan], PARAMS) as commit:
+        tmp_dest, tmp_matrix = commit.stage(dest), commit.stage(matrix)
+        assert tmp_dest.endswith(".nii.gz") and tmp_matrix.endswith(".mat")
+        write(tmp_dest)
+        write(tmp_matrix)
+        assert not os.path.exists(dest)
+    assert sorted(os.listdir(os.path.dirname(dest))) == [
+        ".MPRAGE.complete",
+        "MPRAGE.mat",
+        "MPRAGE.nii.gz",
+    ]
+    assert is_complete(dest, [scan], PARAMS)
+    assert not is_complete(dest, [scan], {"robust": False})
+
+
+def test_failed_unit_leaves_nothing(scan, dest):
+    with pytest.raises(RuntimeError):
+        with OutputCommit(dest, [scan], PARAMS) as commit:
+            write(commit.stage(dest))
+            raise RuntimeError("tool failed")
+    assert os.listdir(os.path.dirname(dest)) == []
+    assert not is_complete(dest, [scan], PARAMS)
+
+
+def test_missing_output_aborts_the_commit(scan, dest):
+    with pytest.raises(FileNotFoundError):
+        with OutputCommit(dest, [scan], PARAMS) as commit:
+            write(commit.stage(dest))
+            commit.stage(dest.replace(".nii.gz", ".mat"))
+    assert os.listdir(os.path.dirname(dest)) == []
+
+
+def test_changed_input_invalidates_the_marker(scan, dest):
+    with OutputCommit(dest, [scan], PARAMS) as commit:
+        write(commit.stage(dest))
+    time.sleep(0.01)
+    write(scan, "rescanned")
+    assert not is_complete(dest, [scan], PARAMS)
+
+
+def test_changed_output_invalidates_the_marker(scan, dest):
+    with OutputCommit(dest, [scan], PARAMS) as commit:
+        write(commit.stage(dest))
+    time.sleep(0.01)
+    write(dest, "edited by hand")
+    assert not is_complete(dest, [scan], PARAMS)
+    adopt(dest, [scan], PARAMS)
+    assert is_complete(dest, [scan], PARAMS)
+
+
+def test_crashed_unit_is_redone(scan, dest):
+    with OutputCommit(dest, [scan], PARAMS) as commit:
+        write(commit.stage(dest), "first")
+    # A crash after the old marker was cleared and an output was half
+    # replaced, before the new marker was written.
+    commit = OutputCommit(dest, [scan], PARAMS).begin()
+    write(commit.stage(dest), "partial")
+    write(dest, "partial")
+    assert not os.path.exists(get_marker_path(dest))
+    assert not is_complete(dest, [scan], PARAMS)
+    with OutputCommit(dest, [scan], PARAMS) as commit:
+        write(commit.stage(dest), "second")
+    assert is_complete(dest, [scan], PARAMS)
+    with open(dest) as output_file:
+        assert output_file.read() == "second"
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+
+import instrumentation
+
+from dao import get_scans
+from planner import Plan, ScanManifest, report_plan
+
+SCANS = {
+    "subject1": {"MPRAGE_1mm": 1.0, "T1W_highres": 0.5, "FLAIR": 1.0},
+    "subject2": {"T1W": 0.8, "MPRAGE": 1.2},
+    "subject3": {"FLAIR": 1.0, "t2_tse": 0.7},
+}
+
+
+@pytest.fixture
+def base_dir(tmp_path):
+    for subject_id, scans in SCANS.items():
+        (tmp_path / subject_id).mkdir()
+        for name, zoom in scans.items():
+            image = nib.Nifti1Image(np.zeros((4, 4, 4), np.int16), np.eye(4) * zoom)
+            nib.save(image, str(tmp_path / subject_id / f"{name}.nii.gz"))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("scan_type", [None, "t1", "t2"])
+def test_manifest_chooses_the_scans_get_scans_does(base_dir, tmp_path, scan_type):
+    manifest = ScanManifest(str(tmp_path / "manifest.json"))
+    manifest.refresh(base_dir)
+    assert sorted(manifest.choose_scans(base_dir, scan_type)) == sorted(
+        get_scans(base_dir, scan_type)
+    )
+
+
+def test_plan_is_printed_when_quiet(monkeypatch, capsys):
+    monkeypatch.setattr(instrumentation, "QUIET", True)
+    report_plan(Plan("realign", [], [], [0.0], 2))
+    assert "Planned 0 realign jobs" in capsys.readouterr().out
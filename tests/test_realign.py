@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("nipype")
+nib = pytest.importorskip("nibabel")
+
+from realign import register_linear, run_registrations
+
+# Accepts FLIRT's command line, copies the input to the output and writes an
+# identity matrix; inputs of subjects named BROKEN make it fail.
+STUB_FLIRT = """
+import shutil, sys
+args = sys.argv[1:]
+options = dict(zip(args[::2], args[1::2]))
+if "BROKEN" in options["-in"]:
+    sys.exit("stub failure")
+shutil.copyfile(options["-in"], options["-out"])
+with open(options["-omat"], "w") as matrix_file:
+    matrix_file.write("1 0 0 0\\n0 1 0 0\\n0 0 1 0\\n0 0 0 1\\n")
+"""
+COST_FUNCTION = "Correlation Ratio"
+
+
+def save_volume(path) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), np.float32), np.eye(4)), str(path))
+    return str(path)
+
+
+@pytest.fixture
+def flirt(write_stub, monkeypatch):
+    monkeypatch.setenv("FSLOUTPUTTYPE", "NIFTI_GZ")
+    return write_stub("flirt", STUB_FLIRT)
+
+
+@pytest.fixture
+def scans(tmp_path):
+    subject_ids = ["SUBJECT1", "SUBJECT2", "BROKEN", "SUBJECT3"]
+    return [
+        save_volume(tmp_path / "Skull-stripped" / subject_id / "MPRAGE.nii.gz")
+        for subject_id in subject_ids
+    ]
+
+
+@pytest.fixture
+def register_all(scans, tmp_path, flirt):
+    target_scan = save_volume(tmp_path / "target" / "MPRAGE.nii.gz")
+
+    def register(workers: int) -> dict:
+        return run_registrations(
+            register_linear,
+            scans,
+            workers,
+            target_scan=target_scan,
+            output_dir=str(tmp_path / "Realigned"),
+            cost_function=COST_FUNCTION,
+            command=flirt,
+        )
+
+    return register
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_every_subject_is_registered(register_all, tmp_path, workers):
+    results = register_all(workers)
+    assert set(results) == {"SUBJECT1", "SUBJECT2", "SUBJECT3", "BROKEN"}
+    for subject_id in ("SUBJECT1", "SUBJECT2", "SUBJECT3"):
+        assert results[subject_id].status == "done"
+        subject_dir = tmp_path / "Realigned" / subject_id
+        assert sorted(os.listdir(subject_dir)) == [
+            ".MPRAGE.complete",
+            "MPRAGE.mat",
+            "MPRAGE.nii.gz",
+        ]
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_failing_subject_is_reported(register_all, tmp_path, workers):
+    results = register_all(workers)
+    assert results["BROKEN"].status == "failed"
+    assert results["BROKEN"].error
+    # Nothing of the failed attempt is left behind.
+    assert os.listdir(tmp_path / "Realigned" / "BROKEN") == []
+
+
+def test_registered_subjects_are_skipped(register_all):
+    register_all(2)
+    results = register_all(2)
+    statuses = {subject_id: result.status for subject_id, result in results.items()}
+    assert statuses == {
+        "SUBJECT1": "skipped",
+        "SUBJECT2": "skipped",
+        "SUBJECT3": "skipped",
+        "BROKEN": "failed",
+    }
@@ -0,0 +1,50 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from result_log import ResultLog
+
+PARAMS = {"bins": 256}
+
+
+def append_records(path: str, worker: int, count: int):
+    log = ResultLog(path, PARAMS)
+    for index in range(count):
+        log.append(f"{worker}-{index}", index)
+
+
+def test_partial_last_line_is_trimmed_on_append(tmp_path):
+    path = tmp_path / "log.jsonl"
+    log = ResultLog(str(path), PARAMS)
+    log.append("a", 1.0)
+    with open(path, "a") as log_file:
+        log_file.write('{"subject_id": "b", "val')
+    # Opening the log leaves it alone; only a writer holding the lock repairs.
+    ResultLog(str(path), PARAMS)
+    assert path.read_text().endswith('"val')
+    log.append("c", 3.0)
+    assert log.to_dict() == {"a": 1.0, "c": 3.0}
+
+
+def test_concurrent_appends_keep_every_record(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(append_records, path, worker, 50) for worker in range(4)
+        ]
+        for future in futures:
+            future.result()
+    records = list(ResultLog(path, PARAMS).iterate_records())
+    assert len(records) == 200
+    assert len(ResultLog(path, PARAMS).completed()) == 200
+
+
+def test_other_params_are_kept(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    ResultLog(path, {"bins": 64}).append("a", 0.5)
+    log = ResultLog(path, PARAMS)
+    log.append("a", 1.0)
+    log.append("b", 2.0)
+    assert log.to_dict() == {"a": 1.0, "b": 2.0}
+    assert log.count_other_params() == 1
+    log.discard()
+    assert log.to_dict() == {}
+    assert ResultLog(path, {"bins": 64}).to_dict() == {"a": 0.5}
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from aggregate_index import update_index
+from results_store import (
+    COST_METRIC,
+    MUTUAL_INFORMATION_METRIC,
+    read_results,
+    write_metric,
+)
+
+VALUES = {"a": 1.0, "b": 2.0, "c": 3.0}
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    store_dir = str(tmp_path / "store")
+    for target_id in ("T1", "T2"):
+        write_metric(
+            VALUES, target_id, "Correlation Ratio", MUTUAL_INFORMATION_METRIC, store_dir
+        )
+        write_metric(VALUES, target_id, "Correlation Ratio", COST_METRIC, store_dir)
+    return store_dir
+
+
+def test_rows_are_filtered_by_subject_and_metric(store_dir):
+    results = read_results(
+        "T1", subject_id="b", metric=COST_METRIC, store_dir=store_dir
+    )
+    assert results.to_dict("records") == [
+        {
+            "target_id": "T1",
+            "subject_id": "b",
+            "cost_function": "Correlation Ratio",
+            "metric": COST_METRIC,
+            "value": 2.0,
+        }
+    ]
+    results = read_results(subject_id=["a", "c"], store_dir=store_dir)
+    assert len(results) == 8
+    assert set(results["subject_id"]) == {"a", "c"}
+    assert list(results.index) == list(range(8))
+
+
+def test_partitions_are_summarized(store_dir):
+    entries = [
+        entry
+        for partition in update_index(store_dir)["partitions"].values()
+        for entry in partition["entries"]
+    ]
+    assert len(entries) == 4
+    assert {entry["max"] for entry in entries} == {3.0}
@@ -0,0 +1,122 @@
+import json
+
+from scheduler import FslScheduler, Job
+
+STUB_TOOL = """
+import json, os, sys, time
+options = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+if "-log" in options:
+    with open(options["-log"], "a") as log_file:
+        log_file.write(json.dumps(["start", time.time()]) + "\\n")
+time.sleep(float(options.get("-sleep", 0)))
+if "-count" in options:
+    with open(options["-count"], "a") as count_file:
+        count_file.write("x")
+    if len(open(options["-count"]).read()) < int(options.get("-succeed-on", 1)):
+        sys.exit("not yet")
+if "-out" in options:
+    open(options["-out"], "w").close()
+if "-log" in options:
+    with open(options["-log"], "a") as log_file:
+        log_file.write(json.dumps(["end", time.time()]) + "\\n")
+print(os.environ.get("FSLOUTPUTTYPE", "unset"), options.get("-cost", ""))
+sys.exit(int(options.get("-exit", 0)))
+"""
+
+
+def create_scheduler(**kwargs) -> FslScheduler:
+    return FslScheduler(**dict(dict(retries=0, backoff=0), **kwargs))
+
+
+def test_done_job_returns_stdout(write_stub, tmp_path):
+    tool = write_stub("flirt", STUB_TOOL)
+    out = tmp_path / "out.nii.gz"
+    job = Job("a", "flirt", f"{tool} -out {out} -cost 0.25", outputs=[str(out)])
+    result = create_scheduler().run([job])["a"]
+    assert result.status == "done"
+    assert result.returncode == 0
+    assert result.stdout.split()[-1] == "0.25"
+
+
+def test_failed_job_reports_stderr(write_stub):
+    tool = write_stub("flirt", STUB_TOOL)
+    result = create_scheduler().run([Job("a", "flirt", f"{tool} -exit 3")])["a"]
+    assert result.status == "failed"
+    assert result.returncode == 3
+
+
+def test_missing_outputs_fail_the_job(write_stub, tmp_path):
+    tool = write_stub("bet", STUB_TOOL)
+    job = Job("a", "bet", tool, outputs=[str(tmp_path / "never_written.nii.gz")])
+    result = create_scheduler().run([job])["a"]
+    assert result.status == "failed"
+    assert "Missing outputs" in result.error
+
+
+def test_failed_job_is_retried(write_stub, tmp_path):
+    tool = write_stub("flirt", STUB_TOOL)
+    count = tmp_path / "count"
+    job = Job("a", "flirt", f"{tool} -count {count} -succeed-on 2")
+    result = create_scheduler(retries=2).run([job])["a"]
+    assert result.status == "done"
+    assert result.attempts == 2
+
+
+def test_timeout_kills_job(write_stub):
+    tool = write_stub("fnirt", STUB_TOOL)
+    job = Job("a", "fnirt", f"{tool} -sleep 30", timeout=0.5)
+    result = create_scheduler().run([job])["a"]
+    assert result.status == "timeout"
+    assert result.attempts == 1
+
+
+def test_job_environment_reaches_the_command(write_stub):
+    tool = write_stub("flirt", STUB_TOOL)
+    job = Job("a", "flirt", tool, environ={"FSLOUTPUTTYPE": "NIFTI"})
+    result = create_scheduler().run([job])["a"]
+    assert result.stdout.split()[0] == "NIFTI"
+
+
+def test_from_interface_keeps_interface_environment(write_stub):
+    tool = write_stub("bet", STUB_TOOL)
+
+    class Inputs:
+        environ = {"FSLOUTPUTTYPE": "NIFTI_GZ"}
+
+    class Interface:
+        cmdline = tool
+        inputs = Inputs()
+
+    job = Job.from_interface("a", "bet", Interface())
+    result = create_scheduler().run([job])["a"]
+    assert result.stdout.split()[0] == "NIFTI_GZ"
+
+
+def read_intervals(log_path) -> list:
+    events = [json.loads(line) for line in log_path.read_text().splitlines()]
+    starts = sorted(time for event, time in events if event == "start")
+    ends = sorted(time for event, time in events if event == "end")
+    return list(zip(starts, ends))
+
+
+def test_tool_limit_serializes_jobs(write_stub, tmp_path):
+    tool = write_stub("fnirt", STUB_TOOL)
+    log = tmp_path / "log"
+    jobs = [Job(str(i), "fnirt", f"{tool} -sleep 0.2 -log {log}") for i in range(3)]
+    results = create_scheduler(limits={"fnirt": 1}).run(jobs)
+    assert all(result.status == "done" for result in results.values())
+    intervals = read_intervals(log)
+    assert all(end <= start for (_, end), (start, _) in zip(intervals, intervals[1:]))
+
+
+def test_memory_budget_serializes_jobs(write_stub, tmp_path):
+    tool = write_stub("flirt", STUB_TOOL)
+    log = tmp_path / "log"
+    jobs = [
+        Job(str(i), "flirt", f"{tool} -sleep 0.2 -log {log}", memory=600)
+        for i in range(3)
+    ]
+    results = create_scheduler(memory_budget=1000).run(jobs)
+    assert all(result.status == "done" for result in results.values())
+    intervals = read_intervals(log)
+    assert all(end <= start for (_, end), (start, _) in zip(intervals, intervals[1:]))
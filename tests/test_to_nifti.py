@@ -0,0 +1,113 @@
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from to_nifti import convert_series, get_converted_files, is_up_to_date, to_nifti
+
+# Writes a magnitude and a phase image, as dcm2niix does for some series, and
+# records what else was in its output directory when it started.
+STUB_DCM2NIIX = """
+import os, sys, time
+args = sys.argv[1:]
+options = dict(zip(args[:-1:2], args[1:-1:2]))
+if os.environ.get("STUB_FAIL"):
+    sys.exit("stub failure")
+seen = ",".join(sorted(os.listdir(options["-o"])))
+time.sleep(float(os.environ.get("STUB_SLEEP", 0)))
+for suffix in ("", "_ph"):
+    path = os.path.join(options["-o"], options["-f"] + suffix + ".nii.gz")
+    with open(path, "w") as output:
+        output.write(seen)
+"""
+
+
+@pytest.fixture
+def dcm2niix(write_stub):
+    return write_stub("dcm2niix", STUB_DCM2NIIX)
+
+
+@pytest.fixture
+def series(tmp_path):
+    series_dir = tmp_path / "DICOM" / "subject" / "series"
+    series_dir.mkdir(parents=True)
+    (series_dir / "0001.dcm").write_text("")
+    return str(series_dir)
+
+
+def test_conversion_commits_every_output(series, dcm2niix, tmp_path):
+    dest = str(tmp_path / "NIfTI")
+    convert_series(series, dest, "T1", dcm2niix)
+    assert sorted(os.listdir(dest)) == [".T1.complete", "T1.nii.gz", "T1_ph.nii.gz"]
+    assert is_up_to_date(series, os.path.join(dest, "T1.nii.gz"))
+
+
+def test_unconverted_series_is_not_up_to_date(series, tmp_path):
+    assert not is_up_to_date(series, str(tmp_path / "NIfTI" / "T1.nii.gz"))
+
+
+def test_changed_series_is_converted_again(series, dcm2niix, tmp_path):
+    dest = str(tmp_path / "NIfTI")
+    convert_series(series, dest, "T1", dcm2niix)
+    time.sleep(0.01)
+    with open(os.path.join(series, "0002.dcm"), "w"):
+        pass
+    assert not is_up_to_date(series, os.path.join(dest, "T1.nii.gz"))
+
+
+def test_suffixed_conversions_without_marker_are_up_to_date(series, tmp_path):
+    # Conversions from before markers existed, where dcm2niix only wrote
+    # suffixed files.
+    dest = tmp_path / "NIfTI"
+    dest.mkdir()
+    time.sleep(0.01)
+    for name in ("T1_e1.nii.gz", "T1_e2.nii.gz", "T1w.nii.gz"):
+        (dest / name).write_text("")
+    assert get_converted_files(str(dest), "T1") == [
+        str(dest / "T1_e1.nii.gz"),
+        str(dest / "T1_e2.nii.gz"),
+    ]
+    assert is_up_to_date(series, str(dest / "T1.nii.gz"))
+
+
+def test_failed_conversion_leaves_nothing(series, dcm2niix, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_FAIL", "1")
+    dest = str(tmp_path / "NIfTI")
+    with pytest.raises(Exception):
+        convert_series(series, dest, "T1", dcm2niix)
+    assert os.listdir(dest) == []
+    assert not is_up_to_date(series, os.path.join(dest, "T1.nii.gz"))
+
+
+def test_concurrent_jobs_do_not_share_directories(
+    series, dcm2niix, tmp_path, monkeypatch
+):
+    monkeypatch.setenv("STUB_SLEEP", "0.2")
+    dest = str(tmp_path / "NIfTI")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(convert_series, series, dest, name, dcm2niix)
+            for name in ("T1", "T2")
+        ]
+        for future in futures:
+            future.result()
+    for name in ("T1", "T2"):
+        with open(os.path.join(dest, f"{name}.nii.gz")) as output:
+            assert output.read() == ""
+        assert is_up_to_date(series, os.path.join(dest, f"{name}.nii.gz"))
+
+
+def test_to_nifti_skips_converted_series(dcm2niix, tmp_path):
+    pytest.importorskip("pydicom")
+    from benchmark import save_dicom_series
+
+    source_dir = tmp_path / "DICOM"
+    for index in range(3):
+        save_dicom_series(str(source_dir / f"subject{index}" / "series"), str(index))
+    dest_dir = str(tmp_path / "NIfTI")
+    first = to_nifti(str(source_dir), dest_dir, dcm2niix, workers=2)
+    assert sorted(entry["status"] for entry in first) == ["converted"] * 3
+    second = to_nifti(str(source_dir), dest_dir, dcm2niix, workers=2)
+    assert sorted(entry["status"] for entry in second) == ["skipped"] * 3
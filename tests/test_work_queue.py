@@ -0,0 +1,102 @@
+import subprocess
+import time
+
+import pytest
+
+from work_queue import WorkQueue, run_worker
+
+STUB_TOOL = """
+import sys
+if sys.argv[1] == "fail":
+    sys.exit("stub failure")
+print(len(sys.argv[1]))
+"""
+
+
+@pytest.fixture
+def queue(tmp_path):
+    with WorkQueue(str(tmp_path / "queue.sqlite"), max_attempts=2) as queue:
+        yield queue
+
+
+def run_stub(tool: str):
+    # A stage handler that shells out, as the FSL stages do.
+    def handler(payload: dict) -> int:
+        output = subprocess.check_output([tool, payload["subject_id"]])
+        return int(output)
+
+    return handler
+
+
+def test_publish_is_idempotent(queue):
+    assert queue.publish("a", "skull_strip", {"subject_id": "a"})
+    assert not queue.publish("a", "skull_strip", {"subject_id": "other"})
+    assert queue.claim("worker")[2] == {"subject_id": "a"}
+
+
+def test_claimed_task_is_not_claimed_again(queue):
+    queue.publish("a", "skull_strip", {})
+    assert queue.claim("worker1") is not None
+    assert queue.claim("worker2") is None
+    assert queue.pending() == 1
+
+
+def test_claim_filters_by_stage(queue):
+    queue.publish("a", "skull_strip", {})
+    queue.publish("b", "realign", {})
+    key, stage, _ = queue.claim("worker", ["realign"])
+    assert (key, stage) == ("b", "realign")
+
+
+def test_complete_requires_the_owner(queue):
+    queue.publish("a", "mutual_information", {"subject_id": "a"})
+    queue.claim("worker1")
+    assert not queue.complete("a", "worker2", 1.0)
+    assert queue.complete("a", "worker1", 1.0)
+    assert queue.results("mutual_information") == [({"subject_id": "a"}, 1.0)]
+
+
+def test_failures_are_retried_up_to_max_attempts(queue):
+    queue.publish("a", "realign", {})
+    queue.claim("worker")
+    assert queue.fail("a", "worker", "first") == "pending"
+    queue.claim("worker")
+    assert queue.fail("a", "worker", "second") == "failed"
+    assert queue.failures() == {"a": "second"}
+    assert queue.reset_failed() == 1
+    assert queue.claim("worker") is not None
+
+
+def test_expired_leases_are_requeued(queue):
+    queue.publish("a", "realign", {})
+    queue.claim("dead_worker", lease=0.01)
+    time.sleep(0.05)
+    assert queue.requeue_expired() == 1
+    assert not queue.heartbeat("a", "dead_worker")
+    assert queue.claim("worker")[0] == "a"
+
+
+def test_heartbeat_extends_the_lease(queue):
+    queue.publish("a", "realign", {})
+    queue.claim("worker", lease=0.05)
+    assert queue.heartbeat("a", "worker", lease=60)
+    time.sleep(0.1)
+    assert queue.requeue_expired() == 0
+
+
+def test_worker_drains_the_queue(queue, write_stub):
+    handler = run_stub(write_stub("stage", STUB_TOOL))
+    for subject_id in ("one", "three", "fail"):
+        queue.publish(subject_id, "skull_strip", {"subject_id": subject_id})
+    statuses = run_worker(
+        stages=["skull_strip"],
+        wait=False,
+        store=False,
+        handlers={"skull_strip": handler},
+        queue=queue,
+    )
+    # The failing task is retried once before it is given up on.
+    assert statuses == {"done": 2, "retried": 1, "failed": 1}
+    assert sorted(value for _, value in queue.results("skull_strip")) == [3, 5]
+    assert list(queue.failures()) == ["fail"]
+    assert queue.pending() == 0
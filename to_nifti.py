@@ -1,27 +1,140 @@
 import glob
+import json
 import os
-import pydicom
+import shutil
 import subprocess
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from output_commit import OutputCommit, is_complete
 
 DCM2NII = "/export/home/zvibaratz/Programs/MRIcroGL/dcm2niix"
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def read_series_header(series: str, dest_dir: str) -> dict:
+    import pydicom
+
+    sample_dcm = glob.glob(os.path.join(series, "*.dcm"))[0]
+    dcm = pydicom.dcmread(sample_dcm, stop_before_pixels=True)
+    subject_id = dcm.PatientID.zfill(9)
+    series_description = dcm.SeriesDescription
+    if "IR-EPI" in series_description:
+        file_name = "IR-EPI_TI" + str(dcm.InversionTime)
+    else:
+        file_name = series_description
+    series_date = dcm.SeriesDate
+    dest = os.path.join(dest_dir, subject_id, series_date)
+    return {
+        "series": series,
+        "subject_id": subject_id,
+        "file_name": file_name,
+        "dest": dest,
+        "output": os.path.join(dest, f"{file_name}.nii.gz"),
+    }
+
+
+def get_converted_files(dest: str, file_name: str) -> list:
+    # dcm2niix adds suffixes such as _e2 (echoes) and _ph (phase) to the file
+    # name, so a series may be converted to several files.
+    patterns = [f"{file_name}.nii.gz", f"{file_name}_*.nii.gz"]
+    return sorted(
+        path
+        for pattern in patterns
+        for path in glob.glob(os.path.join(glob.escape(dest), pattern))
+    )
+
+
+def is_up_to_date(series: str, output: str) -> bool:
+    # Conversions are committed with a marker listing every file written.
+    # Conversions from before markers existed count when all of their files
+    # are newer than the series.
+    if is_complete(output, [series], {"series": series}):
+        return True
+    dest, name = os.path.split(output)
+    converted = get_converted_files(dest, name[: -len(".nii.gz")])
+    try:
+        series_time = os.path.getmtime(series)
+        return bool(converted) and all(
+            os.path.getmtime(path) >= series_time for path in converted
+        )
+    except FileNotFoundError:
+        return False
+
+
+def convert_series(series: str, dest: str, file_name: str, command: str = DCM2NII):
+    # Each job converts into a directory of its own, so concurrent jobs that
+    # share a destination never see or name-clash with each other's files;
+    # the results are then committed into dest together.
+    os.makedirs(dest, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix=f".{file_name}.", suffix=".tmp", dir=dest)
+    try:
+        command = [command, "-z", "y", "-b", "n", "-o", job_dir, "-f", file_name, series]
+        subprocess.check_output(command, stderr=subprocess.STDOUT)
+        output = os.path.join(dest, f"{file_name}.nii.gz")
+        with OutputCommit(output, [series], {"series": series}) as commit:
+            for name in sorted(os.listdir(job_dir)):
+                path = os.path.join(dest, name)
+                os.replace(os.path.join(job_dir, name), commit.stage(path))
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def convert_entry(entry: dict, command: str = DCM2NII) -> dict:
+    try:
+        convert_series(entry["series"], entry["dest"], entry["file_name"], command)
+    except subprocess.CalledProcessError as e:
+        return dict(entry, status="failed", error=e.output.decode(errors="replace"))
+    except OSError as e:
+        return dict(entry, status="failed", error=str(e))
+    return dict(entry, status="converted", error=None)
+
+
+def write_manifest(manifest: list, dest_dir: str) -> str:
+    path = os.path.join(dest_dir, MANIFEST_FILE_NAME)
+    with open(path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return path
 
 
-def to_nifti(source_dir: str, dest_dir: str = None):
+def to_nifti(
+    source_dir: str,
+    dest_dir: str = None,
+    command: str = DCM2NII,
+    workers: int = 1,
+    header_threads: int = 8,
+    skip_existing: bool = True,
+) -> list:
     series_dirs = glob.glob(os.path.join(source_dir, "*/*/"))
     if dest_dir is None:
         dest_dir = os.path.join(source_dir, "NIfTI")
-        os.makedirs(dest_dir, exist_ok=True)
-    for series in series_dirs:
-        sample_dcm = glob.glob(os.path.join(series, "*.dcm"))[0]
-        dcm = pydicom.dcmread(sample_dcm, stop_before_pixels=True)
-        subject_id = dcm.PatientID.zfill(9)
-        series_description = dcm.SeriesDescription
-        if "IR-EPI" in series_description:
-            file_name = "IR-EPI_TI" + dcm.InversionTime
-        else:
-            file_name = series_description
-        series_date = dcm.SeriesDate
-        dest = os.path.join(dest_dir, subject_id, series_date)
-        os.makedirs(dest, exist_ok=True)
-        command = [DCM2NII, "-z", "y", "-b", "n", "-o", dest, "-f", file_name, series]
-        subprocess.check_output(command)
+    os.makedirs(dest_dir, exist_ok=True)
+    manifest = []
+    # Headers are read by a thread pool and fed to at most `workers` concurrent
+    # dcm2niix processes, so reading and converting overlap.
+    with ThreadPoolExecutor(max_workers=header_threads) as header_pool:
+        with ThreadPoolExecutor(max_workers=workers) as conversion_pool:
+            header_futures = {
+                header_pool.submit(read_series_header, series, dest_dir): series
+                for series in series_dirs
+            }
+            conversions = set()
+            for header_future in header_futures:
+                series = header_futures[header_future]
+                try:
+                    entry = header_future.result()
+                except Exception as e:
+                    manifest.append(
+                        {"series": series, "status": "failed", "error": repr(e)}
+                    )
+                    continue
+                if skip_existing and is_up_to_date(series, entry["output"]):
+                    manifest.append(dict(entry, status="skipped", error=None))
+                    continue
+                if len(conversions) >= 2 * workers:
+                    done, conversions = wait(conversions, return_when=FIRST_COMPLETED)
+                    manifest += [future.result() for future in done]
+                conversions.add(conversion_pool.submit(convert_entry, entry, command))
+            manifest += [future.result() for future in conversions]
+    write_manifest(manifest, dest_dir)
+    return manifest
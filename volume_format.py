@@ -0,0 +1,314 @@
+import base64
+import json
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+import dao
+from instrumentation import measure
+
+CHUNKED_FORMATS = ("zstd", "lz4")
+# Formats FSL cannot write directly: it writes uncompressed NIfTI, which is
+# then converted.
+CONVERTED_FORMATS = CHUNKED_FORMATS + ("parallel_gzip",)
+CHUNKED_MAGIC = b"BPVOL1\n"
+DEFAULT_CHUNK_BYTES = 8 * 2 ** 20
+GZIP_BLOCK_BYTES = 4 * 2 ** 20
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+DEFAULT_THREADS = os.cpu_count() or 1
+
+
+def get_volume_format(path: str) -> str:
+    if path.endswith(".nii.zst"):
+        return "zstd"
+    elif path.endswith(".nii.lz4"):
+        return "lz4"
+    elif path.endswith(".nii"):
+        return "nii"
+    return "nii.gz"
+
+
+def get_codec(volume_format: str) -> tuple:
+    # Both codecs are optional dependencies and release the GIL, so chunks
+    # are (de)compressed on threads.
+    if volume_format == "zstd":
+        import zstandard
+
+        # zstandard's (de)compressor objects must not be shared between
+        # threads.
+        def compress(data: bytes) -> bytes:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+        def decompress(data: bytes) -> bytes:
+            return zstandard.ZstdDecompressor().decompress(data)
+
+        return compress, decompress
+    elif volume_format == "lz4":
+        import lz4.frame
+
+        return lz4.frame.compress, lz4.frame.decompress
+    raise ValueError(
+        f"Invalid chunked format {volume_format}! Use one of {CHUNKED_FORMATS}."
+    )
+
+
+def get_fsl_output_type(volume_format: str = None) -> str:
+    volume_format = volume_format or dao.VOLUME_FORMAT
+    return "NIFTI_GZ" if volume_format == "nii.gz" else "NIFTI"
+
+
+def get_fsl_output_path(path: str, volume_format: str = None) -> str:
+    # Where FSL should write a volume whose final path is `path`.
+    volume_format = volume_format or dao.VOLUME_FORMAT
+    if volume_format in CONVERTED_FORMATS:
+        return dao.get_volume_path(path, "nii")
+    return dao.get_volume_path(path, volume_format)
+
+
+def write_chunked(
+    data: np.ndarray,
+    affine: np.ndarray,
+    header_block: bytes,
+    path: str,
+    volume_format: str = "zstd",
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+    threads: int = DEFAULT_THREADS,
+):
+    # Chunks are slabs along the last axis, laid out in Fortran order like the
+    # NIfTI data itself, so slab-streaming readers decompress only what they
+    # need.
+    compress, _ = get_codec(volume_format)
+    data = np.asfortranarray(data)
+    slice_bytes = data.nbytes // max(1, data.shape[-1])
+    chunk_slices = max(1, chunk_bytes // max(1, slice_bytes))
+    starts = range(0, data.shape[-1], chunk_slices)
+    slabs = (data[..., start : start + chunk_slices] for start in starts)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        chunks = list(executor.map(lambda slab: compress(slab.tobytes("F")), slabs))
+    header = {
+        "format": volume_format,
+        "shape": list(data.shape),
+        "dtype": data.dtype.str,
+        "affine": np.asarray(affine).tolist(),
+        "nifti_header": base64.b64encode(header_block).decode(),
+        "chunk_slices": chunk_slices,
+        "chunk_lengths": [len(chunk) for chunk in chunks],
+    }
+    header_bytes = json.dumps(header).encode()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as volume_file:
+        volume_file.write(CHUNKED_MAGIC)
+        volume_file.write(struct.pack("<Q", len(header_bytes)))
+        volume_file.write(header_bytes)
+        for chunk in chunks:
+            volume_file.write(chunk)
+    os.replace(tmp_path, path)
+
+
+class ChunkedVolume:
+    # Read-only array proxy over a chunked volume, sliced along its last axis
+    # the way iterate_series_slabs slices nibabel's proxies.
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as volume_file:
+            if volume_file.read(len(CHUNKED_MAGIC)) != CHUNKED_MAGIC:
+                raise ValueError(f"{path} is not a chunked volume!")
+            (header_length,) = struct.unpack("<Q", volume_file.read(8))
+            self.header = json.loads(volume_file.read(header_length).decode())
+            offset = volume_file.tell()
+        self.shape = tuple(self.header["shape"])
+        self.dtype = np.dtype(self.header["dtype"])
+        self.affine = np.array(self.header["affine"])
+        self.chunk_slices = self.header["chunk_slices"]
+        self.offsets = []
+        for length in self.header["chunk_lengths"]:
+            self.offsets.append((offset, length))
+            offset += length
+        _, self.decompress = get_codec(self.header["format"])
+        self._cached = None
+
+    def read_chunk(self, index: int) -> np.ndarray:
+        if self._cached is not None and self._cached[0] == index:
+            return self._cached[1]
+        offset, length = self.offsets[index]
+        with open(self.path, "rb") as volume_file:
+            volume_file.seek(offset)
+            raw = self.decompress(volume_file.read(length))
+        start = index * self.chunk_slices
+        slices = min(self.chunk_slices, self.shape[-1] - start)
+        chunk = np.frombuffer(raw, dtype=self.dtype)
+        chunk = chunk.reshape(self.shape[:-1] + (slices,), order="F")
+        self._cached = index, chunk
+        return chunk
+
+    def read_slices(self, start: int, stop: int) -> np.ndarray:
+        first, last = start // self.chunk_slices, (stop - 1) // self.chunk_slices
+        chunks = [self.read_chunk(index) for index in range(first, last + 1)]
+        data = chunks[0] if len(chunks) == 1 else np.concatenate(chunks, axis=-1)
+        offset = first * self.chunk_slices
+        return data[..., start - offset : stop - offset]
+
+    def __getitem__(self, key):
+        if not (
+            isinstance(key, tuple)
+            and len(key) == 2
+            and key[0] is Ellipsis
+            and isinstance(key[1], slice)
+            and key[1].step in (None, 1)
+        ):
+            return self.get_data()[key]
+        start, stop, _ = key[1].indices(self.shape[-1])
+        return self.read_slices(start, max(start, stop))
+
+    def get_data(self, threads: int = DEFAULT_THREADS) -> np.ndarray:
+        data = np.empty(self.shape, dtype=self.dtype, order="F")
+
+        def read(index: int):
+            offset, length = self.offsets[index]
+            with open(self.path, "rb") as volume_file:
+                volume_file.seek(offset)
+                raw = self.decompress(volume_file.read(length))
+            start = index * self.chunk_slices
+            stop = min(start + self.chunk_slices, self.shape[-1])
+            chunk = np.frombuffer(raw, dtype=self.dtype)
+            data[..., start:stop] = chunk.reshape(
+                self.shape[:-1] + (stop - start,), order="F"
+            )
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(read, range(len(self.offsets))))
+        return data
+
+    def to_image(self):
+        import nibabel as nib
+
+        header_block = base64.b64decode(self.header["nifti_header"])
+        header = nib.Nifti1Header(binaryblock=header_block)
+        # The stored data is already scaled, so the header must not scale it
+        # again when the image is saved.
+        header.set_slope_inter(None, None)
+        return nib.Nifti1Image(self.get_data(), self.affine, header)
+
+
+def load_image(path: str):
+    # A nibabel image for any supported format.
+    if get_volume_format(path) in CHUNKED_FORMATS:
+        return ChunkedVolume(path).to_image()
+    import nibabel as nib
+
+    return nib.load(path)
+
+
+def load_proxy(path: str, keep_file_open: bool = False):
+    if get_volume_format(path) in CHUNKED_FORMATS:
+        return ChunkedVolume(path)
+    import nibabel as nib
+
+    return nib.load(path, keep_file_open=keep_file_open).dataobj
+
+
+def load_data(path: str) -> np.ndarray:
+    if get_volume_format(path) in CHUNKED_FORMATS:
+        return ChunkedVolume(path).get_data()
+    import nibabel as nib
+
+    return np.asarray(nib.load(path).get_data())
+
+
+def write_parallel_gzip(
+    source_path: str, path: str, threads: int = DEFAULT_THREADS, level: int = GZIP_LEVEL
+):
+    # Blocks are compressed as independent gzip members; concatenated members
+    # are a valid gzip stream for nibabel, FSL and gzip itself.
+    def compress(block: bytes) -> bytes:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def read_blocks():
+        with open(source_path, "rb") as source_file:
+            for block in iter(lambda: source_file.read(GZIP_BLOCK_BYTES), b""):
+                yield block
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        with open(tmp_path, "wb") as volume_file:
+            for member in executor.map(compress, read_blocks()):
+                volume_file.write(member)
+    os.replace(tmp_path, path)
+
+
+def save_image(image, path: str, volume_format: str = None):
+    volume_format = volume_format or get_volume_format(path)
+    path = dao.get_volume_path(path, volume_format)
+    with measure("volume_write", path=path, volume_format=volume_format):
+        if volume_format in CHUNKED_FORMATS:
+            write_chunked(
+                np.asarray(image.get_data()),
+                image.affine,
+                image.header.binaryblock,
+                path,
+                volume_format,
+            )
+        elif volume_format == "parallel_gzip":
+            import nibabel as nib
+
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(path)) as tmp:
+                nifti_path = os.path.join(tmp, "volume.nii")
+                nib.save(image, nifti_path)
+                write_parallel_gzip(nifti_path, path)
+        else:
+            import nibabel as nib
+
+            nib.save(image, path)
+    return path
+
+
+def finalize_volume(fsl_path: str, path: str, volume_format: str = None) -> str:
+    # Converts what FSL wrote into the configured format.
+    volume_format = volume_format or dao.VOLUME_FORMAT
+    path = dao.get_volume_path(path, volume_format)
+    if fsl_path == path:
+        return path
+    if volume_format == "parallel_gzip":
+        with measure("volume_write", path=path, volume_format=volume_format):
+            write_parallel_gzip(fsl_path, path)
+    else:
+        save_image(load_image(fsl_path), path, volume_format)
+    os.remove(fsl_path)
+    return path
+
+
+def export_volume(path: str, dest: str) -> str:
+    # Final exports are always gzipped NIfTI, whatever the intermediates use.
+    dest = dao.get_volume_path(dest, "nii.gz")
+    if path.endswith(".nii.gz"):
+        shutil.copyfile(path, dest)
+        return dest
+    return save_image(load_image(path), dest, "parallel_gzip")
+
+
+@contextmanager
+def fsl_readable(path: str):
+    # FSL only reads NIfTI, so chunked inputs are expanded to a temporary
+    # uncompressed copy for the duration of the command.
+    if get_volume_format(path) not in CHUNKED_FORMATS:
+        yield path
+        return
+    import nibabel as nib
+
+    tmp = tempfile.mkdtemp(prefix="brain_profile_")
+    try:
+        nifti_name = os.path.basename(dao.get_volume_path(path, "nii"))
+        nifti_path = os.path.join(tmp, nifti_name)
+        nib.save(load_image(path), nifti_path)
+        yield nifti_path
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
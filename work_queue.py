@@ -0,0 +1,363 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from dao import get_mutual_information_log_path, get_work_queue_path
+from instrumentation import measure, report
+from result_log import ResultLog
+
+QUEUE_STAGES = ("skull_strip", "realign", "mutual_information")
+DEFAULT_LEASE = 5 * 60
+DEFAULT_MAX_ATTEMPTS = 3
+POLL_INTERVAL = 5
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY,
+    stage TEXT,
+    payload TEXT,
+    status TEXT,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER,
+    value TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, stage);
+"""
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    # Any broker exposing publish, claim, heartbeat, complete, fail,
+    # requeue_expired and pending can stand in for this class in run_worker.
+    # Leases compare wall-clock times written by different nodes, so their
+    # clocks should be kept in sync.
+    def __init__(self, path: str = None, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = path or get_work_queue_path()
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.connection.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can
+        # never claim the same task.
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def publish(self, key: str, stage: str, payload: dict) -> bool:
+        # Publishing is idempotent: a key already queued keeps its state.
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, 'pending', NULL, NULL, 0, NULL, NULL)",
+                (key, stage, json.dumps(payload)),
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, owner: str, stages: list = None, lease: float = DEFAULT_LEASE):
+        stages = list(stages or QUEUE_STAGES)
+        placeholders = ", ".join("?" * len(stages))
+        with self.transaction() as connection:
+            row = connection.execute(
+                f"SELECT key, stage, payload, attempts FROM tasks WHERE status = 'pending' AND stage IN ({placeholders}) ORDER BY rowid LIMIT 1",
+                stages,
+            ).fetchone()
+            if row is None:
+                return None
+            key, stage, payload, attempts = row
+            connection.execute(
+                "UPDATE tasks SET status = 'running', owner = ?, lease_expires = ?, attempts = ? WHERE key = ?",
+                (owner, time.time() + lease, attempts + 1, key),
+            )
+        return key, stage, json.loads(payload)
+
+    def heartbeat(self, key: str, owner: str, lease: float = DEFAULT_LEASE) -> bool:
+        # False means the lease expired and the task was handed to someone else.
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE key = ? AND owner = ? AND status = 'running'",
+                (time.time() + lease, key, owner),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, key: str, owner: str, value=None) -> bool:
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET status = 'done', value = ?, error = NULL WHERE key = ? AND owner = ? AND status = 'running'",
+                (json.dumps(value), key, owner),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, key: str, owner: str, error: str) -> str:
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT attempts FROM tasks WHERE key = ? AND owner = ? AND status = 'running'",
+                (key, owner),
+            ).fetchone()
+            if row is None:
+                return None
+            status = "pending" if row[0] < self.max_attempts else "failed"
+            connection.execute(
+                "UPDATE tasks SET status = ?, owner = NULL, error = ? WHERE key = ?",
+                (status, error, key),
+            )
+        return status
+
+    def requeue_expired(self) -> int:
+        now = time.time()
+        with self.transaction() as connection:
+            requeued = connection.execute(
+                "UPDATE tasks SET status = 'pending', owner = NULL, error = 'Lease expired' WHERE status = 'running' AND lease_expires < ? AND attempts < ?",
+                (now, self.max_attempts),
+            ).rowcount
+            connection.execute(
+                "UPDATE tasks SET status = 'failed', owner = NULL, error = 'Lease expired' WHERE status = 'running' AND lease_expires < ?",
+                (now,),
+            )
+        return requeued
+
+    def pending(self, stages: list = None) -> int:
+        # Tasks that may still need a worker, including those running now
+        # whose lease could yet expire.
+        stages = list(stages or QUEUE_STAGES)
+        placeholders = ", ".join("?" * len(stages))
+        with self.lock:
+            return self.connection.execute(
+                f"SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'running') AND stage IN ({placeholders})",
+                stages,
+            ).fetchone()[0]
+
+    def counts(self) -> dict:
+        counts = defaultdict(dict)
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT stage, status, COUNT(*) FROM tasks GROUP BY stage, status"
+            ).fetchall()
+        for stage, status, count in rows:
+            counts[stage][status] = count
+        return dict(counts)
+
+    def results(self, stage: str) -> list:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT payload, value FROM tasks WHERE stage = ? AND status = 'done'",
+                (stage,),
+            ).fetchall()
+        return [(json.loads(payload), json.loads(value)) for payload, value in rows]
+
+    def failures(self) -> dict:
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT key, error FROM tasks WHERE status = 'failed'"
+                ).fetchall()
+            )
+
+    def reset_failed(self) -> int:
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0 WHERE status = 'failed'"
+            ).rowcount
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Heartbeat(threading.Thread):
+    def __init__(self, queue, key: str, owner: str, lease: float = DEFAULT_LEASE):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.key = key
+        self.owner = owner
+        self.lease = lease
+        self.lost = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease / 3):
+            if not self.queue.heartbeat(self.key, self.owner, self.lease):
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def get_skull_strip_key(subject_id: str) -> str:
+    return f"skull_strip:{subject_id}"
+
+
+def get_realign_key(target_id: str, cost_function: str, subject_id: str) -> str:
+    return f"realign:{target_id}:{cost_function}:{subject_id}"
+
+
+def get_mutual_information_key(
+    target_id: str, cost_function: str, subject_id: str
+) -> str:
+    return f"mutual_information:{target_id}:{cost_function}:{subject_id}"
+
+
+def run_skull_strip_task(payload: dict):
+    from output_commit import is_complete
+    from skull_strip import strip_skull
+
+    # A requeued task whose earlier attempt committed its output is done.
+    if is_complete(payload["dest"], [payload["scan"]], {"robust": payload["robust"]}):
+        return
+    os.makedirs(os.path.dirname(payload["dest"]), exist_ok=True)
+    strip_skull(payload["scan"], payload["dest"], payload["robust"])
+
+
+def run_realign_task(payload: dict):
+    from realign import register_linear
+
+    # A requeued task skips registrations an earlier attempt committed and
+    # redoes any it left half-written.
+    result = register_linear(
+        payload["scan"],
+        payload["target_scan"],
+        payload["output_dir"],
+        payload["cost_function"],
+        payload["command"],
+    )
+    if result.status == "failed":
+        raise RuntimeError(result.error)
+
+
+def run_mutual_information_task(payload: dict) -> float:
+    from mutual_information import (
+        calculate_scans_mutual_information_score,
+        get_mutual_information_params,
+    )
+
+    score = float(
+        calculate_scans_mutual_information_score(
+            payload["target_scan"], payload["scan"], payload["bins"]
+        )
+    )
+    log_path = get_mutual_information_log_path(
+        payload["target_id"], payload["cost_function"]
+    )
+    params = get_mutual_information_params(payload["bins"])
+    ResultLog(log_path, params).append(payload["subject_id"], score)
+    return score
+
+
+STAGE_HANDLERS = {
+    "skull_strip": run_skull_strip_task,
+    "realign": run_realign_task,
+    "mutual_information": run_mutual_information_task,
+}
+
+
+def store_queue_results(queue, store_dir: str = None) -> list:
+    from results_store import MUTUAL_INFORMATION_METRIC, exclusive_lock, write_metric
+
+    scores = defaultdict(dict)
+    for payload, value in queue.results("mutual_information"):
+        partition = payload["target_id"], payload["cost_function"]
+        scores[partition][payload["subject_id"]] = value
+    paths = []
+    # Workers on several nodes may drain the queue at the same time.
+    with exclusive_lock(f"{queue.path}.lock"):
+        for (target_id, cost_function), values in scores.items():
+            path = write_metric(
+                values, target_id, cost_function, MUTUAL_INFORMATION_METRIC, store_dir
+            )
+            paths.append(path)
+    return paths
+
+
+def execute_task(
+    queue, key: str, stage: str, payload: dict, owner: str, handlers: dict, lease: float
+) -> str:
+    heartbeat = Heartbeat(queue, key, owner, lease)
+    heartbeat.start()
+    try:
+        with measure(f"queue_{stage}", payload.get("subject_id"), key=key):
+            value = handlers[stage](payload)
+    except Exception as e:
+        heartbeat.stop()
+        status = queue.fail(key, owner, str(e))
+        report(f"\u2718 {key}: {e}")
+        return "retried" if status == "pending" else "failed"
+    heartbeat.stop()
+    if not queue.complete(key, owner, value):
+        report(f"\u2718 {key}: lease lost before completion")
+        return "lost"
+    report(f"\u2714 {key}")
+    return "done"
+
+
+def run_worker(
+    queue_path: str = None,
+    stages: list = None,
+    lease: float = DEFAULT_LEASE,
+    poll_interval: float = POLL_INTERVAL,
+    wait: bool = True,
+    store: bool = True,
+    handlers: dict = None,
+    queue=None,
+) -> dict:
+    # With wait, the worker stays until nothing is pending or running anywhere,
+    # so it can pick up tasks whose owners died; otherwise it exits as soon as
+    # nothing is claimable.
+    handlers = dict(STAGE_HANDLERS, **(handlers or {}))
+    owner = get_worker_id()
+    owns_queue = queue is None
+    queue = queue or WorkQueue(queue_path)
+    statuses = defaultdict(int)
+    try:
+        while True:
+            requeued = queue.requeue_expired()
+            if requeued:
+                report(f"Requeued {requeued} tasks with expired leases.")
+            task = queue.claim(owner, stages, lease)
+            if task is None:
+                if not wait or not queue.pending(stages):
+                    break
+                time.sleep(poll_interval)
+                continue
+            statuses[execute_task(queue, *task, owner, handlers, lease)] += 1
+        if store and queue.results("mutual_information"):
+            store_queue_results(queue)
+    finally:
+        if owns_queue:
+            queue.close()
+    report(f"Worker {owner} finished: {dict(statuses)}")
+    return dict(statuses)
+
+
+def run_local_workers(workers: int, queue_path: str = None, **kwargs) -> list:
+    queue_path = queue_path or get_work_queue_path()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run_worker, queue_path, **kwargs) for _ in range(workers)
+        ]
+        return [future.result() for future in futures]